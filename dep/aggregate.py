@@ -0,0 +1,107 @@
+"""Aggregation trees for the sums of the site parameters in the distributed EP
+algorithm.
+
+The sites are split into leaf nodes of consecutive sites, which are further
+gathered into a tree where each node has at most `fanin` children. Each node
+holds the partial sum of the site parameters in its subtree and is calculated
+only from the partial sums of its children, so that the root sums only its own
+children. When some of the sites change, only their leaves and the ancestors of
+those are recalculated.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+
+
+class SumTree(object):
+    """Aggregation tree of the sum of a stacked site array.
+    
+    Parameters
+    ----------
+    n : int
+        The length of the summed vectors.
+    
+    K : int
+        The number of sites.
+    
+    fanin : int
+        The maximum number of sites in a leaf and children of a node.
+    
+    leaf_sum : function
+        Returns the sum of the sites in the given slice as an array of length
+        `n`.
+    
+    """
+    
+    def __init__(self, n, K, fanin, leaf_sum):
+        if fanin < 2:
+            raise ValueError("The fan-in should be at least 2")
+        self.K = K
+        self.fanin = fanin
+        self.leaf_sum = leaf_sum
+        # The partial sums of the nodes on each level, the leaves first
+        self.levels = []
+        n_nodes = K
+        while True:
+            n_nodes = -(-n_nodes // fanin)
+            self.levels.append(np.zeros((n, n_nodes), order='F'))
+            if n_nodes == 1:
+                break
+        # The sum over all the sites
+        self.total = self.levels[-1][:,0]
+    
+    
+    def update(self, sites=None, out=None, map_func=None):
+        """Update the sum after the given sites have changed.
+        
+        Parameters
+        ----------
+        sites : array_like of int, optional
+            The indexes of the changed sites. By default all the sites have
+            changed.
+        
+        out : ndarray, optional
+            If given, the sum is copied into this array.
+        
+        map_func : function, optional
+            Function used in place of the built-in map for calculating the
+            leaves, e.g. the map method of a thread pool.
+        
+        Returns
+        -------
+        total : ndarray
+            The sum over all the sites.
+        
+        """
+        fanin = self.fanin
+        if sites is None:
+            nodes = np.arange(self.levels[0].shape[1])
+        else:
+            nodes = np.unique(np.asarray(sites, dtype=int) // fanin)
+        leaves = self.levels[0]
+        def leaf(j):
+            leaves[:,j] = self.leaf_sum(
+                slice(j*fanin, min((j+1)*fanin, self.K)))
+        if map_func is None:
+            map_func = map
+        map_func(leaf, nodes)
+        # Propagate to the ancestors
+        for (children, level) in zip(self.levels[:-1], self.levels[1:]):
+            nodes = np.unique(nodes // fanin)
+            for j in nodes:
+                np.sum(children[:,j*fanin:(j+1)*fanin], axis=1,
+                       out=level[:,j])
+        if out is not None:
+            np.copyto(out, self.total)
+            return out
+        return self.total
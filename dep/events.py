@@ -0,0 +1,104 @@
+"""Sinks for the events reported by the distributed EP algorithm.
+
+The events of Master.run are given to the functions in its argument `hooks` as
+dicts with the name of the event in key 'event' and the iteration number in key
+'iteration' (see Master.run for the events and their fields). The sinks in this
+module can be used as such hooks: EventTable collects the events in memory and
+JsonLinesFile writes them into a file, one JSON object per line.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import json
+import numpy as np
+
+
+def _json_default(obj):
+    """Convert numpy scalars and arrays for json."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+def read_json_lines(filename):
+    """Read the events written by JsonLinesFile into a list of dicts."""
+    with open(filename, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class EventTable(object):
+    """Sink collecting the events into memory.
+    
+    The events are stored in the instance variable `events` (list of dict).
+    
+    """
+    
+    def __init__(self):
+        self.events = []
+    
+    
+    def __call__(self, event):
+        self.events.append(event)
+    
+    
+    def select(self, event=None, **fields):
+        """Get the events of the given name and with the given field values.
+        
+        Example: table.select('site', site=3) returns the events of site 3.
+        
+        """
+        return [e for e in self.events
+                if (event is None or e['event'] == event)
+                and all(e.get(key) == val for (key, val) in fields.iteritems())]
+    
+    
+    def column(self, key, event=None, **fields):
+        """Get the values of a field in the selected events as an array.
+        
+        The events without the field are skipped. Missing values (None) are
+        converted into nan.
+        
+        """
+        values = [e[key] for e in self.select(event, **fields) if key in e]
+        return np.array([np.nan if v is None else v for v in values])
+
+
+class JsonLinesFile(object):
+    """Sink writing the events into a file, one JSON object per line.
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file.
+    
+    mode : str, optional
+        The mode of opening the file. Default is 'a', i.e. the events are
+        appended to an existing file.
+    
+    """
+    
+    def __init__(self, filename, mode='a'):
+        self.filename = filename
+        self.file = open(filename, mode)
+    
+    
+    def __call__(self, event):
+        self.file.write(json.dumps(event, default=_json_default))
+        self.file.write('\n')
+        self.file.flush()
+    
+    
+    def close(self):
+        """Close the file."""
+        self.file.close()
@@ -0,0 +1,225 @@
+"""Storage for the iteration history of the posterior approximation in the
+distributed EP algorithm.
+
+The history can be stored in memory or streamed into append-only files on disk
+as the iterations finish. Either the full covariance matrix or only its
+diagonal is stored, optionally only on every k-th iteration. A streamed
+history can be loaded as memory-mapped arrays with the function load_history,
+also while the algorithm is still running.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import pickle
+import numpy as np
+
+
+HISTORY_FORM_OPTIONS = ('full', 'diag')
+
+# File names in a streamed history directory
+_META_FILE = 'history.pkl'
+_M_FILE = 'm_phi.dat'
+_COV_FILE = 'cov_phi.dat'
+
+
+def _cov_shape(dphi, form):
+    """Shape of one stored covariance record."""
+    if form == 'full':
+        return (dphi, dphi)
+    else:
+        return (dphi,)
+
+
+def load_history(path, mode='r'):
+    """Load a history streamed on disk as memory-mapped arrays.
+    
+    Only the completely written iterations are included, so a history of a run
+    still in progress can be loaded as well.
+    
+    Parameters
+    ----------
+    path : str
+        The history directory given to History.
+    
+    mode : str, optional
+        The mode of the memory maps, see numpy.memmap. Default is 'r'.
+    
+    Returns
+    -------
+    m_phi, cov_phi : ndarray
+        Mean and covariance (or variance if the history was stored in the
+        diagonal form) of the posterior approximation at the stored
+        iterations.
+    
+    iters : ndarray
+        Indexes of the stored iterations.
+    
+    """
+    with open(os.path.join(path, _META_FILE), 'rb') as f:
+        meta = pickle.load(f)
+    dphi = meta['dphi']
+    cov_shape = _cov_shape(dphi, meta['form'])
+    m_file = os.path.join(path, _M_FILE)
+    cov_file = os.path.join(path, _COV_FILE)
+    # The number of complete records
+    itemsize = np.dtype(np.float64).itemsize
+    n = min(
+        os.path.getsize(m_file) // (itemsize*dphi),
+        os.path.getsize(cov_file) // (itemsize*int(np.prod(cov_shape)))
+    )
+    iters = np.asarray(meta['iters'][:n])
+    if n == 0:
+        return np.zeros((0, dphi)), np.zeros((0,)+cov_shape), iters
+    m_phi = np.memmap(m_file, dtype=np.float64, mode=mode, shape=(n, dphi))
+    cov_phi = np.memmap(cov_file, dtype=np.float64, mode=mode,
+                        shape=(n,)+cov_shape)
+    return m_phi, cov_phi, iters
+
+
+class History(object):
+    """Iteration history of the posterior approximation.
+    
+    Parameters
+    ----------
+    niter : int
+        The number of iterations.
+    
+    dphi : int
+        The dimension of the approximation.
+    
+    form : {'full', 'diag'}, optional
+        Store the full covariance matrix (default) or only its diagonal.
+    
+    every : int, optional
+        Store only every `every`th iteration and the last one. Default is 1.
+    
+    path : str, optional
+        If given, the history is streamed into append-only files in this
+        directory instead of keeping it in memory. Existing history files in
+        the directory are replaced. The memory usage is then independent of
+        `niter`. The history can be loaded with the function load_history.
+    
+    """
+    
+    def __init__(self, niter, dphi, form='full', every=1, path=None):
+        if form not in HISTORY_FORM_OPTIONS:
+            raise ValueError("Invalid history form {!r}".format(form))
+        if every < 1:
+            raise ValueError("Arg. `every` should be positive")
+        self.dphi = dphi
+        self.form = form
+        self.path = path
+        # Indexes of the stored iterations and their slots
+        self.iters = [i for i in xrange(niter)
+                      if (i+1) % every == 0 or i == niter-1]
+        self.slots = dict((i, s) for (s, i) in enumerate(self.iters))
+        cov_shape = _cov_shape(dphi, form)
+        if path is None:
+            self.m_phi = np.zeros((len(self.iters), dphi))
+            self.cov_phi = np.zeros((len(self.iters),)+cov_shape)
+            self.m_file = None
+            self.cov_file = None
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, _META_FILE), 'wb') as f:
+                pickle.dump({'dphi': dphi, 'form': form, 'iters': self.iters},
+                            f, pickle.HIGHEST_PROTOCOL)
+            self.m_phi = None
+            self.cov_phi = None
+            self.m_file = open(os.path.join(path, _M_FILE), 'wb')
+            self.cov_file = open(os.path.join(path, _COV_FILE), 'wb')
+    
+    
+    def record(self, i, m, S):
+        """Record the approximation of iteration i if it is to be stored.
+        
+        Parameters
+        ----------
+        i : int
+            The index of the iteration. The iterations have to be recorded in
+            increasing order.
+        
+        m, S : ndarray
+            The mean and the covariance matrix of the approximation.
+        
+        Returns
+        -------
+        bool
+            True if the iteration was stored.
+        
+        """
+        slot = self.slots.get(i)
+        if slot is None:
+            return False
+        if self.form == 'full':
+            # The matrix is symmetric, store it in C-order
+            cov = S.T
+        else:
+            cov = np.diag(S)
+        if self.path is None:
+            np.copyto(self.m_phi[slot], m)
+            np.copyto(self.cov_phi[slot], cov)
+        else:
+            self.m_file.write(np.ascontiguousarray(m, dtype=np.float64)
+                              .tostring())
+            self.m_file.flush()
+            self.cov_file.write(np.ascontiguousarray(cov, dtype=np.float64)
+                                .tostring())
+            self.cov_file.flush()
+        return True
+    
+    
+    def result(self, n=None):
+        """Get the stored history.
+        
+        Parameters
+        ----------
+        n : int, optional
+            Include only the iterations before iteration n. By default, an
+            in-memory history contains all the slots, including the ones not
+            yet recorded (filled with zeros), and a streamed history contains
+            the recorded iterations.
+        
+        Returns
+        -------
+        m_phi, cov_phi : ndarray
+            Mean and covariance (or variance if the form is 'diag') of the
+            approximation at the stored iterations. Memory-mapped arrays if
+            the history is streamed on disk.
+        
+        """
+        if self.path is None:
+            if n is None:
+                return self.m_phi, self.cov_phi
+            n_slots = np.searchsorted(self.iters, n)
+            return self.m_phi[:n_slots], self.cov_phi[:n_slots]
+        else:
+            if self.m_file is not None:
+                self.m_file.flush()
+                self.cov_file.flush()
+            m_phi, cov_phi, iters = load_history(self.path)
+            if n is not None:
+                n_slots = np.searchsorted(iters, n)
+                m_phi = m_phi[:n_slots]
+                cov_phi = cov_phi[:n_slots]
+            return m_phi, cov_phi
+    
+    
+    def close(self):
+        """Close the files of a streamed history."""
+        if self.m_file is not None:
+            self.m_file.close()
+            self.cov_file.close()
+            self.m_file = None
+            self.cov_file = None
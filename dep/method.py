@@ -1,8 +1,10 @@
 """An implementation of a distributed EP algorithm described in an article
 "Expectation propagation as a way of life" (arXiv:1412.4869).
 
-This implementation works with parallel EP but the calculations are done
-serially with shared memory between workers.
+This implementation works with parallel EP. By default the calculations are
+done serially with shared memory between workers but the tilted distributions
+can also be processed in parallel in a pool of processes, or by site servers
+holding their own data on separate nodes (see Master and module server).
 
 The most recent version of the code can be found on GitHub:
 https://github.com/gelman/ep-stan
@@ -16,7 +18,14 @@ https://github.com/gelman/ep-stan
 # All rights reserved.
 
 from __future__ import division
+import os
 import sys
+import shutil
+import pickle
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
 from timeit import default_timer as timer
 import numpy as np
 from scipy import linalg
@@ -24,15 +33,146 @@ from sklearn.covariance import GraphLassoCV
 
 # LAPACK qr routine
 dgeqrf_routine = linalg.get_lapack_funcs('geqrf')
+# BLAS scaled vector addition routine
+daxpy_routine = linalg.get_blas_funcs('axpy', dtype=np.float64)
 
 from util import (
     invert_normal_params,
     olse,
     get_last_fit_sample,
+    get_constrained_pars,
+    get_fit_adaptation,
+    pystan_version,
+    psislw,
     suppress_stdout,
     load_stan,
-    copy_fit_samples
+    copy_fit_samples,
+    copy_vb_samples,
+    effective_sample_size,
+    shared_zeros,
+    block_slices,
+    packed_triu_indices,
+    pack_triu,
+    unpack_triu,
+    lowrank_factors,
+    lowrank_compress,
+    lowrank_capacitance,
+    cho_factor_blocks,
+    cho_factor_stacked,
+    cho_solve_stacked
 )
+from pool import SitePool, SocketPool
+from history import History
+from aggregate import SumTree
+
+
+class Workspace(object):
+    """Scratch arrays for the methods Worker.cavity and Worker.tilted.
+    
+    A workspace held by a worker between the methods cavity and tilted (see
+    WorkspacePool.acquire) provides its instance variables `Mat` and `vec`
+    through `temp_M` and `temp_v`. The master also borrows the workspaces for
+    the stacked scratch of the cavity checks (see method stacks).
+    
+    Parameters
+    ----------
+    dphi : int
+        The length of the parameter vector phi.
+    
+    phi_blocks : sequence of int, optional
+        The block diagonal structure of the site approximations, see Master.
+    
+    """
+    
+    def __init__(self, dphi, phi_blocks=None):
+        self.temp_M = np.zeros((dphi,dphi), order='F')
+        self.temp_v = np.zeros(dphi)
+        if phi_blocks is None:
+            self.block_temps = None
+        else:
+            # Temporary arrays for the precision estimates of each block
+            self.block_temps = [
+                (np.empty((b,b), order='F'), np.empty((b,b), order='F'))
+                for b in phi_blocks
+            ]
+        self.dphi = dphi
+        # Stacked scratch allocated when first needed
+        self.stack_pair = None
+    
+    
+    def stacks(self, n):
+        """Get two scratch stacks of `n` matrices of shape (dphi,dphi).
+        
+        The stacks are arrays of shape (dphi,dphi,n) in F-order, whose
+        transposes are C-contiguous stacks of shape (n,dphi,dphi) (see
+        Master.cavities and Master.max_damping). They are allocated on the
+        first call and grown if more matrices are requested.
+        
+        """
+        if self.stack_pair is None or self.stack_pair[0].shape[2] < n:
+            self.stack_pair = tuple(
+                np.zeros((self.dphi,self.dphi,n), order='F')
+                for _ in xrange(2)
+            )
+        return self.stack_pair[0][:,:,:n], self.stack_pair[1][:,:,:n]
+
+
+class WorkspacePool(object):
+    """Pool of scratch workspaces shared by the workers.
+    
+    A worker borrows a workspace only for the duration of one call, or holds
+    one for its cavity distribution while being processed, and the master
+    borrows them for the cavity checks of each thread. The memory of the
+    scratch arrays thus scales with the concurrency instead of the number of
+    sites. If all the workspaces are borrowed, a new one is added into the
+    pool.
+    
+    Parameters
+    ----------
+    dphi : int
+        The length of the parameter vector phi.
+    
+    phi_blocks : sequence of int, optional
+        The block diagonal structure of the site approximations, see Master.
+    
+    size : int, optional
+        The number of workspaces allocated in the beginning, i.e. the number
+        of concurrent executors. Default is 1.
+    
+    """
+    
+    def __init__(self, dphi, phi_blocks=None, size=1):
+        self.dphi = dphi
+        self.phi_blocks = phi_blocks
+        self.free = [Workspace(dphi, phi_blocks) for _ in xrange(size)]
+        self.size = size
+        self.lock = threading.Lock()
+    
+    
+    def acquire(self):
+        """Take a workspace from the pool until it is given back with release.
+        """
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            self.size += 1
+        return Workspace(self.dphi, self.phi_blocks)
+    
+    
+    def release(self, ws):
+        """Give back a workspace taken with acquire."""
+        with self.lock:
+            self.free.append(ws)
+    
+    
+    @contextmanager
+    def borrow(self):
+        """Context manager borrowing a workspace from the pool."""
+        ws = self.acquire()
+        try:
+            yield ws
+        finally:
+            self.release(ws)
 
 
 class Worker(object):
@@ -50,11 +190,24 @@ class Worker(object):
         The length of the parameter vector phi.
     
     X, y: ndarray
-        The data included in this site.
+        The data included in this site. None if the data is held only by a
+        site server (see module server), in which case the method tilted can
+        not be used.
     
     A : dict, optional
         Additional data included in this site.
     
+    Mat, vec : ndarray, optional
+        Arrays of shape (dphi,dphi) in F-order and (dphi,) used for the
+        instance variables `Mat` and `vec`. If not provided, they are taken
+        from `workspaces` when the cavity distribution is formed and given
+        back with the method release_cavity, so that only the workers being
+        processed hold them.
+    
+    workspaces : WorkspacePool, optional
+        The pool of scratch arrays shared with the other workers in the same
+        process. Allocated if not provided.
+    
     Other parameters
     ----------------
     See the class DistributedEP
@@ -63,8 +216,25 @@ class Worker(object):
     
     DEFAULT_OPTIONS = {
         'init_prev'       : True,
+        'adapt_prev'      : False,
+        'warmup_full'     : 1,
+        'warmup_decay'    : 0.5,
+        'warmup_min'      : 50,
+        'metric_init'     : None,
+        'metric_shrink'   : 0.5,
+        'reuse'           : None,
+        'reuse_k_max'     : 0.7,
+        'reuse_min_ess'   : 0.5,
+        'tilted_method'   : 'sample',
+        'laplace_iter'    : 20,
+        'advi_algorithm'  : 'meanfield',
+        'advi_iter'       : 10000,
+        'advi_draws'      : 1000,
         'prec_estim'      : 'sample',
         'prec_estim_skip' : 0,
+        'phi_blocks'      : None,
+        'site_form'       : 'full',
+        'site_rank'       : 10,
         'verbose'         : True,
         'tmp_fix_32bit'   : False # FIXME: Temp fix for RandomState problem
     }
@@ -81,9 +251,29 @@ class Worker(object):
     # Available values for option `prec_estim`
     PREC_ESTIM_OPTIONS = ('sample', 'olse', 'glassocv')
     
+    # Available values for option `site_form`
+    SITE_FORM_OPTIONS = ('full', 'lowrank')
+    
+    # Available values for option `metric_init`
+    METRIC_INIT_OPTIONS = (None, 'diag', 'dense')
+    
+    # The oldest PyStan accepting the step size and the (dense) inverse metric
+    # in the sampling argument `control`
+    MIN_PYSTAN_ADAPT = (2, 18)
+    
+    # Available values for option `reuse`
+    REUSE_OPTIONS = (None, 'psis')
+    
+    # Available values for option `tilted_method`
+    TILTED_METHOD_OPTIONS = ('sample', 'laplace', 'advi')
+    
+    # Available values for option `advi_algorithm`
+    ADVI_ALGORITHM_OPTIONS = ('meanfield', 'fullrank')
+    
     RESERVED_STAN_PARAMETER_NAMES = ['X', 'y', 'N', 'D', 'mu_phi', 'Omega_phi']
     
-    def __init__(self, index, stan_model, dphi, X, y, A={}, **options):
+    def __init__(self, index, stan_model, dphi, X, y, A={}, Mat=None,
+                 vec=None, workspaces=None, **options):
         
         # Parse options
         # Set missing options to defaults
@@ -106,9 +296,18 @@ class Worker(object):
         # After calling the method cavity, self.Mat holds the precision matrix
         # and self.vec holds the mean of the cavity distribution. After calling
         # the method tilted, self.Mat holds the unnormalised covariance matrix
-        # and self.vec holds the mean of the tilted distributions.
-        self.Mat = np.empty((dphi,dphi), order='F')
-        self.vec = np.empty(dphi)
+        # and self.vec holds the mean of the tilted distributions. If not
+        # given, they are held only between the method cavity and the method
+        # release_cavity (see self.held_ws).
+        if Mat is not None:
+            if not Mat.flags['FARRAY']:
+                raise ValueError("Arg. `Mat` should be in F-order")
+            if vec is None:
+                vec = np.empty(dphi)
+        self.Mat = Mat
+        self.vec = vec
+        # The workspace providing self.Mat and self.vec
+        self.held_ws = None
         # The instance variable self.phase indicates if self.Mat and self.vec
         # contains the cavity or tilted distribution parameters:
         #     0: neither
@@ -119,27 +318,44 @@ class Worker(object):
         # indicates how many samples has contributed into the unnormalised
         # covariance matrix in self.Mat
         self.nsamp = None
+        # The mean of the latest tilted distribution and its Monte Carlo
+        # standard error
+        self.mt = None
+        self.mt_se = None
+        # The effective sample sizes of the latest tilted distribution samples
+        self.ess = None
+        # The elapsed times of the sample extraction and the precision
+        # estimation in the latest tilted distribution
+        self.extract_time = None
+        self.estim_time = None
         
         # Current iteration global approximations
         self.Q = None
         self.r = None
         
+        # Block diagonal structure of the site approximations
+        self.phi_blocks = options['phi_blocks']
+        self.phi_slices = block_slices(dphi, self.phi_blocks)
+        
         # Temporary arrays for calculations
-        self.temp_M = np.empty((dphi,dphi), order='F')
-        self.temp_v = np.empty(dphi)
+        if workspaces is None:
+            workspaces = WorkspacePool(dphi, self.phi_blocks)
+        self.workspaces = workspaces
         
         # Data for stan model in method tilted
-        self.data = dict(
-            N=X.shape[0],
-            X=X,
-            y=y,
-            mu_phi=self.vec,
-            Omega_phi=self.Mat.T,  # Mat transposed in order to get C-order
-            **A
-        )
-        # Add param `D` only if `X` is two dimensional
-        if len(X.shape) == 2:
-            self.data['D'] = X.shape[1]
+        if X is None:
+            self.data = None
+        else:
+            self.data = dict(
+                N=X.shape[0],
+                X=X,
+                y=y,
+                **A
+            )
+            self._set_cavity_data()
+            # Add param `D` only if `X` is two dimensional
+            if len(X.shape) == 2:
+                self.data['D'] = X.shape[1]
         
         # Store other instance variables
         self.index = index
@@ -165,6 +381,70 @@ class Worker(object):
                 raise ValueError("Arg. `init` has to be a string if "
                                  "`init_prev` is True")
         
+        # Adaptation of the sampler carried over the iterations
+        self.adapt_prev = options['adapt_prev']
+        self.warmup_full = options['warmup_full']
+        self.warmup_decay = options['warmup_decay']
+        self.warmup_min = options['warmup_min']
+        if not 0 < self.warmup_decay <= 1:
+            raise ValueError("Option `warmup_decay` should be in (0,1]")
+        # The step size and the inverse metric of the previous fit, and the
+        # number of consecutive fits they have been carried over
+        self.adapt = None
+        self.adapt_iters = 0
+        
+        # Initial inverse metric formed from the cavity distribution
+        self.metric_init = options['metric_init']
+        if not self.metric_init in self.METRIC_INIT_OPTIONS:
+            raise ValueError("Invalid value for option `metric_init`")
+        self.metric_shrink = options['metric_shrink']
+        if not 0 <= self.metric_shrink <= 1:
+            raise ValueError("Option `metric_shrink` should be in [0,1]")
+        if ((self.adapt_prev or self.metric_init is not None)
+                and pystan_version() < self.MIN_PYSTAN_ADAPT):
+            # The step size and the inverse metric can not be given to the
+            # sampler in older versions
+            raise ValueError(
+                "Options `adapt_prev` and `metric_init` require PyStan {} or "
+                "later".format('.'.join(map(str, self.MIN_PYSTAN_ADAPT)))
+            )
+        # The covariance of phi (or its diagonal) in the previous tilted
+        # distribution
+        self.prev_cov = None
+        
+        # Reuse of the previous samples
+        self.reuse = options['reuse']
+        if not self.reuse in self.REUSE_OPTIONS:
+            raise ValueError("Invalid value for option `reuse`")
+        self.reuse_k_max = options['reuse_k_max']
+        self.reuse_min_ess = options['reuse_min_ess']
+        # The latest samples of phi drawn from the model, their effective
+        # sample sizes, and the cavity distribution (precision matrix, mean)
+        # they were drawn with
+        self.reuse_samp = None
+        self.reuse_ess = None
+        self.reuse_cavity = None
+        # Indicates if the latest tilted distribution reused the samples, and
+        # the Pareto shape estimate of its importance weights (None if not
+        # tried)
+        self.reused = False
+        self.reuse_k = None
+        
+        # Method for the tilted distributions
+        self.tilted_method = options['tilted_method']
+        if not self.tilted_method in self.TILTED_METHOD_OPTIONS:
+            raise ValueError("Invalid value for option `tilted_method`")
+        self.laplace_iter = options['laplace_iter']
+        # The latest mode of the Laplace approximation
+        self.laplace_mode = None
+        self.advi_algorithm = options['advi_algorithm']
+        if not self.advi_algorithm in self.ADVI_ALGORITHM_OPTIONS:
+            raise ValueError("Invalid value for option `advi_algorithm`")
+        self.advi_iter = options['advi_iter']
+        self.advi_draws = options['advi_draws']
+        # The mean of phi in the latest variational approximation
+        self.advi_mean = None
+        
         # Tilted precision estimate method
         self.prec_estim = options['prec_estim']
         if not self.prec_estim in self.PREC_ESTIM_OPTIONS:
@@ -176,6 +456,21 @@ class Worker(object):
         if self.prec_estim == 'glassocv':
             self.glassocv = GraphLassoCV(assume_centered=True)
         
+        # Form of the site approximations
+        self.site_form = options['site_form']
+        if not self.site_form in self.SITE_FORM_OPTIONS:
+            raise ValueError("Invalid value for option `site_form`")
+        self.site_rank = min(options['site_rank'], dphi)
+        if self.site_form == 'lowrank':
+            if self.site_rank < 1:
+                raise ValueError("Option `site_rank` should be positive")
+            if self.prec_estim != 'sample' or self.phi_blocks is not None:
+                raise ValueError("Low rank site approximations can not be "
+                                 "used with `prec_estim` or `phi_blocks`")
+            if self.tilted_method == 'laplace':
+                raise ValueError("Low rank site approximations can not be "
+                                 "used with the Laplace approximation")
+        
         # Verbose option
         self.verbose = options['verbose']
         
@@ -187,16 +482,64 @@ class Worker(object):
             self.fix32bit = False
         
     
-    def cavity(self, Q, r, Qi, ri):
+    def _set_cavity_data(self):
+        """Point the cavity distribution in the Stan data to Mat and vec."""
+        if self.data is not None:
+            self.data['mu_phi'] = self.vec
+            # Mat transposed in order to get C-order
+            self.data['Omega_phi'] = None if self.Mat is None else self.Mat.T
+    
+    
+    def _hold_cavity(self):
+        """Take the arrays Mat and vec from the workspaces if not held."""
+        if self.Mat is None:
+            self.held_ws = self.workspaces.acquire()
+            self.Mat = self.held_ws.temp_M
+            self.vec = self.held_ws.temp_v
+            self._set_cavity_data()
+    
+    
+    def release_cavity(self):
+        """Give back the arrays Mat and vec taken by the method cavity.
+        
+        Called after the cavity or the tilted distribution in them is no
+        longer needed. Does nothing if the arrays were given in the
+        constructor.
+        
+        """
+        if self.held_ws is not None:
+            self.Mat = None
+            self.vec = None
+            self._set_cavity_data()
+            self.workspaces.release(self.held_ws)
+            self.held_ws = None
+    
+    
+    def cavity(self, Q, r, Qi, ri, mean=None):
         """Form the cavity distribution and convert them to moment parameters.
         
+        If the instance variables Mat and vec were not given in the
+        constructor, they are taken from the workspaces for the cavity
+        distribution and should be given back with the method release_cavity
+        after the tilted distribution has been processed. They are given back
+        already here if the cavity distribution is not positive definite.
+        
         Parameters
         ----------
         Q, r : ndarray
             Natural parameters of the global approximation
         
         Qi, ri : ndarray
-            Natural site parameters
+            Natural site parameters. `Qi` can be a full matrix, its packed
+            upper triangular (see util.pack_triu) or, with the option
+            `site_form` 'lowrank', its low rank factors (see
+            util.lowrank_factors).
+        
+        mean : ndarray, optional
+            The mean of the cavity distribution, if already solved with the
+            cavity distribution known to be positive definite (see
+            Master.cavities). The cavity precision matrix is then not
+            factorised again.
         
         Returns
         -------
@@ -208,55 +551,267 @@ class Worker(object):
         
         self.Q = Q
         self.r = r
-        np.subtract(self.Q, Qi, out=self.Mat)
+        self._hold_cavity()
+        if Qi.ndim == 1 and self.site_form == 'lowrank':
+            # Form the full matrix (symmetric, write transposed)
+            U, w = lowrank_factors(Qi, self.dphi)
+            np.dot(U * w, U.T, out=self.Mat.T)
+            np.subtract(self.Q, self.Mat, out=self.Mat)
+        elif Qi.ndim == 1:
+            unpack_triu(Qi, self.Mat, self.phi_blocks)
+            np.subtract(self.Q, self.Mat, out=self.Mat)
+        else:
+            np.subtract(self.Q, Qi, out=self.Mat)
+        if mean is not None:
+            np.copyto(self.vec, mean)
+            self.phase = 1
+            return True
         np.subtract(self.r, ri, out=self.vec)
         
-        # Check if positive definite and solve the mean
+        # Check if positive definite and solve the mean (block by block)
         try:
-            np.copyto(self.temp_M, self.Mat)
-            cho = linalg.cho_factor(self.temp_M, overwrite_a=True)
-            linalg.cho_solve(cho, self.vec, overwrite_b=True)
+            with self.workspaces.borrow() as ws:
+                np.copyto(ws.temp_M, self.Mat)
+                for sl in self.phi_slices:
+                    cho = linalg.cho_factor(ws.temp_M[sl,sl],
+                                            overwrite_a=True)
+                    linalg.cho_solve(cho, self.vec[sl], overwrite_b=True)
         except linalg.LinAlgError:
             # Not positive definite
             self.phase = 0
+            self.release_cavity()
             return False
         else:
             self.phase = 1
             return True
-        
-        
-    def tilted(self, dQi, dri, save_fit=False):
-        """Estimate the tilted distribution parameters.
-        
-        This method estimates the tilted distribution parameters and calculates
-        the resulting site parameter updates into the given arrays. The cavity
-        distribution has to be calculated before this method is called, i.e. the
-        method cavity has to be run before this.
-        
-        After calling this method the instance variables self.Mat and self.vec
-        hold the tilted distribution moment parameters (note however that the
-        covariance matrix is unnormalised and the number of samples contributing
-        to this matrix is stored in the instance variable self.nsamp).
+    
+    
+    def set_cavity(self, Q, r, Mat, vec):
+        """Set already formed cavity distribution.
         
         Parameters
         ----------
-        dQi, dri : ndarray
-            Output arrays where the site parameter updates are placed.
+        Q, r : ndarray
+            Natural parameters of the global approximation
         
-        save_fit : bool, optional
-            If True, the Stan fit-object is saved into the instance variable
-            `fit` for later use. Default is False.
+        Mat, vec : ndarray
+            The precision matrix and the mean vector of the cavity
+            distribution, as obtained in the instance variables of the same
+            name by the method cavity.
+        
+        """
+        self.Q = Q
+        self.r = r
+        self._hold_cavity()
+        np.copyto(self.Mat, Mat)
+        np.copyto(self.vec, vec)
+        self.phase = 1
+    
+    
+    def get_state(self):
+        """Get the state of the worker carried over the iterations.
         
         Returns
         -------
-        pos_def
-            True if the estimated tilted distribution covariance matrix is
-            positive definite. False otherwise.
+        state : dict
+            The sampler initialisation and adaptation, the state of the random
+            number generator, and the counters and timings of the worker. Can be
+            restored with the method set_state.
+        
+        """
+        if self.fix32bit:
+            rand_state = self.rstate
+        else:
+            rand_state = self.stan_params['seed']
+        if isinstance(rand_state, np.random.RandomState):
+            rand_state = rand_state.get_state()
+        return dict(
+            init = self.stan_params['init'],
+            rand_state = rand_state,
+            iteration = self.iteration,
+            prec_estim_skip = self.prec_estim_skip,
+            nsamp = self.nsamp,
+            last_time = self.last_time,
+            mt = self.mt,
+            mt_se = self.mt_se,
+            ess = self.ess,
+            extract_time = self.extract_time,
+            estim_time = self.estim_time,
+            stan_iter = self.stan_params['iter'],
+            stan_warmup = self.stan_params['warmup'],
+            adapt = self.adapt,
+            adapt_iters = self.adapt_iters,
+            prev_cov = self.prev_cov,
+            reuse_samp = self.reuse_samp,
+            reuse_ess = self.reuse_ess,
+            reuse_cavity = self.reuse_cavity,
+            reused = self.reused,
+            reuse_k = self.reuse_k,
+            laplace_mode = self.laplace_mode,
+            advi_mean = self.advi_mean
+        )
+    
+    
+    def set_state(self, state):
+        """Restore the state of the worker obtained with method get_state."""
+        if self.fix32bit:
+            self.rstate.set_state(state['rand_state'])
+        elif isinstance(self.stan_params['seed'], np.random.RandomState):
+            self.stan_params['seed'].set_state(state['rand_state'])
+        else:
+            self.stan_params['seed'] = state['rand_state']
+        self.stan_params['init'] = state['init']
+        self.iteration = state['iteration']
+        self.prec_estim_skip = state['prec_estim_skip']
+        self.nsamp = state['nsamp']
+        self.last_time = state['last_time']
+        self.mt = state['mt']
+        self.mt_se = state['mt_se']
+        self.ess = state['ess']
+        self.extract_time = state['extract_time']
+        self.estim_time = state['estim_time']
+        self.stan_params['iter'] = state['stan_iter']
+        self.stan_params['warmup'] = state['stan_warmup']
+        self.adapt = state['adapt']
+        self.adapt_iters = state['adapt_iters']
+        self.prev_cov = state['prev_cov']
+        self.reuse_samp = state['reuse_samp']
+        self.reuse_ess = state['reuse_ess']
+        self.reuse_cavity = state['reuse_cavity']
+        self.reused = state['reused']
+        self.reuse_k = state['reuse_k']
+        self.laplace_mode = state['laplace_mode']
+        self.advi_mean = state['advi_mean']
+    
+    
+    def set_draws(self, ndraws):
+        """Set the number of samples drawn in the following iterations.
+        
+        The number of iterations of the sampler is set so that at least
+        `ndraws` samples are obtained after the warmup and thinning from all
+        the chains together. The number of warmup iterations is kept fixed.
         
         """
+        if self.stan_params['warmup'] is None:
+            # Fix the default warmup of the current number of iterations
+            self.stan_params['warmup'] = self.stan_params['iter'] // 2
+        chains = self.stan_params['chains']
+        per_chain = -(-int(ndraws) // chains)
+        self.stan_params['iter'] = (self.stan_params['warmup']
+                                    + self.stan_params['thin'] * per_chain)
+    
+    
+    def discard_tilted(self, dQi, dri):
+        """Discard the tilted distribution of the current iteration.
         
-        if self.phase != 1:
-            raise RuntimeError('Cavity has to be calculated before tilted.')
+        The site parameter updates in the given arrays are set to zero and the
+        initialisation and the adaptation of the sampler, as well as the
+        samples kept for reuse, are reset.
+        
+        """
+        self.phase = 0
+        dQi.fill(0)
+        dri.fill(0)
+        if self.init_prev:
+            # Reset initialisation method
+            self.stan_params['init'] = self.init_orig
+        self.adapt = None
+        self.adapt_iters = 0
+        self.prev_cov = None
+        self.reuse_samp = None
+        self.reuse_ess = None
+        self.reuse_cavity = None
+        self.laplace_mode = None
+        self.advi_mean = None
+    
+    
+    def _sampling_params(self):
+        """The arguments for the sampling of the tilted distribution.
+        
+        If the adaptation of the previous fit is carried over, the sampler
+        starts from its step size and inverse metric (see method _inv_metric
+        for option `metric_init`) and the warmup is shortened geometrically
+        after the first `warmup_full` iterations. The number of iterations
+        after the warmup is kept unchanged.
+        
+        """
+        if self.adapt is None or self.adapt_iters < self.warmup_full:
+            if self.metric_init == 'dense':
+                params = self.stan_params.copy()
+                params['control'] = dict(metric='dense_e')
+                return params
+            return self.stan_params
+        params = self.stan_params.copy()
+        warmup = params['warmup']
+        if warmup is None:
+            warmup = params['iter'] // 2
+        n_decay = self.adapt_iters - self.warmup_full + 1
+        params['warmup'] = max(
+            min(self.warmup_min, warmup),
+            int(warmup * self.warmup_decay**n_decay)
+        )
+        params['iter'] -= warmup - params['warmup']
+        stepsize, inv_metric = self.adapt
+        if self.metric_init is None:
+            params['control'] = dict(inv_metric=dict(enumerate(inv_metric)))
+        else:
+            params['control'] = dict(
+                metric = self.metric_init + '_e',
+                inv_metric = dict(enumerate(self._inv_metric(inv_metric)))
+            )
+        if self.adapt_prev:
+            params['control']['stepsize'] = np.mean(stepsize)
+        return params
+    
+    
+    def _inv_metric(self, inv_metric):
+        """Form the initial inverse metric of each chain.
+        
+        The block of phi, which has to be the first parameter in the model, is
+        the cavity covariance moved towards the previous tilted distribution
+        covariance by the factor `metric_shrink`. The block of the local
+        parameters is taken from the given inverse metrics of the previous fit.
+        The metric is diagonal or dense according to the option `metric_init`.
+        
+        """
+        d = self.dphi
+        # The cavity covariance
+        with self.workspaces.borrow() as ws:
+            if self.phi_blocks is not None:
+                ws.temp_M.fill(0)
+            invert_normal_params(self.Mat, out_A=ws.temp_M,
+                                 blocks=self.phi_blocks)
+            if self.metric_init == 'diag':
+                S_phi = np.diag(ws.temp_M).copy()
+            else:
+                S_phi = ws.temp_M.copy()
+        if self.prev_cov is not None and self.metric_shrink > 0:
+            S_phi *= 1 - self.metric_shrink
+            S_phi += self.metric_shrink * self.prev_cov
+        out = []
+        for M in inv_metric:
+            n = M.shape[0]
+            if self.metric_init == 'diag':
+                M_new = np.empty(n)
+                M_new[:d] = S_phi
+                M_new[d:] = M[d:] if M.ndim == 1 else np.diag(M)[d:]
+            else:
+                M_new = np.zeros((n,n))
+                M_new[:d,:d] = S_phi
+                if M.ndim == 1:
+                    M_new[d:,d:].flat[::n-d+1] = M[d:]
+                else:
+                    M_new[d:,d:] = M[d:,d:]
+            out.append(M_new)
+        return out
+    
+    
+    def _sample(self, save_fit):
+        """Sample from the tilted distribution with Stan.
+        
+        Returns the samples of phi in an array of shape (nsamp,dphi).
+        
+        """
         
         # FIXME: Temp fix for RandomState problem in 32-bit Python
         if self.fix32bit:
@@ -267,11 +822,16 @@ class Worker(object):
             time_start = timer()
             fit = self.stan_model.sampling(
                 data=self.data,
-                **self.stan_params
+                **self._sampling_params()
             )
             time_end = timer()
             self.last_time = (time_end - time_start)
         
+        if self.adapt_prev or self.metric_init is not None:
+            # Store the adaptation for the next iteration
+            self.adapt = get_fit_adaptation(fit)
+            self.adapt_iters += 1
+        
         if self.verbose:
             # Mean stepsize
             steps = [np.mean(p['stepsize__'])
@@ -292,135 +852,559 @@ class Worker(object):
         
         # Extract samples
         # TODO: preallocate space for samples
+        time_start = timer()
         samp = copy_fit_samples(fit, self.fit_pnames)
         self.nsamp = samp.shape[0]
+        # Effective sample sizes
+        self.ess = effective_sample_size(samp, self.stan_params['chains'])
+        self.extract_time = timer() - time_start
         
         if save_fit:
             # Save fit
             self.fit = fit
+        
+        return samp
+    
+    
+    def _sample_advi(self):
+        """Draw from the variational approximation of the tilted distribution.
+        
+        The approximation is fitted with StanModel.vb starting from the mean
+        of phi in the previous approximation of the site. Returns the draws of
+        phi in an array of shape (advi_draws,dphi).
+        
+        """
+        if self.advi_mean is None:
+            init = self.init_orig if self.init_prev else 'random'
+        else:
+            init = {'phi': self.advi_mean}
+        with suppress_stdout():
+            time_start = timer()
+            vbfit = self.stan_model.vb(
+                data=self.data,
+                pars=['phi'],
+                iter=self.advi_iter,
+                seed=self.stan_params['seed'],
+                init=init,
+                algorithm=self.advi_algorithm,
+                output_samples=self.advi_draws
+            )
+            self.last_time = timer() - time_start
+        time_start = timer()
+        samp = copy_vb_samples(vbfit, 'phi')
+        self.nsamp = samp.shape[0]
+        # The draws are independent
+        self.ess = np.empty(self.dphi)
+        self.ess.fill(self.nsamp)
+        self.advi_mean = np.mean(samp, axis=0)
+        self.extract_time = timer() - time_start
+        return samp
+    
+    
+    def _reuse_weights(self):
+        """Importance weights of the kept samples in the current tilted
+        distribution.
+        
+        The likelihood terms of the previous and the current tilted
+        distribution cancel out, so that the importance ratios are the ratios
+        of the cavity densities. The weights are smoothed with Pareto smoothed
+        importance sampling (see util.psislw).
+        
+        Returns
+        -------
+        weights : ndarray or None
+            The normalised weights of the samples, or None if there are no
+            samples kept or if the weights are not reliable according to the
+            options `reuse_k_max` and `reuse_min_ess`.
+        
+        ess : float
+            The effective sample size of the weights.
+        
+        """
+        if self.reuse_samp is None:
+            return None, None
+        time_start = timer()
+        Q_prev, m_prev = self.reuse_cavity
+        # Log ratios of the cavity densities
+        diff = self.reuse_samp - m_prev
+        lw = 0.5 * np.einsum('ij,ij->i', diff.dot(Q_prev), diff)
+        diff = self.reuse_samp - self.vec
+        lw -= 0.5 * np.einsum('ij,ij->i', diff.dot(self.Mat), diff)
+        lw, self.reuse_k = psislw(lw, out=lw)
+        weights = np.exp(lw, out=lw)
+        ess = 1 / np.sum(weights**2)
+        self.last_time = timer() - time_start
+        if (    self.reuse_k > self.reuse_k_max
+             or ess < self.reuse_min_ess * weights.shape[0]):
+            return None, None
+        return weights, ess
+    
+    
+    def tilted(self, dQi, dri, save_fit=False):
+        """Estimate the tilted distribution parameters.
+        
+        This method estimates the tilted distribution parameters and calculates
+        the resulting site parameter updates into the given arrays. The cavity
+        distribution has to be calculated before this method is called, i.e. the
+        method cavity has to be run before this.
+        
+        After calling this method the instance variables self.Mat and self.vec
+        hold the tilted distribution moment parameters (note however that the
+        covariance matrix is unnormalised and the number of samples contributing
+        to this matrix is stored in the instance variable self.nsamp).
+        
+        Parameters
+        ----------
+        dQi, dri : ndarray
+            Output arrays where the site parameter updates are placed. `dQi`
+            can be a full matrix or a packed upper triangular (see
+            util.pack_triu). With the low rank site approximations, the new
+            site precision matrix is placed into the first half of the factors
+            in `dQi` (see util.lowrank_factors and method _estimate_lowrank)
+            and the rest is left zero.
+        
+        save_fit : bool, optional
+            If True, the Stan fit-object is saved into the instance variable
+            `fit` for later use. If the previous samples are reused (see
+            option `reuse`), there is no new fit and `fit` is set to None.
+            Default is False.
+        
+        Returns
+        -------
+        pos_def
+            True if the estimated tilted distribution covariance matrix is
+            positive definite. False otherwise.
+        
+        """
+        
+        if self.phase != 1:
+            raise RuntimeError('Cavity has to be calculated before tilted.')
+        
+        if dQi.ndim == 1 and self.site_form != 'lowrank':
+            # Estimate into a temporary array and pack in the end
+            dQi_packed = dQi
         else:
-            # Dereference fit here so that it can be garbage collected
-            fit = None
+            dQi_packed = None
+        
+        if self.tilted_method == 'laplace':
+            with self.workspaces.borrow() as ws:
+                if dQi_packed is not None:
+                    dQi = ws.temp_M
+                pos_def = self._tilted_laplace(dQi, dri)
+                if pos_def and dQi_packed is not None:
+                    pack_triu(dQi, out=dQi_packed, blocks=self.phi_blocks)
+            if not pos_def:
+                if dQi_packed is not None:
+                    dQi = dQi_packed
+                self.discard_tilted(dQi, dri)
+            self.iteration += 1
+            return pos_def
+        
+        # Reuse the previous samples if the importance weights are reliable
+        weights = None
+        self.reused = False
+        self.reuse_k = None
+        if self.reuse is not None:
+            weights, ess = self._reuse_weights()
+        
+        if weights is None:
+            if self.reuse is not None:
+                # Keep the samples and their cavity for the later iterations
+                self.reuse_cavity = (self.Mat.copy(order='F'), self.vec.copy())
+            if self.tilted_method == 'advi':
+                samp = self._sample_advi()
+            else:
+                samp = self._sample(save_fit)
+            if self.reuse is not None:
+                self.reuse_samp = samp.copy(order='F')
+                self.reuse_ess = self.ess
+            n_eff = self.nsamp
+            # Mean
+            mt = np.mean(samp, axis=0, out=self.vec)
+            # Center samples
+            samp -= mt
+        else:
+            time_start = timer()
+            samp = self.reuse_samp.copy(order='F')
+            self.reused = True
+            self.nsamp = samp.shape[0]
+            # The effective sample sizes decrease by the relative effective
+            # sample size of the weights
+            n_eff = ess
+            self.ess = self.reuse_ess * (ess / self.nsamp)
+            # Weighted mean
+            mt = np.dot(weights, samp, out=self.vec)
+            # Center and scale the samples so that their scatter matrix is
+            # the weighted one scaled by nsamp
+            samp -= mt
+            samp *= np.sqrt(weights * self.nsamp)[:,np.newaxis]
+            self.extract_time = timer() - time_start
+            if save_fit:
+                # There is no fit of the reused samples
+                self.fit = None
+        
+        # Monte Carlo standard error of the mean (ignoring the autocorrelation
+        # of the samples)
+        self.mt = mt.copy()
+        samp_ss = np.einsum('ij,ij->j', samp, samp)
+        self.mt_se = np.sqrt(samp_ss / ((self.nsamp - 1) * n_eff))
+        if self.metric_init == 'diag':
+            # Store the variances for the inverse metric of the next iteration
+            self.prev_cov = samp_ss / (self.nsamp - 1)
+        elif self.metric_init == 'dense':
+            self.prev_cov = samp.T.dot(samp) / (self.nsamp - 1)
         
         # Estimate precision matrix
-        try:
-            # Basic sample estimate
-            if self.prec_estim == 'sample' or self.prec_estim_skip > 0:
-                # Mean
-                mt = np.mean(samp, axis=0, out=self.vec)
-                # Center samples
-                samp -= mt
-                # Use QR-decomposition for obtaining Cholesky of the scatter
-                # matrix (only R needed, Q-less algorithm would be nice)
-                _, _, _, info = dgeqrf_routine(samp, overwrite_a=True)
-                if info:
-                    raise linalg.LinAlgError(
-                        "dgeqrf LAPACK routine failed with error code {}"
-                        .format(info)
-                    )
-                # Copy the relevant part of the array into contiguous memory
-                np.copyto(self.Mat, samp[:self.dphi,:])
-                invert_normal_params(
-                    self.Mat, mt, out_A=dQi, out_b=dri,
-                    cho_form=True
-                )
-                # Unbiased (for normal distr.) natural parameter estimates
-                unbias_k = (self.nsamp - self.dphi - 2)
-                dQi *= unbias_k
-                dri *= unbias_k
-                if self.prec_estim_skip > 0:
-                    self.prec_estim_skip -= 1
-            
-            # Optimal linear shrinkage estimate
-            elif self.prec_estim == 'olse':
-                # Mean
-                mt = np.mean(samp, axis=0, out=self.vec)
-                # Center samples
-                samp -= mt
-                # Sample covariance
-                np.dot(samp.T, samp, out=self.Mat.T)
-                # Normalise self.Mat into dQi
-                np.divide(self.Mat, self.nsamp, out=dQi)
-                # Estimate
-                olse(dQi, self.nsamp, P=self.Q, out='in-place')
-                np.dot(dQi, mt, out=dri)
-            
-            # Graphical lasso with cross validation
-            elif self.prec_estim == 'glassocv':
-                # Mean
-                mt = np.mean(samp, axis=0, out=self.vec)
-                # Center samples
-                samp -= mt
-                # Fit
-                self.glassocv.fit(samp)
-                if self.verbose:
-                    print '    glasso alpha: {:.4}'.format(self.glassocv.alpha_)
-                np.copyto(dQi, self.glassocv.precision_.T)
-                # Calculate corresponding r
-                np.dot(dQi, mt, out=dri)
+        time_start = timer()
+        with self.workspaces.borrow() as ws:
+            if dQi_packed is not None:
+                dQi = ws.temp_M
+            try:
+                if self.site_form == 'lowrank':
+                    self._estimate_lowrank(samp, mt, dQi, dri)
+                else:
+                    if self.phi_blocks is None:
+                        self._estimate_precision(
+                            samp, mt, self.Mat, self.Q, dQi, dri)
+                    else:
+                        # Estimate each diagonal block from its marginal
+                        # samples
+                        dQi.fill(0)
+                        for (sl, (M_b, dQi_b)) in zip(self.phi_slices,
+                                                      ws.block_temps):
+                            self._estimate_precision(
+                                samp[:,sl], mt[sl], M_b, self.Q[sl,sl],
+                                dQi_b, dri[sl])
+                            dQi[sl,sl] = dQi_b
+                    if self.prec_estim_skip > 0:
+                        self.prec_estim_skip -= 1
+                
+                    # Calculate the difference into the output arrays
+                    np.subtract(dQi, self.Q, out=dQi)
+                    np.subtract(dri, self.r, out=dri)
+                    if dQi_packed is not None:
+                        pack_triu(dQi, out=dQi_packed, blocks=self.phi_blocks)
             
+            except linalg.LinAlgError:
+                # Precision estimate failed
+                pos_def = False
+                if dQi_packed is not None:
+                    dQi = dQi_packed
+                self.discard_tilted(dQi, dri)
             else:
-                raise ValueError("Invalid value for option `prec_estim`")
-            
-            # Calculate the difference into the output arrays
-            np.subtract(dQi, self.Q, out=dQi)
-            np.subtract(dri, self.r, out=dri)
-            
-        except linalg.LinAlgError:
-            # Precision estimate failed
-            pos_def = False
-            self.phase = 0
-            dQi.fill(0)
-            dri.fill(0)
-            if self.init_prev:
-                # Reset initialisation method
-                self.init = self.init_orig
-        else:
-            # Set return and phase flag
-            pos_def = True
-            self.phase = 2
+                # Set return and phase flag
+                pos_def = True
+                self.phase = 2
+        self.estim_time = timer() - time_start
         
         self.iteration += 1
         return pos_def
-
-
-class Master(object):
-    """Manages the distributed EP algorithm.
-    
-    Parameters
-    ----------
-    site_model : StanModel or string
-        Model for sampling from the tilted distribution of a site. Can be
-        provided either directly as a PyStan model instance or as filename
-        string pointing to a pickled model or stan source code. The model has a
-        restricted structure (see Notes).
-    
-    X : ndarray
-        Explanatory variable data in an ndarray of shape (N,D), where N is the
-        number of observations and D is the number of variables. `X` should be
-        C-contiguous (copy made if not). N.B. One dimensional array of shape
-        (N,) is also acceptable, in which case D is not provided to the stan
-        model.
-    
-    y : ndarray
-        Response variable data in an ndarray of shape (N,), where N is the
-        number of observations (same N as for X).
-    
-    A : dict, optional
-        Additional data for the site model. The keys in the dict are the names
-        of the variables and the values are the coresponding objects e.g.
-        integers or ndarrays. These arrays are distributed as a whole for each
-        site. Example: {'var':[3,2]} distributes var=[3,2] to each site.
     
-    A_k : dict, optional
-        Additional data for the site model. The keys in the dict are the names
-        of the variables and the values are array-likes of length K, where K is
-        the number of sites. The first element of the array-likes are
-        distributed to the first site etc. Example: {'var':[3,2]} distributes
-        var=3 to the first site and var=2 to the second site.
     
-    A_n : dict, optional
-        Additional sliced data arrays provided for the site model. The keys in
+    def _tilted_laplace(self, dQi, dri):
+        """Estimate the tilted distribution with the Laplace approximation.
+        
+        The mode is found with StanModel.optimizing and refined with Newton
+        steps in the unconstrained parameter space, backtracking until the log
+        density does not decrease. The Hessian of the log density is obtained
+        by finite differences of its gradient at the final point. The
+        local parameters are marginalised out of the resulting normal
+        approximation, which requires that phi is the first parameter in the
+        model. The site parameter updates are calculated into the full
+        matrix `dQi` and `dri`.
+        
+        After calling this method, the instance variable self.Mat holds the
+        covariance matrix and self.vec the mean of phi, and self.nsamp is 1.
+        
+        Returns
+        -------
+        pos_def
+            True if the approximation is positive definite. False otherwise.
+        
+        """
+        d = self.dphi
+        if self.laplace_mode is None:
+            init = self.init_orig if self.init_prev else 'random'
+        else:
+            init = self.laplace_mode
+        with suppress_stdout():
+            time_start = timer()
+            mode = self.stan_model.optimizing(
+                data=self.data,
+                seed=self.stan_params['seed'],
+                init=init
+            )
+            # Fit object for evaluating the gradient of the log density
+            fit = self.stan_model.sampling(
+                data=self.data,
+                algorithm='Fixed_param',
+                chains=1,
+                iter=1,
+                init=[mode],
+                seed=self.stan_params['seed']
+            )
+            self.last_time = timer() - time_start
+        time_start = timer()
+        u = np.asarray(fit.unconstrain_pars(mode), dtype=np.float64)
+        n = u.shape[0]
+        P = np.empty((n,n), order='F')
+        
+        def derivatives(u):
+            """The gradient and the negative Hessian at u (into P)."""
+            g = fit.grad_log_prob(u, adjust_transform=True)
+            for j in xrange(n):
+                h = 1e-5 * max(1.0, abs(u[j]))
+                u[j] += h
+                P[:,j] = fit.grad_log_prob(u, adjust_transform=True)
+                u[j] -= 2*h
+                P[:,j] -= fit.grad_log_prob(u, adjust_transform=True)
+                u[j] += h
+                P[:,j] /= -2*h
+            P[:] = (P + P.T) / 2
+            return g
+        
+        try:
+            lp = fit.log_prob(u, adjust_transform=True)
+            g = derivatives(u)
+            for i in xrange(self.laplace_iter):
+                cho = linalg.cho_factor(P, overwrite_a=False)
+                step = linalg.cho_solve(cho, g)
+                # Backtrack until the log density does not decrease
+                t = 1.0
+                while t >= 1e-3:
+                    u_new = u + t*step
+                    lp_new = fit.log_prob(u_new, adjust_transform=True)
+                    if lp_new >= lp:
+                        break
+                    t /= 2
+                else:
+                    # No improvement along the Newton direction
+                    break
+                u = u_new
+                lp = lp_new
+                g = derivatives(u)
+                if t*np.max(np.abs(step)) < 1e-8:
+                    break
+            # Check the positive definiteness at the final point
+            linalg.cho_factor(P, overwrite_a=False)
+            # Marginalise the local parameters out of the precision matrix
+            if n > d:
+                cho_l = linalg.cho_factor(P[d:,d:])
+                Qt = P[:d,:d] - P[:d,d:].dot(linalg.cho_solve(cho_l, P[d:,:d]))
+            else:
+                Qt = P[:d,:d].copy(order='F')
+            m = u[:d].copy()
+            # Covariance matrix
+            invert_normal_params(Qt, out_A=self.Mat)
+            if self.phi_blocks is not None:
+                # Restrict the precision matrix to the diagonal blocks of the
+                # marginal covariance matrix
+                Qt.fill(0)
+                for sl in self.phi_slices:
+                    Qt[sl,sl] = linalg.inv(self.Mat[sl,sl])
+            np.copyto(dQi, Qt)
+            np.dot(Qt, m, out=dri)
+        except linalg.LinAlgError:
+            self.estim_time = timer() - time_start
+            return False
+        # Initialise the next optimisation from the refined mode
+        self.laplace_mode = get_constrained_pars(fit, u)
+        np.copyto(self.vec, m)
+        self.mt = m
+        self.mt_se = np.zeros(d)
+        self.nsamp = 1
+        self.ess = None
+        self.extract_time = 0.0
+        # Calculate the difference into the output arrays
+        np.subtract(dQi, self.Q, out=dQi)
+        np.subtract(dri, self.r, out=dri)
+        self.estim_time = timer() - time_start
+        self.phase = 2
+        return True
+    
+    
+    def _estimate_precision(self, samp, mt, Mat, P, dQi, dri):
+        """Estimate the natural parameters of the tilted distribution.
+        
+        The estimate is calculated from the centered samples `samp` of shape
+        (nsamp,d) in F-order and their mean `mt` into the arrays `dQi` and
+        `dri` using the method given in the option `prec_estim`. `Mat` is a
+        temporary array of shape (d,d) in F-order and `P` is the current
+        global precision matrix used as the prior in the method 'olse'. The
+        samples are overwritten.
+        
+        """
+        d = samp.shape[1]
+        # Basic sample estimate (also for one dimensional blocks, for which
+        # the other methods are not defined)
+        if self.prec_estim == 'sample' or self.prec_estim_skip > 0 or d == 1:
+            # Use QR-decomposition for obtaining Cholesky of the scatter
+            # matrix (only R needed, Q-less algorithm would be nice)
+            _, _, _, info = dgeqrf_routine(samp, overwrite_a=True)
+            if info:
+                raise linalg.LinAlgError(
+                    "dgeqrf LAPACK routine failed with error code {}"
+                    .format(info)
+                )
+            # Copy the relevant part of the array into contiguous memory
+            np.copyto(Mat, samp[:d,:])
+            invert_normal_params(
+                Mat, mt, out_A=dQi, out_b=dri,
+                cho_form=True
+            )
+            # Unbiased (for normal distr.) natural parameter estimates
+            unbias_k = (self.nsamp - d - 2)
+            dQi *= unbias_k
+            dri *= unbias_k
+        
+        # Optimal linear shrinkage estimate
+        elif self.prec_estim == 'olse':
+            # Sample covariance
+            np.dot(samp.T, samp, out=Mat.T)
+            # Normalise Mat into dQi
+            np.divide(Mat, self.nsamp, out=dQi)
+            # Estimate
+            olse(dQi, self.nsamp, P=np.asfortranarray(P), out='in-place')
+            np.dot(dQi, mt, out=dri)
+        
+        # Graphical lasso with cross validation
+        elif self.prec_estim == 'glassocv':
+            # Fit
+            self.glassocv.fit(samp)
+            if self.verbose:
+                print '    glasso alpha: {:.4}'.format(self.glassocv.alpha_)
+            np.copyto(dQi, self.glassocv.precision_.T)
+            # Calculate corresponding r
+            np.dot(dQi, mt, out=dri)
+        
+        else:
+            raise ValueError("Invalid value for option `prec_estim`")
+    
+    
+    def _estimate_lowrank(self, samp, mt, dQi, dri):
+        """Estimate a low rank site approximation from the tilted samples.
+        
+        The centered samples `samp` are whitened with the cavity distribution
+        and the `site_rank` directions whose whitened variance differs the most
+        from one are selected. With a whitened variance lambda, the site
+        precision of the direction is 1/lambda - 1. Only the span of the
+        samples is considered, so that the estimate is defined even with fewer
+        samples than dimensions. The new site precision matrix is stored into
+        the first half of the low rank factors in `dQi` and the second half is
+        set to zero (see util.lowrank_factors). The site parameter update
+        `dri` is calculated as usual.
+        
+        """
+        n = samp.shape[0]
+        d = self.dphi
+        rank = self.site_rank
+        U, w = lowrank_factors(dQi, d)
+        # Samples multiplied with the cavity precision matrix
+        Z = samp.dot(self.Mat)
+        if n - 1 <= d:
+            # Eigendecomposition of the Gram matrix of the whitened samples
+            lam, W = linalg.eigh(Z.dot(samp.T))
+            lam /= n - 1
+            # Drop the null space of the samples
+            keep = lam > lam[-1] * max(n, d) * np.finfo(float).eps
+            lam = lam[keep]
+            # Directions u = Qc y with u.T Sc u = 1
+            V = Z.T.dot(W[:,keep])
+            V /= np.sqrt((n - 1) * lam)
+        else:
+            # Generalised eigendecomposition in the parameter space
+            lam, V = linalg.eigh(Z.T.dot(Z), self.Mat)
+            lam /= n - 1
+            V = self.Mat.dot(V)
+        prec = 1.0/lam - 1.0
+        ind = np.argsort(-np.abs(prec), kind='mergesort')[:rank]
+        dQi.fill(0)
+        lowrank_compress(V[:,ind], prec[ind], rank,
+                         out_U=U[:,:rank], out_w=w[:rank])
+        # Natural mean parameter of the tilted distribution minus the global
+        np.dot(self.Mat, mt, out=dri)
+        dri += U[:,:rank].dot(w[:rank] * U[:,:rank].T.dot(mt))
+        dri -= self.r
+
+
+class _WorkerList(object):
+    """The workers of the sites, each created when first accessed.
+    
+    Parameters
+    ----------
+    K : int
+        The number of sites.
+    
+    create : function
+        Returns a new worker for the given site index.
+    
+    """
+    
+    def __init__(self, K, create):
+        self.create = create
+        self.items = [None] * K
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __getitem__(self, k):
+        worker = self.items[k]
+        if worker is None:
+            worker = self.create(k)
+            self.items[k] = worker
+        return worker
+    
+    def __iter__(self):
+        for k in xrange(len(self.items)):
+            yield self[k]
+    
+    def created(self, k):
+        """Check if the worker of site k has been created."""
+        return self.items[k] is not None
+    
+    def discard(self, k):
+        """Discard the worker of site k, recreated when accessed next time."""
+        self.items[k] = None
+
+
+class Master(object):
+    """Manages the distributed EP algorithm.
+    
+    Parameters
+    ----------
+    site_model : StanModel or string
+        Model for sampling from the tilted distribution of a site. Can be
+        provided either directly as a PyStan model instance or as filename
+        string pointing to a pickled model or stan source code. The model has a
+        restricted structure (see Notes).
+    
+    X : ndarray
+        Explanatory variable data in an ndarray of shape (N,D), where N is the
+        number of observations and D is the number of variables. `X` should be
+        C-contiguous (copy made if not). N.B. One dimensional array of shape
+        (N,) is also acceptable, in which case D is not provided to the stan
+        model. Can be None with backend 'socket', in which case the data is
+        held only by the site servers and `site_sizes` has to be given.
+    
+    y : ndarray
+        Response variable data in an ndarray of shape (N,), where N is the
+        number of observations (same N as for X). None if `X` is None.
+    
+    A : dict, optional
+        Additional data for the site model. The keys in the dict are the names
+        of the variables and the values are the coresponding objects e.g.
+        integers or ndarrays. These arrays are distributed as a whole for each
+        site. Example: {'var':[3,2]} distributes var=[3,2] to each site.
+    
+    A_k : dict, optional
+        Additional data for the site model. The keys in the dict are the names
+        of the variables and the values are array-likes of length K, where K is
+        the number of sites. The first element of the array-likes are
+        distributed to the first site etc. Example: {'var':[3,2]} distributes
+        var=3 to the first site and var=2 to the second site.
+    
+    A_n : dict, optional
+        Additional sliced data arrays provided for the site model. The keys in
         the dict are the names of the variables and the values are the
         coresponding ndarrays of size (N, ...). These arrays are sliced for each
         site (similary as `X` and `y`).
@@ -459,7 +1443,111 @@ class Master(object):
     ----------------
     seed : {None, int, RandomState}, optional
         The random seed used in the sampling. If not provided, a random seed is
-        used.
+        used. Each site is given an independent random number generator seeded
+        from this, so that the results do not depend on the backend.
+    
+    backend : {'serial', 'processes', 'socket'}, optional
+        How the tilted distributions of the sites are processed:
+            'serial'    : one site after another in this process (default)
+            'processes' : in parallel in a pool of `n_jobs` forked processes
+                          (see pool.SitePool)
+            'socket'    : in parallel by the site servers at `servers`, each
+                          holding the data of some of the sites (see module
+                          server and pool.SocketPool)
+    
+    servers : list, optional
+        The addresses of the site servers with backend 'socket', given as
+        tuples (host, port) or paths of Unix sockets (see
+        server.parse_address). Every site has to be held by a server.
+    
+    authkey : str, optional
+        The authentication key of the site servers. Required for servers with
+        TCP addresses (see module server). Default is None.
+    
+    n_jobs : int, optional
+        The number of processes used with backend 'processes'. By default the
+        number of CPUs is used. Never more than the number of sites.
+    
+    keep_pool : bool, optional
+        If True, the processes of backend 'processes' are started on the first
+        run and kept alive over the following runs, so that the workers, their
+        data and the compiled model are loaded into them only once. The
+        processes are terminated with method close. Default is False.
+    
+    tilted_timeout : float, optional
+        The maximum time in seconds for processing the tilted distribution of
+        a site. Sites exceeding it are cancelled and treated as failed in the
+        iteration, i.e. they are not updated and their sampler initialisation
+        is reset. Requires backend 'processes'. Default is None (no limit).
+    
+    tilted_timeout_mult : float, optional
+        The maximum time for processing the tilted distribution of a site as a
+        multiple of the median sampling time of the sites finished in the
+        iteration. Takes effect after half of the sites have finished. Sites
+        exceeding it are handled as with `tilted_timeout`. Requires backend
+        'processes'. Default is None (no limit).
+    
+    target_rel_error : float, optional
+        If given, the number of samples of each site is adapted so that the
+        Monte Carlo standard error of the tilted distribution mean relative to
+        the tilted distribution standard deviation, i.e. 1/sqrt(ESS), is this
+        value. The required number of samples is estimated from the effective
+        sample sizes (ESS) of the previous iteration of the site. The number of
+        warmup iterations is kept fixed. Default is None (no adaptation).
+    
+    sample_budget : int, optional
+        The maximum total number of samples from all the sites in one iteration
+        when `target_rel_error` is given. If the sites require more, their
+        numbers of samples are scaled down proportionally. Default is None (no
+        limit).
+    
+    min_draws : int, optional
+        The minimum number of samples of a site when `target_rel_error` is
+        given. Default is 100.
+    
+    site_selection : {None, 'random', 'roundrobin', 'change'}, optional
+        If given, only `n_sites` sites are updated in each iteration. Only the
+        cavity distributions of the selected sites and the sites changed in the
+        previous iteration are formed and checked. The sites are selected:
+            'random'     : uniformly at random
+            'roundrobin' : in turns
+            'change'     : by the largest expected change, i.e. the magnitude
+                           of the latest update of the site times the number
+                           of iterations since it
+        Default is None, i.e. all the sites are updated.
+    
+    n_sites : int, optional
+        The number of sites updated in each iteration with `site_selection`.
+    
+    site_methods : sequence of str, optional
+        The method for the tilted distribution of each site, see
+        `tilted_method`. Overrides `tilted_method` and `laplace_min_size`.
+    
+    laplace_min_size : int, optional
+        If given, the tilted distributions of the sites with at least this
+        many observations are approximated with the Laplace approximation and
+        the others with `tilted_method`.
+    
+    n_threads : int, optional
+        The number of threads used in the per-site operations of the master,
+        i.e. summing and updating the site parameters and forming the cavity
+        distributions. Default is 1.
+    
+    cavity_chunk : int, optional
+        The maximum number of sites whose cavity precision matrices are formed
+        and factorised at once by each thread in the positive definiteness
+        checks (see method cavities). Bounds the scratch memory of the master
+        to O(n_threads * cavity_chunk * dphi^2) instead of O(K * dphi^2).
+        Default is 64.
+    
+    agg_fanin : int, optional
+        If given, the sums of the site parameters and their updates over the
+        sites are maintained in aggregation trees (see aggregate.SumTree),
+        whose nodes hold the partial sums of at most `agg_fanin` children.
+        After each step, only the nodes above the changed sites are
+        recalculated and the root sums only its children. The sums are then
+        exact instead of being updated incrementally. Default is None, i.e.
+        the sums are calculated directly.
     
     init_site : scalar or ndarray, optional
         The initial site precision matrix. If not provided, improper uniform
@@ -489,6 +1577,83 @@ class Master(object):
         used as the starting point for the next iteration sampling. Default is
         True.
     
+    adapt_prev : bool, optional
+        Indicates if the adapted step size and inverse metric of the site mcmc
+        sampling are used as the starting point of the adaptation in the next
+        iteration, which allows a shorter warmup. The adaptation is reset if
+        the tilted distribution of the site fails. Requires PyStan 2.18 or
+        later. Default is False.
+    
+    warmup_full : int, optional
+        If `adapt_prev` is True, the number of first iterations of each site
+        using the full warmup. Default is 1.
+    
+    warmup_decay : float, optional
+        If `adapt_prev` is True, the warmup is multiplied by this factor on
+        every iteration after the first `warmup_full` ones, keeping the number
+        of samples after the warmup unchanged. Default is 0.5.
+    
+    warmup_min : int, optional
+        The minimum warmup with `adapt_prev`. Default is 50.
+    
+    metric_init : {None, 'diag', 'dense'}, optional
+        If given, the inverse metric of the site mcmc sampling is initialised
+        on each iteration with a diagonal or dense metric whose block of phi
+        is formed from the cavity distribution, and whose block of the other
+        parameters is taken from the adaptation of the previous iteration. The
+        warmup is then shortened as with `adapt_prev`, which controls if the
+        step size is carried over as well. Requires that phi is the first
+        parameter in the site model and PyStan 2.18 or later. Default is None,
+        i.e. the metric is initialised by Stan.
+    
+    metric_shrink : float, optional
+        The weight of the previous tilted distribution covariance in the block
+        of phi in the initial inverse metric of `metric_init`. The rest is the
+        cavity covariance. Default is 0.5.
+    
+    reuse : {None, 'psis'}, optional
+        If 'psis', the latest samples of each site are reused in the following
+        iterations with Pareto smoothed importance weights between the current
+        cavity distribution and the cavity distribution the samples were drawn
+        with, as long as the weights are reliable. Otherwise new samples are
+        drawn. Default is None, i.e. new samples are drawn on every iteration.
+    
+    reuse_k_max : float, optional
+        The maximum Pareto shape estimate of the weights for reusing the
+        samples. Default is 0.7.
+    
+    reuse_min_ess : float, optional
+        The minimum effective sample size of the weights relative to the number
+        of the samples for reusing the samples. Default is 0.5.
+    
+    tilted_method : {'sample', 'laplace', 'advi'}, optional
+        Method for estimating the tilted distributions:
+            'sample'  : mcmc sampling with Stan (default)
+            'laplace' : Laplace approximation at the mode found with
+                        StanModel.optimizing, with the local parameters
+                        marginalised out. Requires that phi is the first
+                        parameter in the site model.
+            'advi'    : variational approximation fitted with StanModel.vb,
+                        the precision estimated from its draws as with
+                        'sample'
+        See also `site_methods` and `laplace_min_size`.
+    
+    laplace_iter : int, optional
+        The maximum number of Newton steps refining the mode of the Laplace
+        approximation in the unconstrained space. Default is 20.
+    
+    advi_algorithm : {'meanfield', 'fullrank'}, optional
+        The variational family with `tilted_method` 'advi'. Default is
+        'meanfield'.
+    
+    advi_iter : int, optional
+        The maximum number of iterations of the variational optimisation.
+        Default is 10000.
+    
+    advi_draws : int, optional
+        The number of draws from the variational approximation. Default is
+        1000.
+    
     init : {'random', '0', 0, function returning dict, list of dict}, optional
         Specifies how the initialisation is performed for the sampler (see 
         StanModel.sampling). If `init_prev` is True, this parameter affects only
@@ -507,6 +1672,33 @@ class Master(object):
         the tilted distribution precision matrix is estimated using the default
         sample estimate instead of anything else.
     
+    phi_blocks : sequence of int, optional
+        If given, the site approximations are restricted to be block diagonal
+        with consecutive diagonal blocks of the given sizes, summing up to
+        `dphi`. Only the diagonal blocks of the site and global precision
+        matrices are stored and factorised, and the tilted distribution
+        precision of each block is estimated from its marginal samples. The
+        prior precision matrix has to be block diagonal accordingly. Default is
+        None, i.e. full matrices.
+    
+    site_form : {'full', 'lowrank'}, optional
+        The form of the site precision matrices. In 'lowrank', each site
+        precision matrix is a symmetric matrix of rank `site_rank`, estimated
+        from the directions in which the tilted distribution differs the most
+        from the cavity distribution (see Worker._estimate_lowrank). Only the
+        factors of the site approximations are stored, the damped updates are
+        compressed back into the rank before the positive definiteness checks,
+        and the cavity distributions are checked via small capacitance
+        matrices. The full cavity precision matrix of a site is formed in
+        scratch only right before processing its tilted distribution. Can not
+        be used with `phi_blocks`, `init_site`, `damping` 'exact',
+        `prec_estim` other than 'sample' or the method run_async. Default is
+        'full'.
+    
+    site_rank : int, optional
+        The rank of the site precision matrices with `site_form` 'lowrank'.
+        Default is 10 (or `dphi` if smaller).
+    
     df0 : float or function, optional
         The initial damping factor for each iteration. Must be a number in the
         range (0,1]. If a number is given, a constant initial damping factor for
@@ -532,10 +1724,33 @@ class Master(object):
         The treshold value for the damping factor. If the damping factor decays
         below this value, the algorithm is stopped. Default is 1e-6.
     
+    damping : {'decay', 'exact'}, optional
+        The method for finding a damping factor resulting in positive definite
+        posterior and cavity distributions. In 'decay', the damping factor is
+        decayed by `df_decay` until the distributions are positive definite. In
+        'exact', the largest feasible damping factor is first solved from
+        generalised eigenvalue problems (see Master.max_damping) and multiplied
+        with `df_margin`, after which the decay is used only as a fallback.
+        Default is 'decay'.
+    
+    df_margin : float, optional
+        The safety margin multiplier in (0,1) for the largest feasible damping
+        factor when `damping` is 'exact'. Default is 0.9.
+    
     Notes
     -----
     TODO: Describe the structure of the site model.
     
+    The site precision matrices, their updates and their sums are stored as
+    packed upper triangulars (see util.pack_triu), e.g. the instance variable
+    `Qi` has shape (dphi+1 choose 2, K). Full matrices are formed only for the
+    global approximation and the cavity distributions. With `phi_blocks`, only
+    the upper triangulars of the diagonal blocks are stored and the full
+    matrices are zero outside the blocks. With `site_form` 'lowrank', the site
+    precision matrices and their updates are stored as low rank factors (see
+    util.lowrank_factors) of rank `site_rank` and 2*`site_rank` respectively,
+    while their sums are stored packed as above.
+    
     """
     
     # Return codes for method run
@@ -562,9 +1777,43 @@ class Master(object):
         'df0_iter'          : 20,
         'df_decay'          : 0.8,
         'df_treshold'       : 1e-6,
-        'overwrite_model'   : False
+        'damping'           : 'decay',
+        'df_margin'         : 0.9,
+        'overwrite_model'   : False,
+        'backend'           : 'serial',
+        'servers'           : None,
+        'authkey'           : None,
+        'n_jobs'            : None,
+        'keep_pool'         : False,
+        'tilted_timeout'    : None,
+        'tilted_timeout_mult' : None,
+        'n_threads'         : 1,
+        'cavity_chunk'      : 64,
+        'agg_fanin'         : None,
+        'target_rel_error'  : None,
+        'sample_budget'     : None,
+        'min_draws'         : 100,
+        'site_selection'    : None,
+        'n_sites'           : None,
+        'site_methods'      : None,
+        'laplace_min_size'  : None
     }
     
+    # Available values for keyword argument `backend`
+    BACKEND_OPTIONS = ('serial', 'processes', 'socket')
+    
+    # Available values for keyword argument `damping`
+    DAMPING_OPTIONS = ('decay', 'exact')
+    
+    # Available values for keyword argument `site_selection`
+    SITE_SELECTION_OPTIONS = ('random', 'roundrobin', 'change')
+    
+    # Site arrays stored in the checkpoint files
+    CHECKPOINT_ARRAYS = ('Qi', 'ri', 'dQi', 'dri')
+    
+    # Site arrays whose sums over the sites are cached
+    SUM_ARRAYS = ('Qi', 'ri', 'dQi', 'dri')
+    
     def __init__(self, site_model, X, y, **kwargs):
         
         # Parse keyword arguments
@@ -589,21 +1838,31 @@ class Master(object):
             if not self.worker_options.has_key(kw):
                 self.worker_options[kw] = default
         
-        # Validate X
-        self.N = X.shape[0]
-        if len(X.shape) == 2:
-            self.D = X.shape[1]
-        elif len(X.shape) == 1:
+        if X is None:
+            # The data is held only by the site servers
+            if kwargs['backend'] != 'socket' or kwargs['site_sizes'] is None:
+                raise ValueError("Args. `X` and `y` can be omitted only with "
+                                 "backend 'socket' and arg. `site_sizes`")
+            if y is not None:
+                raise ValueError("Arg. `y` should be None if `X` is None")
+            self.N = np.sum(kwargs['site_sizes'])
             self.D = None
         else:
-            raise ValueError("Argument `X` should be one or two dimensional")
+            # Validate X
+            self.N = X.shape[0]
+            if len(X.shape) == 2:
+                self.D = X.shape[1]
+            elif len(X.shape) == 1:
+                self.D = None
+            else:
+                raise ValueError("Argument `X` should be one or two "
+                                 "dimensional")
+            # Validate y
+            if len(y.shape) != 1:
+                raise ValueError("Argument `y` should be one dimensional")
+            if y.shape[0] != self.N:
+                raise ValueError("The shapes of `y` and `X` does not match")
         self.X = X
-        
-        # Validate y
-        if len(y.shape) != 1:
-            raise ValueError("Argument `y` should be one dimensional")
-        if y.shape[0] != self.N:
-            raise ValueError("The shapes of `y` and `X` does not match")
         self.y = y
         
         # Process site indices
@@ -648,8 +1907,9 @@ class Master(object):
                              "two sites.")
         
         # Ensure that X and y are C contiguous
-        self.X = np.ascontiguousarray(self.X)
-        self.y = np.ascontiguousarray(self.y)
+        if self.X is not None:
+            self.X = np.ascontiguousarray(self.X)
+            self.y = np.ascontiguousarray(self.y)
         
         # Process A
         self.A = kwargs['A']
@@ -714,6 +1974,28 @@ class Master(object):
             if self.Q0.shape[0] != self.dphi or self.r0.shape[0] != self.dphi:
                 raise ValueError("Arg. `dphi` does not match with `prior`")
         
+        # Form of the site approximations
+        self.site_form = self.worker_options['site_form']
+        self.site_rank = min(self.worker_options['site_rank'], self.dphi)
+        if self.site_form == 'lowrank':
+            if kwargs['init_site'] is not None or kwargs['damping'] == 'exact':
+                raise ValueError("Low rank site approximations can not be "
+                                 "used with `init_site` or exact damping")
+        
+        # Block diagonal structure
+        self.phi_blocks = self.worker_options['phi_blocks']
+        if self.phi_blocks is not None:
+            self.phi_blocks = tuple(int(b) for b in self.phi_blocks)
+            self.worker_options['phi_blocks'] = self.phi_blocks
+        self.phi_slices = block_slices(self.dphi, self.phi_blocks)
+        if self.phi_blocks is not None:
+            Q0_blocks = unpack_triu(
+                pack_triu(self.Q0, blocks=self.phi_blocks),
+                np.zeros((self.dphi,self.dphi)), self.phi_blocks)
+            if not np.array_equal(Q0_blocks, self.Q0):
+                raise ValueError("The prior precision matrix is not block "
+                                 "diagonal with arg. `phi_blocks`")
+        
         # Damping factor
         self.df_decay = kwargs['df_decay']
         self.df_treshold = kwargs['df_treshold']
@@ -745,6 +2027,12 @@ class Master(object):
         else:
             # Use provided initial damping factor function
             self.df0 = kwargs['df0']
+        self.damping = kwargs['damping']
+        if not self.damping in self.DAMPING_OPTIONS:
+            raise ValueError("Invalid value for arg. `damping`")
+        self.df_margin = kwargs['df_margin']
+        if self.df_margin <= 0 or self.df_margin >= 1:
+            raise ValueError("Arg. `df_margin` has to be in (0,1)")
         
         # Get Stan model
         if isinstance(site_model, basestring):
@@ -754,30 +2042,105 @@ class Master(object):
         else:
             self.site_model = site_model
         
+        # Backend for processing the tilted distributions
+        self.backend = kwargs['backend']
+        if not self.backend in self.BACKEND_OPTIONS:
+            raise ValueError("Invalid value for arg. `backend`")
+        self.n_jobs = kwargs['n_jobs']
+        if self.n_jobs is None:
+            self.n_jobs = multiprocessing.cpu_count()
+        elif self.n_jobs < 1:
+            raise ValueError("Arg. `n_jobs` should be positive")
+        self.n_jobs = min(self.n_jobs, self.K)
+        self.keep_pool = kwargs['keep_pool']
+        # The pool kept alive over the runs
+        self.site_pool = None
+        self.tilted_timeout = kwargs['tilted_timeout']
+        self.tilted_timeout_mult = kwargs['tilted_timeout_mult']
+        if ((self.tilted_timeout is not None
+                or self.tilted_timeout_mult is not None)
+                and self.backend != 'processes'):
+            raise ValueError("Tilted distribution timeouts require backend "
+                             "'processes'")
+        self.servers = kwargs['servers']
+        self.authkey = kwargs['authkey']
+        if self.backend == 'socket' and not self.servers:
+            raise ValueError("Backend 'socket' requires arg. `servers`")
+        
+        # Adaptive number of samples
+        self.target_rel_error = kwargs['target_rel_error']
+        self.sample_budget = kwargs['sample_budget']
+        self.min_draws = kwargs['min_draws']
+        if self.target_rel_error is not None and self.target_rel_error <= 0:
+            raise ValueError("Arg. `target_rel_error` should be positive")
+        # The number of samples required by each site, zero if not yet
+        # estimated, and the adapted numbers of samples, None if not adapted
+        # (see method adapt_draws)
+        self.draws_req = np.zeros(self.K)
+        self.draws = None
+        
+        # Hybrid tilted distribution methods
+        self.laplace_min_size = kwargs['laplace_min_size']
+        self.site_methods = kwargs['site_methods']
+        if self.site_methods is not None:
+            self.site_methods = list(self.site_methods)
+            if len(self.site_methods) != self.K:
+                raise ValueError("Arg. `site_methods` should have K elements")
+            for method in self.site_methods:
+                if not method in Worker.TILTED_METHOD_OPTIONS:
+                    raise ValueError("Invalid value in arg. `site_methods`")
+        
+        # Partial iterations
+        self.site_selection = kwargs['site_selection']
+        self.n_sites = kwargs['n_sites']
+        if self.site_selection is not None:
+            if not self.site_selection in self.SITE_SELECTION_OPTIONS:
+                raise ValueError("Invalid value for arg. `site_selection`")
+            if self.n_sites is None or not 1 <= self.n_sites <= self.K:
+                raise ValueError("Arg. `n_sites` should be in [1,K]")
+        # The sites processed in the latest tilted distribution phase, None
+        # indicating all
+        self.sites_prev = None
+        # Round-robin position
+        self.site_pos = 0
+        # The magnitude of the latest update of each site and the number of
+        # iterations since it
+        self.site_change = np.empty(self.K)
+        self.site_change.fill(np.inf)
+        self.site_age = np.ones(self.K, dtype=int)
+        
+        # Threads for the per-site operations in the master
+        self.n_threads = min(kwargs['n_threads'], self.K)
+        if self.n_threads < 1:
+            raise ValueError("Arg. `n_threads` should be positive")
+        # Split the sites into contiguous chunks processed by each thread
+        lims = np.linspace(0, self.K, self.n_threads+1).astype(int)
+        self.site_chunks = [slice(lims[i], lims[i+1])
+                            for i in xrange(self.n_threads)]
+        # The thread pool exists only while running
+        self.thread_pool = None
+        self.cavity_chunk = kwargs['cavity_chunk']
+        if self.cavity_chunk < 1:
+            raise ValueError("Arg. `cavity_chunk` should be positive")
+        
         # Process seed in worker options
         if not isinstance(self.worker_options['seed'], np.random.RandomState):
             self.worker_options['seed'] = \
                 np.random.RandomState(seed=self.worker_options['seed'])
+        # Independent random number generator for each site
+        self.site_seeds = \
+            self.worker_options['seed'].randint(2**31-1, size=self.K)
+        # Random number generator for the site selection
+        self.rand_state = np.random.RandomState(
+            self.worker_options['seed'].randint(2**31-1))
         
-        # Initialise the workers
-        self.workers = []
-        for k in xrange(self.K):
-            A = dict((key, val[self.k_lim[k]:self.k_lim[k+1]])
-                     for (key, val) in self.A_n.iteritems())
-            A.update(self.A)
-            for (key, val) in self.A_k.iteritems():
-                A[key] = val[k]
-            self.workers.append(
-                Worker(
-                    k,
-                    self.site_model,
-                    self.dphi,
-                    X[self.k_lim[k]:self.k_lim[k+1]],
-                    y[self.k_lim[k]:self.k_lim[k+1]],
-                    A=A,
-                    **self.worker_options
-                )
-            )
+        # The workers are created when first needed (see method
+        # _create_worker). The workers in the same process share their scratch
+        # arrays, from which they also take their cavity distributions only
+        # while being processed (see Worker.cavity).
+        self.workspaces = WorkspacePool(self.dphi, self.phi_blocks,
+                                        size=self.n_threads)
+        self.workers = _WorkerList(self.K, self._create_worker)
         
         # Allocate space for calculations
         # Mean and cov of the approximation
@@ -786,37 +2149,670 @@ class Master(object):
         # Natural parameters of the approximation
         self.Q = self.Q0.copy(order='F')
         self.r = self.r0.copy()
-        # Natural site parameters
-        self.Qi = np.zeros((self.dphi,self.dphi,self.K), order='F')
+        # Packed upper triangular indexes and the prior precision
+        self.triu = packed_triu_indices(self.dphi, self.phi_blocks)
+        self.dphi2 = len(self.triu[0])
+        self.Q0_packed = pack_triu(self.Q0, blocks=self.phi_blocks)
+        # Lengths of the site precision matrices and their updates
+        if self.site_form == 'lowrank':
+            len_Qi = (self.dphi+1) * self.site_rank
+            len_dQi = 2 * len_Qi
+        else:
+            len_Qi = self.dphi2
+            len_dQi = self.dphi2
+        # Natural site parameters (precision matrices packed)
+        self.Qi = np.zeros((len_Qi,self.K), order='F')
         self.ri = np.zeros((self.dphi,self.K), order='F')
-        # Natural site proposal parameters
-        self.Qi2 = np.zeros((self.dphi,self.dphi,self.K), order='F')
-        self.ri2 = np.zeros((self.dphi,self.K), order='F')
-        # Site parameter updates
-        self.dQi = np.zeros((self.dphi,self.dphi,self.K), order='F')
-        self.dri = np.zeros((self.dphi,self.K), order='F')
+        # Means of the cavity distributions (see method cavities)
+        self.mc = np.zeros((self.dphi,self.K), order='F')
+        # Sums of the site parameters and their updates over the sites
+        self.Qi_sum = np.zeros(self.dphi2)
+        self.ri_sum = np.zeros(self.dphi)
+        self.dQi_sum = np.zeros(self.dphi2)
+        self.dri_sum = np.zeros(self.dphi)
+        # Site parameter updates (precision matrices packed)
+        if self.backend == 'processes':
+            # Written directly by the processes in the pool
+            self.dQi = shared_zeros((len_dQi,self.K), order='F')
+            self.dri = shared_zeros((self.dphi,self.K), order='F')
+        else:
+            self.dQi = np.zeros((len_dQi,self.K), order='F')
+            self.dri = np.zeros((self.dphi,self.K), order='F')
+        
+        # Aggregation trees of the sums of the site parameters
+        self.agg_fanin = kwargs['agg_fanin']
+        if self.agg_fanin is None:
+            self.agg_trees = None
+        else:
+            self.agg_trees = {}
+            for name in self.SUM_ARRAYS:
+                A = getattr(self, name)
+                lowrank = self.site_form == 'lowrank' and name.endswith('Qi')
+                self.agg_trees[name] = SumTree(
+                    getattr(self, name + '_sum').shape[0], self.K,
+                    self.agg_fanin, self._site_part_sum(A, lowrank))
         
         if not kwargs['init_site'] is None:
             # Config initial site distributions
             if isinstance(kwargs['init_site'], np.ndarray):
-                for k in xrange(self.K):
-                    np.copyto(self.Qi[:,:,k], kwargs['init_site'])
+                self.Qi[:] = pack_triu(kwargs['init_site'],
+                                       blocks=self.phi_blocks)[:,np.newaxis]
             else:
                 diag_elem = self.K / (kwargs['init_site']**2)
-                for k in xrange(self.K):
-                    self.Qi[:,:,k].flat[::self.dphi+1] = diag_elem
+                self.Qi[self.triu[0] == self.triu[1]] = diag_elem
         
         # Track iterations
         self.iter = 0
     
     
-    def run(self, niter, calc_moments=True, save_last_fits=True, verbose=True):
+    def _site_options(self, k):
+        """The worker options specific to site k."""
+        options = {}
+        if self.site_methods is not None:
+            options['tilted_method'] = self.site_methods[k]
+        elif (    self.laplace_min_size is not None
+              and self.Nk[k] >= self.laplace_min_size):
+            options['tilted_method'] = 'laplace'
+        return options
+    
+    
+    def _create_worker(self, k):
+        """Create the worker of site k."""
+        A = dict((key, val[self.k_lim[k]:self.k_lim[k+1]])
+                 for (key, val) in self.A_n.iteritems())
+        A.update(self.A)
+        for (key, val) in self.A_k.iteritems():
+            A[key] = val[k]
+        options = self.worker_options.copy()
+        options.update(self._site_options(k))
+        options['seed'] = np.random.RandomState(seed=self.site_seeds[k])
+        if self.X is None:
+            # Only the state of the site is kept in this process
+            X_k = y_k = None
+        else:
+            X_k = self.X[self.k_lim[k]:self.k_lim[k+1]]
+            y_k = self.y[self.k_lim[k]:self.k_lim[k+1]]
+        worker = Worker(
+            k,
+            self.site_model,
+            self.dphi,
+            X_k,
+            y_k,
+            A=A,
+            workspaces=self.workspaces,
+            **options
+        )
+        if self.draws is not None:
+            # Adapted number of samples (see method adapt_draws)
+            worker.set_draws(self.draws[k])
+        return worker
+    
+    
+    def cavities(self, Q, Qi, dQi=None, df=1.0, out_pos_def=None, sites=None,
+                 r=None, ri=None, dri=None, out_m=None):
+        """Check the positive definiteness of the cavity distributions.
+        
+        The cavity precision matrices are formed and factorised in chunks of
+        at most `cavity_chunk` sites, with one stacked Cholesky factorisation
+        (see util.cho_factor_stacked) for each diagonal block, in the scratch
+        stack of a workspace borrowed by each thread (see Workspace.stacks).
+        The memory thus scales with `n_threads` instead of K. If `out_m` is
+        given, the cavity means are also solved with the same factorisations
+        (see util.cho_solve_stacked), so that the workers do not need to
+        factorise their cavity distributions again when they are formed for
+        the tilted distributions (see Worker.cavity).
+        
+        Parameters
+        ----------
+        Q : ndarray
+            The precision matrix of the global approximation.
+        
+        Qi : ndarray
+            The site precision matrices of all the sites, of shape (dphi2,K)
+            (packed, see util.pack_triu, or low rank factors, see method
+            _cavities_lowrank).
+        
+        dQi, df : ndarray, float, optional
+            If provided, the cavity distributions are checked using the
+            proposed site precision matrices Qi + df*dQi instead. Not
+            supported with the low rank site approximations, whose proposals
+            are compressed into `Qi` beforehand (see _compress_lowrank).
+        
+        out_pos_def : ndarray, optional
+            Output boolean array of length K.
+        
+        sites : ndarray, optional
+            Sorted indexes of the sites whose cavity distributions are checked.
+            The other sites are indicated positive definite in the output. By
+            default all the sites are considered.
+        
+        r, ri : ndarray, optional
+            The shift vector of the global approximation and the site shift
+            vectors of all the sites, of shape (dphi,K). Required with
+            `out_m`.
+        
+        dri : ndarray, optional
+            If provided, the cavity means are solved using the proposed site
+            shift vectors ri + df*dri instead.
+        
+        out_m : ndarray, optional
+            Output array of shape (dphi,K) for the cavity means of the checked
+            sites. The means of the sites whose cavity distributions are not
+            positive definite are not meaningful.
+        
+        Returns
+        -------
+        pos_def : ndarray
+            Boolean array indicating for each site if the cavity distribution
+            covariance matrix is positive definite.
+        
+        """
+        Q_packed = pack_triu(Q, blocks=self.phi_blocks)
+        def check(sl):
+            # Check the cavities of one chunk of sites in the scratch stack of
+            # a borrowed workspace
+            pos_def = []
+            with self.workspaces.borrow() as ws:
+                for sub in self._subchunks(sl):
+                    Qc, _ = ws.stacks(len(Qi[0,sub]))
+                    if dQi is None:
+                        Qc_packed = Q_packed[:,np.newaxis] - Qi[:,sub]
+                    else:
+                        Qc_packed = dQi[:,sub] * -df
+                        Qc_packed -= Qi[:,sub]
+                        Qc_packed += Q_packed[:,np.newaxis]
+                    unpack_triu(Qc_packed, Qc, self.phi_blocks)
+                    # The transpose is a C-contiguous stack of shape
+                    # (n,dphi,dphi), factorised in place
+                    pos_def_sub = np.ones(Qc.shape[2], dtype=bool)
+                    if out_m is not None:
+                        # Cavity shift vectors, solved in place into means
+                        if dri is None:
+                            mc = r - ri[:,sub].T
+                        else:
+                            mc = dri[:,sub].T * -df
+                            mc -= ri[:,sub].T
+                            mc += r
+                    for b in self.phi_slices:
+                        Qc_b = Qc.T[:,b,b]
+                        pos_def_sub &= cho_factor_stacked(Qc_b, out=Qc_b)[1]
+                        if out_m is not None:
+                            # The failed factorisations have unit pivots,
+                            # their solutions are harmless
+                            cho_solve_stacked(Qc_b, mc[:,b], out='in-place')
+                    if out_m is not None:
+                        out_m[:,sub] = mc.T
+                    pos_def.append(pos_def_sub)
+            return np.concatenate(pos_def)
+        if self.site_form == 'lowrank':
+            if dQi is not None:
+                raise ValueError("The low rank proposals should be compressed "
+                                 "before checking them")
+            pos_def_sites = self._cavities_lowrank(Q, Qi, sites, df=df, r=r,
+                                                   ri=ri, dri=dri, out_m=out_m)
+        else:
+            pos_def_sites = np.concatenate(self._map_chunks(check, sites))
+        if sites is None:
+            pos_def = pos_def_sites
+        else:
+            pos_def = np.ones(self.K, dtype=bool)
+            pos_def[sites] = pos_def_sites
+        if out_pos_def is not None:
+            out_pos_def[:] = pos_def
+            pos_def = out_pos_def
+        return pos_def
+    
+    
+    def _cavities_lowrank(self, Q, Qi, sites, df=1.0, r=None, ri=None,
+                          dri=None, out_m=None):
+        """Check the cavity distributions with low rank site approximations.
+        
+        See method cavities. With the site precision matrix U diag(w) U.T of a
+        site and the Cholesky factorisation Q = L L.T, the cavity precision
+        matrix is positive definite if and only if the eigenvalues of the
+        small capacitance matrix are less than one (see
+        util.lowrank_capacitance). The cavity means are solved with the
+        Woodbury form of the cavity covariance matrix given by the same
+        decomposition. Only the global precision matrix is factorised and each
+        cavity costs O(dphi^2 m) time and O(dphi m) memory for m factors.
+        
+        Returns
+        -------
+        pos_def : ndarray
+            Boolean array indicating the positive definiteness of the cavity
+            distribution of each considered site.
+        
+        """
+        d = self.dphi
+        L = linalg.cholesky(Q, lower=True)
+        def check(sl):
+            # Check the cavities of one chunk of sites
+            U, w = lowrank_factors(Qi[:,sl], d)
+            pos_def = np.empty(U.shape[2], dtype=bool)
+            for (i, k) in enumerate(np.arange(self.K)[sl]):
+                mu, B = lowrank_capacitance(L, U[:,:,i], w[:,i])
+                pos_def[i] = mu[-1] < 1
+                if out_m is not None and pos_def[i]:
+                    # inv(L).T (I + B diag(mu/(1-mu)) B.T) inv(L) (r - ri_k)
+                    v = r - ri[:,k]
+                    if dri is not None:
+                        v -= df * dri[:,k]
+                    v = linalg.solve_triangular(L, v, lower=True)
+                    v += B.dot(mu / (1 - mu) * B.T.dot(v))
+                    out_m[:,k] = linalg.solve_triangular(L, v, lower=True,
+                                                         trans='T')
+            return pos_def
+        return np.concatenate(self._map_chunks(check, sites))
+    
+    
+    def _compress_lowrank(self, df, out, sites=None):
+        """Form the damped low rank site precision matrices into `out`.
+        
+        The sum Qi + df*dQi of each site in `sites` (None indicating all) is
+        compressed into rank `site_rank` (see util.lowrank_compress). The other
+        sites in `out` are not modified. The compressed matrices are the ones
+        checked and accepted in the method run, so that the truncation can
+        not break the positive definiteness of the accepted cavities.
+        
+        """
+        d = self.dphi
+        def compress(sl):
+            for k in np.arange(self.K)[sl]:
+                U, w = lowrank_factors(self.Qi[:,k], d)
+                dU, dw = lowrank_factors(self.dQi[:,k], d)
+                U_out, w_out = lowrank_factors(out[:,k], d)
+                lowrank_compress(
+                    np.concatenate((U, dU), axis=1),
+                    np.concatenate((w, df*dw)),
+                    self.site_rank,
+                    out_U = U_out,
+                    out_w = w_out
+                )
+        self._map_chunks(compress, sites)
+        return out
+    
+    
+    def _complete_lowrank(self, sites):
+        """Complete the low rank site updates estimated by the workers.
+        
+        The workers estimate only the new site precision matrices (see
+        Worker.tilted). The current ones are subtracted by placing them into
+        the second half of the factors of the updates.
+        
+        """
+        d = self.dphi
+        for k in sites:
+            U, w = lowrank_factors(self.Qi[:,k], d)
+            dU, dw = lowrank_factors(self.dQi[:,k], d)
+            dU[:,self.site_rank:] = U
+            np.negative(w, out=dw[self.site_rank:])
+    
+    
+    def max_damping(self, sites=None):
+        """Solve the largest feasible damping factors for the current updates.
+        
+        With the current global precision matrix Q = Q0 + sum(Qi) and the
+        current cavity precision matrices C_k = Q - Qi_k being positive
+        definite, the proposed matrices
+            Q + df*B,      B = sum(dQi),
+            C_k + df*D_k,  D_k = B - dQi_k,
+        are positive definite if and only if 1 + df*lambda > 0 for every
+        generalised eigenvalue lambda of the pair (B, Q) or (D_k, C_k)
+        respectively. The largest feasible damping factor is thus -1/lambda_min
+        if lambda_min is negative and infinite otherwise. The site parameters,
+        the updates and their sums are read from the instance variables. The
+        cavity constraints are solved in chunks of at most `cavity_chunk`
+        sites as in the method cavities.
+        
+        Parameters
+        ----------
+        sites : ndarray, optional
+            Indexes of the sites whose cavity distributions are considered. By
+            default all the sites are considered.
+        
+        Returns
+        -------
+        df_glob : float
+            The largest feasible damping factor for the global approximation.
+        
+        df_cav : ndarray
+            The largest feasible damping factor for each considered cavity
+            distribution.
+        
+        Raises
+        ------
+        LinAlgError
+            If the current global or cavity precision matrices are not
+            positive definite.
+        
+        """
+        A = unpack_triu(self.Q0_packed + self.Qi_sum,
+                        np.zeros((self.dphi,self.dphi), order='F'),
+                        self.phi_blocks)
+        B = unpack_triu(self.dQi_sum,
+                        np.zeros((self.dphi,self.dphi), order='F'),
+                        self.phi_blocks)
+        # The eigenvalues of block diagonal pairs are those of the blocks
+        lam = min(linalg.eigh(B[b,b], A[b,b], eigvals_only=True,
+                              eigvals=(0,0))[0]
+                  for b in self.phi_slices)
+        df_glob = -1.0/lam if lam < 0 else np.inf
+        
+        def solve_part(sub, C, D):
+            # Solve the cavity constraints of the sites `sub` using the
+            # scratch stacks C and D
+            n = C.shape[2]
+            # Symmetric transposes of C_k and D_k stacked into (n,dphi,dphi)
+            unpack_triu(self.Qi[:,sub], C, self.phi_blocks)
+            np.subtract(A[:,:,np.newaxis], C, out=C)
+            C = C.T
+            unpack_triu(self.dQi[:,sub], D, self.phi_blocks)
+            np.subtract(B[:,:,np.newaxis], D, out=D)
+            D = D.T
+            lam = np.empty(n)
+            lam.fill(np.inf)
+            for b in self.phi_slices:
+                L = np.linalg.cholesky(C[:,b,b])
+                # inv(L) * D * inv(L).T has the same eigenvalues as (D, C)
+                M = np.linalg.solve(L, D[:,b,b])
+                M = np.linalg.solve(L, M.transpose(0,2,1))
+                np.minimum(lam, np.linalg.eigvalsh(M)[:,0], out=lam)
+            out = np.empty_like(lam)
+            out.fill(np.inf)
+            neg = lam < 0
+            out[neg] = -1.0/lam[neg]
+            return out
+        
+        def solve(sl):
+            # Solve the cavity constraints of one chunk of sites in parts,
+            # using the scratch stacks of a borrowed workspace
+            out = []
+            with self.workspaces.borrow() as ws:
+                for sub in self._subchunks(sl):
+                    C, D = ws.stacks(len(self.Qi[0,sub]))
+                    out.append(solve_part(sub, C, D))
+            return np.concatenate(out)
+        df_cav = np.concatenate(self._map_chunks(solve, sites))
+        
+        return df_glob, df_cav
+    
+    
+    def adapt_draws(self, sites=None, success=None):
+        """Adapt the number of samples of each site for the next iteration.
+        
+        See the argument `target_rel_error` in Master. The number of samples
+        required by each site is estimated from the effective sample sizes of
+        its latest successful tilted distribution estimate and kept in the
+        instance variable `draws_req`, so that only the processed sites are
+        read. The sites without such an estimate keep their current number of
+        samples. The workers not yet created are given their number of samples
+        when created (see method _create_worker).
+        
+        Parameters
+        ----------
+        sites : ndarray, optional
+            Indexes of the sites processed in the latest tilted distribution
+            phase. By default all the sites are considered.
+        
+        success : ndarray, optional
+            Boolean array of length K indicating the sites with successful
+            latest tilted distribution estimates. By default all the processed
+            sites are considered successful.
+        
+        Returns
+        -------
+        ndarray
+            The number of samples requested from each site.
+        
+        """
+        target_ess = 1.0 / self.target_rel_error**2
+        if sites is None:
+            sites = xrange(self.K)
+        for k in sites:
+            worker = self.workers[k]
+            if worker.ess is None or (success is not None and not success[k]):
+                if worker.nsamp:
+                    self.draws_req[k] = worker.nsamp
+            else:
+                # Effective samples per sample
+                eff = max(np.min(worker.ess), 1.0) / worker.nsamp
+                self.draws_req[k] = target_ess / eff
+        req = np.where(self.draws_req > 0, self.draws_req, self.min_draws)
+        if self.sample_budget is not None and req.sum() > self.sample_budget:
+            req *= self.sample_budget / req.sum()
+        req = np.maximum(np.ceil(req), self.min_draws).astype(int)
+        self.draws = req
+        for k in xrange(self.K):
+            if self.workers.created(k):
+                self.workers[k].set_draws(req[k])
+        return req
+    
+    
+    def _form_cavity(self, k):
+        """Form the cavity distribution of site k for its tilted distribution.
+        
+        The cavity is formed from the current global approximation and site
+        parameters in the instance variables, right before the site is
+        processed (see Worker.cavity). The mean is taken from `mc`, solved
+        when the cavity distributions were checked (see method cavities). If
+        it is not positive definite, the site parameter updates of the site
+        are discarded and False is returned.
+        
+        """
+        worker = self.workers[k]
+        if worker.cavity(self.Q, self.r, self.Qi[:,k], self.ri[:,k],
+                         mean=self.mc[:,k]):
+            return True
+        worker.discard_tilted(self.dQi[:,k], self.dri[:,k])
+        return False
+    
+    
+    def _open_pool(self):
+        """Open the pool for processing the tilted distributions in parallel.
+        
+        Returns None with backend 'serial'. The pool has to be closed after
+        use with method _close_pool.
+        
+        """
+        if self.backend == 'processes':
+            if self.site_pool is not None:
+                if not self.site_pool.running:
+                    return self.site_pool
+                # Interrupted in the middle of a run, start over
+                self.close()
+            pool = SitePool(self.workers, self.n_jobs, self.dQi, self.dri)
+            if self.keep_pool:
+                self.site_pool = pool
+            return pool
+        elif self.backend == 'socket':
+            site_options = dict((k, self._site_options(k))
+                                for k in xrange(self.K))
+            return SocketPool(self.workers, self.servers, self.dQi, self.dri,
+                              self.worker_options, authkey=self.authkey,
+                              site_options=site_options)
+        else:
+            return None
+    
+    
+    def _close_pool(self, pool):
+        """Close the pool opened with method _open_pool unless it is kept."""
+        if pool is not None and pool is not self.site_pool:
+            pool.close()
+    
+    
+    def close(self):
+        """Terminate the processes kept alive with arg. `keep_pool`."""
+        if self.site_pool is not None:
+            self.site_pool.close()
+            self.site_pool = None
+    
+    
+    def _emit(self, hooks, event, **fields):
+        """Call the hooks with an event of the current iteration."""
+        if not hooks:
+            return
+        fields['event'] = event
+        fields['iteration'] = self.iter
+        for hook in hooks:
+            hook(fields)
+    
+    
+    def _truncate_records(self, n):
+        """Truncate the per iteration records of method run to n iterations."""
+        self.stimes = self.stimes[:n]
+        self.wtimes = self.wtimes[:n]
+        self.ncutoff = self.ncutoff[:n]
+        if self.target_rel_error is not None:
+            self.ndraws = self.ndraws[:n]
+    
+    
+    def _map_chunks(self, func, sites=None):
+        """Call `func` with each chunk of sites.
+        
+        The chunks are slices of all the sites, or index arrays of the given
+        `sites`. The chunks are processed in parallel threads while running.
+        
+        """
+        if sites is None:
+            chunks = self.site_chunks
+        else:
+            chunks = [c for c in np.array_split(sites, self.n_threads)
+                      if len(c)]
+        if self.thread_pool is None:
+            return [func(sl) for sl in chunks]
+        else:
+            return self.thread_pool.map(func, chunks)
+    
+    
+    def _subchunks(self, sl):
+        """Split a chunk of sites into parts of at most `cavity_chunk`."""
+        n = self.cavity_chunk
+        if isinstance(sl, slice):
+            start, stop, _ = sl.indices(self.K)
+            return [slice(i, min(i+n, stop)) for i in xrange(start, stop, n)]
+        return [sl[i:i+n] for i in xrange(0, len(sl), n)]
+    
+    
+    def _site_part_sum(self, A, lowrank=False):
+        """Get a function summing the stacked site array `A` over given sites.
+        
+        If `lowrank` is True, `A` contains low rank site precision matrices
+        (see util.lowrank_factors) and their sum is calculated packed.
+        
+        """
+        if lowrank:
+            def part(sl):
+                U, w = lowrank_factors(A[:,sl], self.dphi)
+                U = U.reshape((self.dphi,-1), order='F')
+                return pack_triu(np.dot(U * w.ravel(order='F'), U.T))
+        else:
+            part = lambda sl: A[...,sl].sum(-1)
+        return part
+    
+    
+    def _sum_sites(self, A, out, sites=None, lowrank=False):
+        """Sum the stacked site array `A` over the sites (the last axis).
+        
+        If `lowrank` is True, `A` contains low rank site precision matrices
+        (see util.lowrank_factors) and their sum is calculated packed into
+        `out`.
+        
+        """
+        part = self._site_part_sum(A, lowrank)
+        parts = self._map_chunks(part, sites)
+        if not parts:
+            out.fill(0)
+            return out
+        np.copyto(out, parts[0])
+        for part in parts[1:]:
+            out += part
+        return out
+    
+    
+    def _aggregate(self, name, changed=None):
+        """Update the sum of a site array with its aggregation tree.
+        
+        The sum of the site array `name` (one of SUM_ARRAYS) is updated into
+        the respective instance variable, e.g. `Qi_sum` for 'Qi', after the
+        sites `changed` (None indicating all) have changed. The leaves of the
+        tree are processed in parallel threads while running.
+        
+        """
+        if self.thread_pool is None:
+            map_func = None
+        else:
+            map_func = self.thread_pool.map
+        return self.agg_trees[name].update(
+            changed, out=getattr(self, name + '_sum'), map_func=map_func)
+    
+    
+    def _axpy_sites(self, a, X, Y, sites=None):
+        """Add `a*X` into `Y` in-place for stacked F-contiguous site arrays."""
+        def axpy(sl):
+            if isinstance(sl, slice):
+                # Contiguous views of the chunks
+                y = Y[...,sl].ravel(order='F')
+                daxpy_routine(X[...,sl].ravel(order='F'), y, a=a)
+            else:
+                Y[...,sl] += a*X[...,sl]
+        self._map_chunks(axpy, sites)
+    
+    
+    def select_sites(self):
+        """Select the sites to be updated in the next iteration.
+        
+        See the argument `site_selection` in Master.
+        
+        Returns
+        -------
+        ndarray
+            Sorted indexes of the selected sites.
+        
+        """
+        if self.site_selection is None:
+            return np.arange(self.K)
+        elif self.site_selection == 'random':
+            sites = self.rand_state.permutation(self.K)[:self.n_sites]
+        elif self.site_selection == 'roundrobin':
+            sites = (self.site_pos + np.arange(self.n_sites)) % self.K
+            self.site_pos = (self.site_pos + self.n_sites) % self.K
+        else:
+            # Largest expected change
+            score = self.site_change * self.site_age
+            sites = np.argsort(-score, kind='mergesort')[:self.n_sites]
+        return np.sort(sites)
+    
+    
+    def _approx_change(self, Q_prev, m_prev, S_prev, ldet_prev, m, S, ldet):
+        """Change of the posterior approximation from the previous one.
+        
+        Returns the KL divergence of N(m,S) from N(m_prev,S_prev) and the
+        relative change (see the argument `tol_rel` in method run). `Q_prev` is
+        the inverse of `S_prev` and `ldet_prev`, `ldet` are the log-determinants
+        of the respective precision matrices.
+        
+        """
+        dm = m - m_prev
+        kl = 0.5*(np.sum(Q_prev*S) + dm.dot(Q_prev.dot(dm)) - self.dphi
+                  + ldet - ldet_prev)
+        rel = max(
+            np.max(np.abs(dm) / np.sqrt(np.diag(S))),
+            np.sqrt(np.sum((S - S_prev)**2) / np.sum(S_prev**2))
+        )
+        return kl, rel
+    
+    
+    def run(self, niter, calc_moments=True, save_last_fits=True, verbose=True,
+            tol_kl=None, tol_rel=None, tol_mc=None, checkpoint_every=None,
+            checkpoint_path=None, history='full', history_every=1,
+            history_path=None, hooks=None):
         """Run the distributed EP algorithm.
         
         Parameters
         ----------
         niter : int
-            Number of iterations to run.
+            Number of iterations to run. If any of the tolerances is given, the
+            maximum number of iterations.
         
         calc_moments : bool, optional
             If True, the moment parameters (mean and covariance) of the
@@ -824,20 +2820,107 @@ class Master(object):
             Default is True.
         
         save_last_fits : bool
-            If True (default), the Stan fit-objects from the last iteration are saved for future use (mix_phi and mix_pred methods).
+            If True (default), the Stan fit-objects from the last iteration are
+            saved for future use (mix_phi and mix_pred methods). Sites reusing
+            their previous samples keep no fit.
         
         verbose : bool, optional
             If true, some progress information is printed. Default is True.
         
+        tol_kl : float, optional
+            Stop when the KL divergence of the posterior approximation from the
+            one of the previous iteration is below this value.
+        
+        tol_rel : float, optional
+            Stop when the relative change in the posterior approximation is
+            below this value. The relative change is the maximum of the change
+            in the mean relative to the posterior standard deviation and the
+            change in the covariance matrix relative to its Frobenius norm.
+        
+        tol_mc : float, optional
+            Stop when the change in the tilted distribution mean of every site
+            is below this value times its Monte Carlo standard error. The
+            standard error is estimated ignoring the autocorrelation of the
+            samples. The sites using the Laplace approximation have no Monte
+            Carlo error and are not considered.
+        
+        checkpoint_every : int, optional
+            If given, a checkpoint is saved into `checkpoint_path` after every
+            `checkpoint_every` iterations (see method save_checkpoint).
+        
+        checkpoint_path : str, optional
+            The path of the checkpoint directory. Required if
+            `checkpoint_every` is given.
+        
+        history : {'full', 'diag'}, optional
+            Store the full covariance matrix of the posterior approximation
+            (default) or only its diagonal, the variance, at every iteration.
+        
+        history_every : int, optional
+            Store the moments only on every `history_every`th iteration and on
+            the last one. Default is 1.
+        
+        history_path : str, optional
+            If given, the moments are streamed into append-only files in this
+            directory as each iteration finishes instead of keeping them in
+            memory, and the returned moments are memory-mapped from the files.
+            See module history.
+        
+        hooks : sequence of callable, optional
+            Functions called with each event of the run, see Notes. E.g. the
+            sinks events.EventTable and events.JsonLinesFile.
+        
         Returns
         -------
         m_phi, var_phi : ndarray
-            Mean and variance of the posterior approximation at every iteration.
-            Returned only if `calc_moments` is True.
+            Mean and covariance (or variance if `history` is 'diag') of the
+            posterior approximation at the stored iterations. Returned only if
+            `calc_moments` is True. The indexes of the stored iterations are
+            stored in the instance variable `history_iters`.
         
         info : int
             Return code. Zero if all ok. See variables Master.INFO_*.
         
+        Notes
+        -----
+        The sampling time of each site in each iteration is stored in the
+        instance variable `stimes` (array of shape (niter, K)) and the real
+        wall time of the tilted distribution phase of each iteration in the
+        instance variable `wtimes`. The number of sites cancelled in each
+        iteration because of the timeouts is stored in the instance variable
+        `ncutoff`. If the number of samples is adapted (see argument
+        `target_rel_error` in Master), the number of samples requested from
+        each site for the next iteration is stored in the instance
+        variable `ndraws`.
+        
+        If the algorithm is stopped because of the tolerances, the returned
+        moments and the sampling times contain only the iterations run. The
+        criterion that stopped the algorithm is stored in the instance variable
+        `stop_reason`, which is one of 'tol_kl', 'tol_rel', 'tol_mc' or
+        'niter'. The criteria based on the posterior approximation are checked
+        before the tilted distribution phase, so that stopping saves it. With
+        the tolerances given, the Stan fit-objects are saved on every iteration
+        if `save_last_fits` is True.
+        
+        The events given to `hooks` are dicts with the name of the event in key
+        'event' and the iteration number in key 'iteration'. The events are:
+            'damping'   : after the damping step of each iteration, with the
+                          number of damping factor decays in 'retries', the
+                          accepted damping factor 'df', and the time spent in
+                          the Cholesky factorisations of the global precision
+                          matrix and in the cavity checks in 'cholesky_time'
+                          and 'cavity_time'
+            'site'      : for each processed site, with the site index in
+                          'site', the times spent in the sampling, the sample
+                          extraction and the precision estimation in
+                          'sampling_time', 'extraction_time' and
+                          'estimation_time', and flags 'failed',
+                          'cancelled' (see `tilted_timeout`) and 'reused'
+                          (see `reuse`)
+            'tilted'    : after the tilted distribution phase, with its wall
+                          time in 'wall_time' and the number of failed sites in
+                          'failures'
+        
         """
         
         if niter < 1:
@@ -848,6 +2931,12 @@ class Master(object):
                 return None, None, self.INFO_OK
             else:
                 return self.INFO_OK
+        if checkpoint_every is not None:
+            if checkpoint_every < 1:
+                raise ValueError("Arg. `checkpoint_every` should be positive")
+            if checkpoint_path is None:
+                raise ValueError("Arg. `checkpoint_path` is required with "
+                                 "`checkpoint_every`")
         
         # Localise some instance variables
         # Mean and cov of the posterior approximation
@@ -859,195 +2948,972 @@ class Master(object):
         # Natural site parameters
         Qi = self.Qi
         ri = self.ri
-        # Natural site proposal parameters
-        Qi2 = self.Qi2
-        ri2 = self.ri2
         # Site parameter updates
         dQi = self.dQi
         dri = self.dri
+        # Sums of the site parameters and their updates
+        Qi_sum = self.Qi_sum
+        ri_sum = self.ri_sum
+        dQi_sum = self.dQi_sum
+        dri_sum = self.dri_sum
+        # Packed global precision matrix
+        Q_packed = np.empty(self.dphi2)
+        # Low rank site approximations
+        lowrank = self.site_form == 'lowrank'
+        if lowrank:
+            # The proposed site precision matrices compressed into the rank,
+            # only the checked sites are written on each try
+            Qi_prop = Qi.copy(order='F')
+            # Sum of the sites not checked in the current iteration
+            Qi_rest = np.empty(self.dphi2)
         
         # Array for positive definitness checking of each cavity distribution
         posdefs = np.empty(self.K, dtype=bool)
         
+        # Convergence criteria
+        self.stop_reason = 'niter'
+        n_done = niter
+        check_moments = tol_kl is not None or tol_rel is not None
+        if check_moments:
+            # The approximation of the previous iteration
+            Q_prev = np.empty((self.dphi,self.dphi), order='F')
+            m_prev = np.empty(self.dphi)
+            S_prev = np.empty((self.dphi,self.dphi), order='F')
+            ldet_prev = None
+        if tol_mc is not None:
+            # The tilted distribution means of the previous iteration
+            mt_prev = np.empty((self.dphi,self.K), order='F')
+            mt_se_prev = np.empty((self.dphi,self.K), order='F')
+            mt_ok_prev = np.zeros(self.K, dtype=bool)
+        
         if calc_moments:
-            # Allocate memory for results
-            m_phi_s = np.zeros((niter, self.dphi))
-            cov_phi_s = np.zeros((niter, self.dphi, self.dphi))
-        
-        # Monitor sampling times
-        stimes = np.zeros(niter)
-        
-        # Iterate niter rounds
-        for cur_iter in xrange(niter):
-            self.iter += 1
-            # Initial dampig factor
-            if self.iter > 1:
-                df = self.df0(self.iter)
+            # Storage for the results
+            hist = History(niter, self.dphi, form=history,
+                           every=history_every, path=history_path)
+            self.history_iters = hist.iters
+        
+        # Monitor sampling times: the sampling time of each site and the wall
+        # time of the whole tilted distribution phase
+        self.stimes = np.zeros((niter, self.K))
+        self.wtimes = np.zeros(niter)
+        self.ncutoff = np.zeros(niter, dtype=int)
+        if self.target_rel_error is not None:
+            self.ndraws = np.zeros((niter, self.K), dtype=int)
+        
+        pool = self._open_pool()
+        if self.n_threads > 1:
+            self.thread_pool = ThreadPool(self.n_threads)
+        
+        # The moments of the approximation are calculated and stored in a
+        # background thread while the tilted distributions are processed,
+        # unless they are needed for the convergence check
+        if calc_moments and not check_moments:
+            moment_pool = ThreadPool(1)
+        else:
+            moment_pool = None
+        moment_job = None
+        
+        def store_moments(cur_iter):
+            """Invert Q (chol in S) and store the moments."""
+            invert_normal_params(S, r, out_A='in-place', out_b=m,
+                                 cho_form=True, blocks=self.phi_blocks)
+            if calc_moments:
+                hist.record(cur_iter, m, S)
+                if verbose:
+                    print "Mean and std of phi[0]: {:.3}, {:.3}" \
+                          .format(m[0], np.sqrt(S[0,0]))
+        
+        try:
+            # Cache the sums of the site parameters and their updates
+            if self.agg_trees is None:
+                self._sum_sites(Qi, Qi_sum, lowrank=lowrank)
+                self._sum_sites(ri, ri_sum)
+                self._sum_sites(dQi, dQi_sum, lowrank=lowrank)
+                self._sum_sites(dri, dri_sum)
             else:
-                # At the first round (rond zero) there is nothing to damp yet
-                df = 1
-            if verbose:
-                print "Iter {}, starting df {:.3g}".format(self.iter, df)
-                fail_printline_pos = False
-                fail_printline_cov = False
+                for name in self.SUM_ARRAYS:
+                    self._aggregate(name)
             
-            while True:
-                # Try to update the global posterior approximation
+            # Iterate niter rounds
+            for cur_iter in xrange(niter):
+                if moment_job is not None:
+                    # Wait for the moments of the previous iteration
+                    moment_job.get()
+                    moment_job = None
+                self.iter += 1
+                # Initial dampig factor
+                if self.iter > 1:
+                    df = self.df0(self.iter)
+                else:
+                    # At the first round (rond zero) there is nothing to damp
+                    # yet
+                    df = 1
+                # The sites processed in this iteration and the sites whose
+                # cavity distributions are checked (None indicating all)
+                sites = self.select_sites()
+                if self.site_selection is None or self.sites_prev is None:
+                    check = None
+                else:
+                    check = np.union1d(self.sites_prev, sites)
+                if self.damping == 'exact' and self.iter > 1:
+                    # Solve the largest feasible damping factor
+                    try:
+                        df_glob, df_cav = self.max_damping(sites=check)
+                    except linalg.LinAlgError:
+                        # Current state not positive definite, use the decay
+                        if verbose:
+                            print "Exact damping failed, using decay"
+                    else:
+                        df_max = self.df_margin * min(df_glob, df_cav.min())
+                        if df_max < df:
+                            df = df_max
+                        if df < self.df_treshold:
+                            if verbose:
+                                print "Damping factor reached minimum."
+                            if df_glob <= df_cav.min():
+                                info = self.INFO_DF_TRESHOLD_REACHED_GLOBAL
+                            else:
+                                info = self.INFO_DF_TRESHOLD_REACHED_CAVITY
+                            if calc_moments:
+                                return hist.result() + (info,)
+                            else:
+                                return info
+                if verbose:
+                    print "Iter {}, starting df {:.3g}".format(self.iter, df)
+                    fail_printline_pos = False
+                    fail_printline_cov = False
+                # Number of damping factor decays and time spent in the checks
+                n_retries = 0
+                time_chol = 0.0
+                time_cav = 0.0
+                if lowrank:
+                    # The compressed proposals of the checked sites are summed
+                    # on each try, the rest of the sum does not change
+                    if check is None:
+                        Qi_rest.fill(0)
+                    else:
+                        self._sum_sites(Qi, Qi_rest, check, lowrank=True)
+                        np.subtract(Qi_sum, Qi_rest, out=Qi_rest)
                 
-                # These 4 lines could be run in parallel also
-                np.add(Qi, np.multiply(df, dQi, out=Qi2), out=Qi2)
-                np.add(ri, np.multiply(df, dri, out=ri2), out=ri2)
-                np.add(Qi2.sum(2, out=Q), self.Q0, out=Q)
-                np.add(ri2.sum(1, out=r), self.r0, out=r)
-                # N.B. In the first iteration Q=Q0, r=r0 (if zero initialised)
+                while True:
+                    # Try to update the global posterior approximation using
+                    # the cached sums: Q = Q0 + sum(Qi) + df*sum(dQi)
+                    if lowrank:
+                        # Sum of the compressed proposals
+                        self._compress_lowrank(df, Qi_prop, check)
+                        self._sum_sites(Qi_prop, Q_packed, check, lowrank=True)
+                        Q_packed += Qi_rest
+                    else:
+                        np.multiply(df, dQi_sum, out=Q_packed)
+                        Q_packed += Qi_sum
+                    Q_packed += self.Q0_packed
+                    unpack_triu(Q_packed, Q, self.phi_blocks)
+                    np.multiply(df, dri_sum, out=r)
+                    r += ri_sum
+                    r += self.r0
+                    # N.B. In the first iteration Q=Q0, r=r0 (if zero
+                    # initialised)
+                    
+                    # Check for positive definiteness
+                    cho_Q = S
+                    np.copyto(cho_Q, Q)
+                    time_start = timer()
+                    try:
+                        cho_factor_blocks(cho_Q, self.phi_blocks)
+                    except linalg.LinAlgError:
+                        time_chol += timer() - time_start
+                        # Not positive definite -> reduce damping factor
+                        df *= self.df_decay
+                        n_retries += 1
+                        if verbose:
+                            fail_printline_pos = True
+                            sys.stdout.write(
+                                "\rNon pos. def. posterior cov, " +
+                                "reducing df to {:.3}".format(df) +
+                                " "*5 + "\b"*5
+                            )
+                            sys.stdout.flush()
+                        if self.iter == 1:
+                            if verbose:
+                                print "\nInvalid prior."
+                            if calc_moments:
+                                return hist.result() + \
+                                    (self.INFO_INVALID_PRIOR,)
+                            else:
+                                return self.INFO_INVALID_PRIOR
+                        if df < self.df_treshold:
+                            if verbose:
+                                print "\nDamping factor reached minimum."
+                            if calc_moments:
+                                return hist.result() + \
+                                    (self.INFO_DF_TRESHOLD_REACHED_GLOBAL,)
+                            else:
+                                return self.INFO_DF_TRESHOLD_REACHED_GLOBAL
+                        continue
+                    
+                    time_chol += timer() - time_start
+                    
+                    # Cavity distributions
+                    # --------------------
+                    # Check positive definitness for each cavity distribution
+                    # with the proposed site parameters
+                    time_start = timer()
+                    if lowrank:
+                        self.cavities(Q, Qi_prop, df=df, out_pos_def=posdefs,
+                                      sites=check, r=r, ri=ri, dri=dri,
+                                      out_m=self.mc)
+                    else:
+                        self.cavities(Q, Qi, dQi=dQi, df=df,
+                                      out_pos_def=posdefs, sites=check,
+                                      r=r, ri=ri, dri=dri, out_m=self.mc)
+                    time_cav += timer() - time_start
+                    
+                    if np.all(posdefs):
+                        # All cavity distributions are positive definite.
+                        # Accept step (update the site parameters in-place)
+                        if lowrank:
+                            # The checked proposals
+                            if check is None:
+                                np.copyto(Qi, Qi_prop)
+                            else:
+                                Qi[:,check] = Qi_prop[:,check]
+                        else:
+                            self._axpy_sites(df, dQi, Qi, check)
+                        self._axpy_sites(df, dri, ri, check)
+                        if self.agg_trees is not None:
+                            self._aggregate('Qi', check)
+                            self._aggregate('ri', check)
+                        else:
+                            np.subtract(Q_packed, self.Q0_packed, out=Qi_sum)
+                            np.subtract(r, self.r0, out=ri_sum)
+                        if self.site_selection is not None:
+                            # The updates have been used, only the processed
+                            # sites get new ones
+                            if check is None:
+                                dQi.fill(0)
+                                dri.fill(0)
+                            else:
+                                dQi[:,check] = 0
+                                dri[:,check] = 0
+                        break
+                        
+                    else:
+                        # Not all cavity distributions are positive definite ...
+                        # reduce the damping factor
+                        df *= self.df_decay
+                        n_retries += 1
+                        if verbose:
+                            if fail_printline_pos:
+                                fail_printline_pos = False
+                                print
+                            fail_printline_cov = True
+                            sys.stdout.write(
+                                "\rNon pos. def. cavity in {} sites, "
+                                .format(np.count_nonzero(~posdefs)) +
+                                "(first encountered in site {}), "
+                                .format(np.nonzero(~posdefs)[0][0]) +
+                                "reducing df to {:.3}".format(df) +
+                                " "*5 + "\b"*5
+                            )
+                            sys.stdout.flush()
+                        if df < self.df_treshold:
+                            if verbose:
+                                print "\nDamping factor reached minimum."
+                            if calc_moments:
+                                return hist.result() + \
+                                    (self.INFO_DF_TRESHOLD_REACHED_CAVITY,)
+                            else:
+                                return self.INFO_DF_TRESHOLD_REACHED_CAVITY
+                if verbose and (fail_printline_pos or fail_printline_cov):
+                    print
+                self._emit(hooks, 'damping', retries=n_retries, df=df,
+                           cholesky_time=time_chol, cavity_time=time_cav)
                 
-                # Check for positive definiteness
-                cho_Q = S
-                np.copyto(cho_Q, Q)
-                try:
-                    linalg.cho_factor(cho_Q, overwrite_a=True)
-                except linalg.LinAlgError:
-                    # Not positive definite -> reduce damping factor
-                    df *= self.df_decay
-                    if verbose:
-                        fail_printline_pos = True
-                        sys.stdout.write(
-                            "\rNon pos. def. posterior cov, " +
-                            "reducing df to {:.3}".format(df) +
-                            " "*5 + "\b"*5
-                        )
-                        sys.stdout.flush()
-                    if self.iter == 1:
+                if moment_pool is not None:
+                    # Invert Q and store the moments in the background. Q, r
+                    # and S are not modified before the next iteration.
+                    moment_job = moment_pool.apply_async(store_moments,
+                                                         (cur_iter,))
+                elif check_moments:
+                    # Log-determinant of Q (chol was already calculated)
+                    ldet_Q = 2*np.sum(np.log(np.diag(cho_Q)))
+                    store_moments(cur_iter)
+                if check_moments:
+                    # Compare to the approximation of the previous iteration
+                    if ldet_prev is not None:
+                        kl, rel = self._approx_change(
+                            Q_prev, m_prev, S_prev, ldet_prev, m, S, ldet_Q)
                         if verbose:
-                            print "\nInvalid prior."
-                        if calc_moments:
-                            return m_phi_s, cov_phi_s, self.INFO_INVALID_PRIOR
+                            print ("KL divergence from previous approximation "
+                                   "{:.3g}, relative change {:.3g}"
+                                   .format(kl, rel))
+                        if tol_kl is not None and kl < tol_kl:
+                            self.stop_reason = 'tol_kl'
+                        elif tol_rel is not None and rel < tol_rel:
+                            self.stop_reason = 'tol_rel'
+                    np.copyto(Q_prev, Q)
+                    np.copyto(m_prev, m)
+                    np.copyto(S_prev, S)
+                    ldet_prev = ldet_Q
+                    if self.stop_reason != 'niter':
+                        # Converged, the current updates have been used
+                        dQi.fill(0)
+                        dri.fill(0)
+                        dQi_sum.fill(0)
+                        dri_sum.fill(0)
+                        if self.site_selection is not None:
+                            self.sites_prev = np.zeros(0, dtype=int)
+                        n_done = cur_iter + 1
+                        self._truncate_records(cur_iter)
+                        break
+                
+                # Tilted distributions (parallelisable)
+                # -------------------------------------
+                if verbose:
+                        print "Process tilted distributions"
+                save_fit = save_last_fits and (
+                    cur_iter == niter-1 or check_moments or tol_mc is not None)
+                time_start = timer()
+                # Sites cancelled because of the timeouts
+                cancelled = set()
+                if pool is None:
+                    # Process the sites serially
+                    for k in sites:
+                        if verbose:
+                            sys.stdout.write(
+                                "\r    site {}".format(k+1)+' '*10+'\b'*9)
+                            # Force flush here as it is not done automatically
+                            sys.stdout.flush()
+                        # Process the site
+                        if self._form_cavity(k):
+                            worker = self.workers[k]
+                            posdefs[k] = worker.tilted(
+                                dQi[:,k],
+                                dri[:,k],
+                                save_fit = save_fit
+                            )
+                            worker.release_cavity()
                         else:
-                            return self.INFO_INVALID_PRIOR
-                    if df < self.df_treshold:
+                            posdefs[k] = False
+                        if verbose and not posdefs[k]:
+                            sys.stdout.write("fail\n")
+                else:
+                    # Process the sites in parallel
+                    results = pool.imap(
+                        sites,
+                        save_fit = save_fit,
+                        timeout = self.tilted_timeout,
+                        timeout_mult = self.tilted_timeout_mult,
+                        prepare = self._form_cavity
+                    )
+                    for (k, posdef) in results:
+                        if posdef is None:
+                            # Cancelled because of the timeout
+                            self.workers[k].discard_tilted(dQi[:,k], dri[:,k])
+                            self.ncutoff[cur_iter] += 1
+                            cancelled.add(k)
+                            posdef = False
+                        posdefs[k] = posdef
                         if verbose:
-                            print "\nDamping factor reached minimum."
-                        if calc_moments:
-                            return m_phi_s, cov_phi_s, \
-                                self.INFO_DF_TRESHOLD_REACHED_GLOBAL
+                            sys.stdout.write(
+                                "\r    site {} done".format(k+1)+' '*10+'\b'*9)
+                            if not posdef:
+                                sys.stdout.write("fail\n")
+                            sys.stdout.flush()
+                self.wtimes[cur_iter] = timer() - time_start
+                if hooks:
+                    for k in sites:
+                        worker = self.workers[k]
+                        if k in cancelled:
+                            self._emit(hooks, 'site', site=k,
+                                       sampling_time=worker.last_time,
+                                       extraction_time=None,
+                                       estimation_time=None,
+                                       failed=True, cancelled=True,
+                                       reused=False)
                         else:
-                            return self.INFO_DF_TRESHOLD_REACHED_GLOBAL
-                    continue
+                            self._emit(hooks, 'site', site=k,
+                                       sampling_time=worker.last_time,
+                                       extraction_time=worker.extract_time,
+                                       estimation_time=worker.estim_time,
+                                       failed=not posdefs[k], cancelled=False,
+                                       reused=worker.reused)
+                    n_failed = len(sites) - np.count_nonzero(posdefs[sites])
+                    self._emit(hooks, 'tilted', wall_time=self.wtimes[cur_iter],
+                               failures=n_failed)
+                if verbose:
+                    if np.all(posdefs):
+                        print "\rAll sites ok"
+                    elif np.any(posdefs):
+                        print "\rSome sites failed and are not updated"
+                    else:
+                        print "\rEvery site failed"
+                    if self.ncutoff[cur_iter]:
+                        print "{} sites cancelled because of the timeout" \
+                              .format(self.ncutoff[cur_iter])
+                if not np.any(posdefs[sites]):
+                    if moment_job is not None:
+                        moment_job.get()
+                    if calc_moments:
+                        return hist.result() + (self.INFO_ALL_SITES_FAIL,)
+                    else:
+                        return self.INFO_ALL_SITES_FAIL
                 
-                # Cavity distributions (parallelisable)
-                # -------------------------------------
-                # Check positive definitness for each cavity distribution
-                for k in xrange(self.K):
-                    posdefs[k] = \
-                        self.workers[k].cavity(Q, r, Qi2[:,:,k], ri2[:,k])
-                    # Early stopping criterion (when in serial)
-                    if not posdefs[k]:
-                        break
+                # Store sampling times
+                for k in sites:
+                    self.stimes[cur_iter,k] = self.workers[k].last_time
                 
-                if np.all(posdefs):
-                    # All cavity distributions are positive definite.
-                    # Accept step (switch Qi-Qi2 and ri-ri2)
-                    temp = Qi
-                    Qi = Qi2
-                    Qi2 = temp
-                    temp = ri
-                    ri = ri2
-                    ri2 = temp
-                    self.Qi = Qi
-                    self.Qi2 = Qi2
-                    self.ri = ri
-                    self.ri2 = ri2
-                    break
-                    
+                if self.target_rel_error is not None:
+                    # Adapt the number of samples for the next iteration
+                    self.ndraws[cur_iter] = self.adapt_draws(sites, posdefs)
+                
+                if lowrank:
+                    self._complete_lowrank(sites[posdefs[sites]])
+                
+                if self.agg_trees is not None:
+                    # Aggregate the sums of the updates of the changed sites
+                    self._aggregate('dQi', check)
+                    self._aggregate('dri', check)
+                elif self.site_selection is None:
+                    # Cache the sums of the updates
+                    self._sum_sites(dQi, dQi_sum, lowrank=lowrank)
+                    self._sum_sites(dri, dri_sum)
                 else:
-                    # Not all cavity distributions are positive definite ...
-                    # reduce the damping factor
-                    df *= self.df_decay
+                    # Cache the sums of the updates, only the processed sites
+                    # have non-zero ones
+                    self._sum_sites(dQi, dQi_sum, sites, lowrank=lowrank)
+                    self._sum_sites(dri, dri_sum, sites)
+                if self.site_selection is not None:
+                    # Magnitudes of the updates for the site selection
+                    self.site_age += 1
+                    self.site_age[sites] = 1
+                    if lowrank:
+                        # Frobenius norms from the Gram matrices of the factors
+                        U, w = lowrank_factors(dQi[:,sites], self.dphi)
+                        G = np.einsum('imk,ilk->mlk', U, U)
+                        dQi_norm2 = np.einsum('mk,lk,mlk->k', w, w, G**2)
+                    else:
+                        dQi_norm2 = np.sum(dQi[:,sites]**2, axis=0)
+                    self.site_change[sites] = np.sqrt(
+                        dQi_norm2 + np.sum(dri[:,sites]**2, axis=0))
+                    self.site_change[sites[~posdefs[sites]]] = np.inf
+                    self.sites_prev = sites
+                
+                if (checkpoint_every is not None
+                        and (cur_iter + 1) % checkpoint_every == 0):
+                    self.save_checkpoint(checkpoint_path)
                     if verbose:
-                        if fail_printline_pos:
-                            fail_printline_pos = False
-                            print
-                        fail_printline_cov = True
-                        sys.stdout.write(
-                            "\rNon pos. def. cavity, " +
-                            "(first encountered in site {}), "
-                            .format(np.nonzero(~posdefs)[0][0]) +
-                            "reducing df to {:.3}".format(df) +
-                            " "*5 + "\b"*5
-                        )
-                        sys.stdout.flush()
-                    if df < self.df_treshold:
+                        print "Checkpoint saved into {}".format(checkpoint_path)
+                
+                if verbose and calc_moments:
+                    print("Iter {} done, max sampling time {}, wall time {}"
+                          .format(self.iter, self.stimes[cur_iter].max(),
+                                  self.wtimes[cur_iter]))
+                
+                if tol_mc is not None:
+                    # Change in the tilted distribution means relative to
+                    # their Monte Carlo standard errors
+                    mt_all = np.all(posdefs) and np.all(mt_ok_prev)
+                    mt_z = 0.0
+                    n_mc = 0
+                    # Only the processed sites have changed, the others are
+                    # not read in order not to create their workers
+                    for k in sites:
+                        if not posdefs[k]:
+                            mt_ok_prev[k] = False
+                            continue
+                        worker = self.workers[k]
+                        if worker.tilted_method == 'laplace':
+                            # Deterministic, the standard error is zero
+                            mt_ok_prev[k] = True
+                            continue
+                        if mt_ok_prev[k]:
+                            n_mc += 1
+                            mt_z = max(mt_z, np.max(
+                                np.abs(worker.mt - mt_prev[:,k])
+                                / np.sqrt(worker.mt_se**2 + mt_se_prev[:,k]**2)
+                            ))
+                        np.copyto(mt_prev[:,k], worker.mt)
+                        np.copyto(mt_se_prev[:,k], worker.mt_se)
+                        mt_ok_prev[k] = True
+                    if mt_all and n_mc:
                         if verbose:
-                            print "\nDamping factor reached minimum."
-                        if calc_moments:
-                            return m_phi_s, cov_phi_s, \
-                                self.INFO_DF_TRESHOLD_REACHED_CAVITY
-                        else:
-                            return self.INFO_DF_TRESHOLD_REACHED_CAVITY
-            if verbose and (fail_printline_pos or fail_printline_cov):
-                print
+                            print ("Max change in tilted means relative to MC "
+                                   "error {:.3g}".format(mt_z))
+                        if mt_z < tol_mc:
+                            self.stop_reason = 'tol_mc'
+                            n_done = cur_iter + 1
+                            self._truncate_records(n_done)
+                            break
             
-            if calc_moments:
-                # Invert Q (chol was already calculated)
-                # N.B. The following inversion could be done while
-                # parallel jobs are running, thus saving time.
-                invert_normal_params(cho_Q, r, out_A='in-place', out_b=m,
-                                     cho_form=True)
-                # Store the approximation moments
-                np.copyto(m_phi_s[cur_iter], m)
-                np.copyto(cov_phi_s[cur_iter], S.T)
-                if verbose:
-                    print "Mean and std of phi[0]: {:.3}, {:.3}" \
-                          .format(m_phi_s[cur_iter,0], 
-                                  np.sqrt(cov_phi_s[cur_iter,0,0]))
+            if moment_job is not None:
+                moment_job.get()
             
-            # Tilted distributions (parallelisable)
-            # -------------------------------------
+        finally:
+            self._close_pool(pool)
+            if self.thread_pool is not None:
+                self.thread_pool.close()
+                self.thread_pool.join()
+                self.thread_pool = None
+            if moment_pool is not None:
+                moment_pool.close()
+                moment_pool.join()
+            if calc_moments:
+                hist.close()
+        
+        if verbose:
+            if self.stop_reason != 'niter':
+                print "Converged ({})".format(self.stop_reason)
+            print("{} iterations done\nTotal limiting sampling time: {}, "
+                  "total wall time: {}"
+                  .format(n_done, self.stimes.max(axis=1).sum(),
+                          self.wtimes.sum()))
+        
+        if calc_moments:
+            return hist.result(n_done) + (self.INFO_OK,)
+        else:
+            return self.INFO_OK
+    
+    
+    def run_async(self, niter, staleness=None, calc_moments=True,
+                  save_last_fits=True, verbose=True, history='full',
+                  history_every=1, history_path=None):
+        """Run the distributed EP algorithm asynchronously.
+        
+        In the asynchronous (stale-synchronous) mode, there is no barrier
+        between the iterations. As soon as the tilted distribution of a site
+        has been processed, its update is damped and folded into the global
+        approximation and the site is immediately given a new cavity
+        distribution. Updates finishing at the same time are folded together
+        as one global update. With backends 'processes' and 'socket' the sites
+        are processed in parallel. Otherwise they are processed one after
+        another: without a staleness bound each site is folded as soon as it
+        is processed, and with a staleness bound all the sites are given
+        cavity distributions as if processed in parallel and then processed in
+        the order they were given, so that for example zero staleness
+        reproduces the synchronous method run.
+        
+        Parameters
+        ----------
+        niter : int
+            Number of iterations to run. One iteration corresponds to K
+            processed tilted distributions, the sites finishing faster being
+            processed more often.
+        
+        staleness : int, optional
+            The staleness bound, i.e. the maximum number of global updates the
+            cavity distribution of a site may lag behind when its update is
+            folded. If folding the finished sites would make a running site
+            lag more than this, the finished sites wait until the lagging sites
+            are done. Zero corresponds to the synchronous algorithm. By default
+            the staleness is not bounded.
+        
+        calc_moments : bool, optional
+            If True, the moment parameters (mean and covariance) of the
+            posterior approximation are calculated after every iteration and
+            returned. Default is True.
+        
+        save_last_fits : bool
+            If True (default), the Stan fit-objects from the last iteration are
+            saved for future use (mix_phi and mix_pred methods). Sites reusing
+            their previous samples keep no fit.
+        
+        verbose : bool, optional
+            If true, some progress information is printed. Default is True.
+        
+        history, history_every, history_path : optional
+            The storage of the moments, see method run.
+        
+        Returns
+        -------
+        m_phi, var_phi : ndarray
+            Mean and covariance (or variance if `history` is 'diag') of the
+            posterior approximation after the stored iterations. Returned only
+            if `calc_moments` is True.
+        
+        info : int
+            Return code. Zero if all ok. See variables Master.INFO_*.
+        
+        Notes
+        -----
+        The damping factor of an update of a site is given by `df0` called
+        with the number of tilted distributions processed by the site so far
+        plus one.
+        If the resulting posterior or cavity distributions are not positive
+        definite, the damping factors of the folded updates are decayed
+        together. If the damping reaches `df_treshold`, the updates are
+        discarded, and the tilted distributions of the sites are discarded
+        (see Worker.discard_tilted) with their iteration counters rolled back.
+        
+        For each site, the number of global updates its cavity lagged behind
+        when its update was folded are stored in the instance variable
+        `site_lags` (list of K lists). The sampling times are stored in the
+        instance variable `stimes` as in the method run, the time of each
+        processed tilted distribution being added to the iteration during
+        which it finished.
+        
+        """
+        
+        if self.site_form == 'lowrank':
+            raise ValueError("Low rank site approximations are not supported "
+                             "in run_async")
+        if niter < 1:
             if verbose:
-                    print "Process tilted distributions"
-            for k in xrange(self.K):
-                if verbose:
-                    sys.stdout.write("\r    site {}".format(k+1)+' '*10+'\b'*9)
-                    # Force flush here as it is not done automatically
-                    sys.stdout.flush()
-                # Process the site
-                posdefs[k] = self.workers[k].tilted(
-                    dQi[:,:,k],
-                    dri[:,k],
-                    save_fit = (save_last_fits and cur_iter == niter-1)
-                )
-                if verbose and not posdefs[k]:
-                    sys.stdout.write("fail\n")
+                print "Nothing to do here as provided arg. `niter` is {}" \
+                      .format(niter)
+            if calc_moments:
+                return None, None, self.INFO_OK
+            else:
+                return self.INFO_OK
+        
+        # Localise some instance variables
+        S = self.S
+        m = self.m
+        Q = self.Q
+        r = self.r
+        Qi = self.Qi
+        ri = self.ri
+        dQi = self.dQi
+        dri = self.dri
+        
+        # Packed global precision matrix
+        Q_packed = np.empty(self.dphi2)
+        
+        # Temporary arrays for the proposals
+        Q2 = np.empty(self.dphi2)
+        r2 = np.empty(self.dphi)
+        temp_p = np.empty(self.dphi2)
+        temp_M = np.zeros((self.dphi,self.dphi), order='F')
+        
+        if calc_moments:
+            # Storage for the results
+            hist = History(niter, self.dphi, form=history,
+                           every=history_every, path=history_path)
+            self.history_iters = hist.iters
+        
+        # Check the prior
+        np.add(Qi.sum(1, out=Q_packed), self.Q0_packed, out=Q_packed)
+        unpack_triu(Q_packed, Q, self.phi_blocks)
+        np.add(ri.sum(1, out=r), self.r0, out=r)
+        try:
+            np.copyto(S, Q)
+            cho_factor_blocks(S, self.phi_blocks)
+        except linalg.LinAlgError:
             if verbose:
-                if np.all(posdefs):
-                    print "\rAll sites ok"
-                elif np.any(posdefs):
-                    print "\rSome sites failed and are not updated"
-                else:
-                    print "\rEvery site failed"
-            if not np.any(posdefs):
-                if calc_moments:
-                    return m_phi_s, cov_phi_s, self.INFO_ALL_SITES_FAIL
+                print "Invalid prior."
+            if calc_moments:
+                hist.close()
+                return hist.result() + (self.INFO_INVALID_PRIOR,)
+            else:
+                return self.INFO_INVALID_PRIOR
+        
+        # Counter of the global updates and its value at the cavity of each
+        # site
+        n_glob = 0
+        cav_glob = np.zeros(self.K, dtype=np.int64)
+        self.site_lags = [[] for _ in xrange(self.K)]
+        # Total number of tilted distributions to process
+        n_total = niter * self.K
+        n_dispatched = 0
+        n_done = 0
+        # Sites waiting for a cavity, being processed, and waiting for folding
+        pending = range(self.K)
+        running = set()
+        finished = []
+        
+        pool = self._open_pool()
+        if self.backend == 'processes':
+            capacity = self.n_jobs
+        elif self.backend == 'socket':
+            capacity = len(self.servers)
+        elif staleness is None:
+            capacity = 1
+        else:
+            capacity = self.K
+        if pool is None:
+            # The sites given a cavity distribution in the order of
+            # processing, and the global approximations of their cavities by
+            # the global update counter. The cavities are formed again from
+            # these when processed, with the means solved when given, so that
+            # the workspaces are held only for the site being processed.
+            queue = []
+            glob_cavs = {}
+        
+        self.stimes = np.zeros((niter, self.K))
+        self.wtimes = np.zeros(niter)
+        time_start = timer()
+        
+        try:
+            while n_done < n_total:
+                
+                # Give new cavity distributions to the idle sites
+                for k in list(pending):
+                    if len(running) >= capacity or n_dispatched >= n_total:
+                        break
+                    worker = self.workers[k]
+                    if not worker.cavity(Q, r, Qi[:,k], ri[:,k]):
+                        # Not positive definite, try again after the next
+                        # global update
+                        continue
+                    pending.remove(k)
+                    running.add(k)
+                    cav_glob[k] = n_glob
+                    save_fit = save_last_fits and n_dispatched >= n_total-self.K
+                    n_dispatched += 1
+                    if pool is None:
+                        np.copyto(self.mc[:,k], worker.vec)
+                        worker.release_cavity()
+                        if not n_glob in glob_cavs:
+                            glob_cavs[n_glob] = (Q.copy(order='F'), r.copy())
+                        queue.append((k, save_fit))
+                    else:
+                        pool.submit(k, save_fit=save_fit)
+                if not running and not finished:
+                    # No cavity distribution is positive definite
+                    if verbose:
+                        print "\nNon pos. def. cavity in every idle site."
+                    if calc_moments:
+                        return hist.result(n_done//self.K) + \
+                            (self.INFO_DF_TRESHOLD_REACHED_CAVITY,)
+                    else:
+                        return self.INFO_DF_TRESHOLD_REACHED_CAVITY
+                
+                # Wait for the sites to finish
+                if pool is None:
+                    # Process the next site in the queue
+                    k, save_fit = queue.pop(0)
+                    worker = self.workers[k]
+                    Q_cav, r_cav = glob_cavs[cav_glob[k]]
+                    worker.cavity(Q_cav, r_cav, Qi[:,k], ri[:,k],
+                                  mean=self.mc[:,k])
+                    posdef = worker.tilted(dQi[:,k], dri[:,k],
+                                           save_fit=save_fit)
+                    worker.release_cavity()
+                    finished.append((k, posdef))
+                    if not any(cav_glob[j] == cav_glob[k] for (j, _) in queue):
+                        del glob_cavs[cav_glob[k]]
                 else:
-                    return self.INFO_ALL_SITES_FAIL
-            
-            # Store max sampling time
-            stimes[cur_iter] = max([w.last_time for w in self.workers])
-            
-            if verbose and calc_moments:
-                print("Iter {} done, max sampling time {}"
-                      .format(self.iter, stimes[cur_iter]))
+                    finished.extend(pool.wait())
+                for (k, _) in finished:
+                    if k in running:
+                        running.discard(k)
+                        cur_iter = min(n_done // self.K, niter-1)
+                        self.stimes[cur_iter,k] += self.workers[k].last_time
+                # Check the staleness bound
+                if (    staleness is not None and running
+                     and n_glob + 1 - cav_glob[list(running)].min() > staleness
+                   ):
+                    continue
+                
+                # Fold the finished sites into the global approximation
+                fold = [k for (k, posdef) in finished if posdef]
+                if fold:
+                    dfs = np.array(
+                        [self.df0(self.workers[k].iteration + 1)
+                         for k in fold])
+                    df_mult = 1.0
+                    while True:
+                        np.copyto(Q2, Q_packed)
+                        np.copyto(r2, r)
+                        for (k, df) in zip(fold, dfs):
+                            Q2 += (df_mult*df) * dQi[:,k]
+                            r2 += (df_mult*df) * dri[:,k]
+                        try:
+                            unpack_triu(Q2, temp_M, self.phi_blocks)
+                            cho_factor_blocks(temp_M, self.phi_blocks)
+                            for (k, df) in zip(fold, dfs):
+                                # Cavity with the folded site parameters
+                                np.subtract(Q2, Qi[:,k], out=temp_p)
+                                temp_p -= (df_mult*df) * dQi[:,k]
+                                unpack_triu(temp_p, temp_M, self.phi_blocks)
+                                cho_factor_blocks(temp_M, self.phi_blocks)
+                        except linalg.LinAlgError:
+                            # Not positive definite -> reduce damping factor
+                            df_mult *= self.df_decay
+                            if df_mult * dfs.max() < self.df_treshold:
+                                if verbose:
+                                    print ("\nDamping factor reached "
+                                           "minimum, discarding updates of "
+                                           "sites {}".format(fold))
+                                for k in fold:
+                                    # Roll back the tilted distribution
+                                    worker = self.workers[k]
+                                    worker.discard_tilted(dQi[:,k], dri[:,k])
+                                    worker.iteration -= 1
+                                break
+                            continue
+                        # Accept
+                        for (k, df) in zip(fold, dfs):
+                            Qi[:,k] += (df_mult*df) * dQi[:,k]
+                            ri[:,k] += (df_mult*df) * dri[:,k]
+                            self.site_lags[k].append(n_glob - cav_glob[k])
+                        np.copyto(Q_packed, Q2)
+                        unpack_triu(Q_packed, Q, self.phi_blocks)
+                        np.copyto(r, r2)
+                        n_glob += 1
+                        break
+                for (k, _) in finished:
+                    pending.append(k)
+                n_iter_prev = n_done // self.K
+                n_done += len(finished)
+                finished = []
+                if verbose:
+                    sys.stdout.write(
+                        "\r{} site updates done, {} global updates"
+                        .format(n_done, n_glob) + ' '*5 + '\b'*5
+                    )
+                    sys.stdout.flush()
+                
+                # Store the results of finished iterations
+                for cur_iter in xrange(n_iter_prev, n_done // self.K):
+                    self.iter += 1
+                    self.wtimes[cur_iter] = timer() - time_start
+                    time_start = timer()
+                    if calc_moments:
+                        invert_normal_params(Q, r, out_A=S, out_b=m,
+                                             blocks=self.phi_blocks)
+                        hist.record(cur_iter, m, S)
+        
+        finally:
+            self._close_pool(pool)
+            if calc_moments:
+                hist.close()
         
         if verbose:
-            print("{} iterations done\nTotal limiting sampling time: {}"
-                  .format(niter, stimes.sum()))
+            print("\n{} iterations done\nTotal wall time: {}"
+                  .format(niter, self.wtimes.sum()))
         
         if calc_moments:
-            return m_phi_s, cov_phi_s, self.INFO_OK
+            return hist.result() + (self.INFO_OK,)
         else:
             return self.INFO_OK
     
     
+    def save_checkpoint(self, path):
+        """Save the state of the algorithm into a checkpoint directory.
+        
+        The site parameters and their pending updates are written in the
+        numpy binary format directly from the arrays, one file each. The
+        iteration counter, the state of the site selection and the states of
+        the workers (the sampler initialisations and the random number
+        generator states) and the states of the random number generators of
+        the master are pickled into a separate file. An existing checkpoint in
+        `path` is replaced only after the new one has been completely written.
+        
+        The model, the data and the configuration are not saved. The run can be
+        resumed with the method load_checkpoint or from_checkpoint.
+        
+        Parameters
+        ----------
+        path : str
+            The path of the checkpoint directory.
+        
+        """
+        path = os.path.normpath(path)
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        for name in self.CHECKPOINT_ARRAYS:
+            np.save(os.path.join(temp_path, name + '.npy'), getattr(self, name))
+        state = dict(
+            K = self.K,
+            dphi = self.dphi,
+            iter = self.iter,
+            workers = [self.workers[k].get_state()
+                       if self.workers.created(k) else None
+                       for k in xrange(self.K)],
+            rand_state = self.rand_state.get_state(),
+            seed_state = self.worker_options['seed'].get_state(),
+            site_seeds = self.site_seeds,
+            sites_prev = self.sites_prev,
+            site_pos = self.site_pos,
+            site_change = self.site_change,
+            site_age = self.site_age,
+            draws_req = self.draws_req,
+            draws = self.draws
+        )
+        with open(os.path.join(temp_path, 'state.pkl'), 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        # Replace the old checkpoint
+        if os.path.exists(path):
+            old_path = path + '.old'
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+            os.rename(temp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(temp_path, path)
+    
+    
+    def load_checkpoint(self, path):
+        """Restore the state of the algorithm from a checkpoint directory.
+        
+        The object has to be constructed with the same model, data and
+        configuration as the one that saved the checkpoint (see method
+        save_checkpoint). The site arrays are memory mapped and copied into
+        place.
+        
+        Parameters
+        ----------
+        path : str
+            The path of the checkpoint directory.
+        
+        """
+        with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        if state['K'] != self.K or state['dphi'] != self.dphi:
+            raise ValueError("The checkpoint does not match the dimensions")
+        for name in self.CHECKPOINT_ARRAYS:
+            arr = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            np.copyto(getattr(self, name), arr)
+            del arr
+        self.iter = state['iter']
+        self.rand_state.set_state(state['rand_state'])
+        self.worker_options['seed'].set_state(state['seed_state'])
+        self.site_seeds = state['site_seeds']
+        self.sites_prev = state['sites_prev']
+        self.site_pos = state['site_pos']
+        self.site_change = state['site_change']
+        self.site_age = state['site_age']
+        self.draws_req = state['draws_req']
+        self.draws = state['draws']
+        for (k, worker_state) in enumerate(state['workers']):
+            if worker_state is None:
+                # Not created before the checkpoint
+                self.workers.discard(k)
+            else:
+                worker = self.workers[k]
+                worker.set_state(worker_state)
+                worker.phase = 0
+    
+    
+    @classmethod
+    def from_checkpoint(cls, path, site_model, X, y, **kwargs):
+        """Construct a Master and restore its state from a checkpoint.
+        
+        The arguments `site_model`, `X`, `y` and the keyword arguments are
+        passed to the constructor and they should be the same as the ones used
+        originally. See the method load_checkpoint.
+        
+        """
+        master = cls(site_model, X, y, **kwargs)
+        master.load_checkpoint(path)
+        return master
+    
+    
+    def _check_fits(self):
+        """Check that every site has a saved fit for mixing the samples."""
+        for k in xrange(self.K):
+            if self.workers[k].fit is None:
+                raise RuntimeError(
+                    "Site {} has no saved fit, e.g. because its previous "
+                    "samples were reused on the last iteration (see worker "
+                    "option `reuse`).".format(k)
+                )
+    
+    
     def mix_phi(self, out_S=None, out_m=None):
         """Form the posterior approximation of phi by mixing the last samples.
         
@@ -1069,6 +3935,7 @@ class Master(object):
         if self.iter == 0:
             raise RuntimeError("Can not mix samples before at least one "
                                "iteration has been done.")
+        self._check_fits()
         if not out_S:
             out_S = np.zeros((self.dphi,self.dphi), order='F')
         if not out_m:
@@ -1145,6 +4012,7 @@ class Master(object):
         if self.iter == 0:
             raise RuntimeError("Can not mix samples before at least one "
                                "iteration has been done.")
+        self._check_fits()
         
         # Check if one or multiple parameters are requested
         if isinstance(params, basestring):
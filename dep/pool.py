@@ -0,0 +1,498 @@
+"""Pools for running the tilted distribution phase of the distributed EP
+algorithm in parallel.
+
+In SitePool, the processes are forked from the master process, so they share
+the workers, the site data and the compiled Stan model with it without any
+copying. The processes can be kept alive over several runs. In each task, only
+the current cavity distribution and the state of the worker are sent to the
+process, and the global approximation only if it has changed since the
+previous task of the process. The resulting site parameter updates are written
+directly into arrays in shared memory (see util.shared_zeros) and the updated
+state of the worker is sent back.
+
+In SocketPool, the sites are processed by site servers (see module server)
+holding their own data and model, possibly on other machines. The tasks are
+the same as in SitePool, but the site parameter updates are sent back over
+the connection.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import select
+import signal
+import traceback
+import multiprocessing
+from multiprocessing.connection import Client
+from timeit import default_timer as timer
+import numpy as np
+
+
+def _global_to_send(sent, conn, Q, r):
+    """Get the global approximation to be sent with a task.
+    
+    Returns None if the same approximation was sent to the connection already,
+    and a copy of (Q, r) otherwise. `sent` holds the latest approximation sent
+    to each connection and it is updated accordingly.
+    
+    """
+    prev = sent.get(conn)
+    if (prev is not None and np.array_equal(prev[0], Q)
+            and np.array_equal(prev[1], r)):
+        return None
+    sent[conn] = (Q.copy(order='F'), r.copy())
+    return sent[conn]
+
+
+def _serve(conn, workers, dQi, dri):
+    """Process the tasks sent by a SitePool. Run in the forked processes."""
+    # The parent process takes care of keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The latest global approximation
+    Q = r = None
+    while True:
+        task = conn.recv()
+        if task is None:
+            # Terminate
+            break
+        k, glob, Mat, vec, state, save_fit = task
+        if glob is not None:
+            Q, r = glob
+        worker = workers[k]
+        try:
+            worker.set_state(state)
+            worker.set_cavity(Q, r, Mat, vec)
+            pos_def = worker.tilted(dQi[:,k], dri[:,k], save_fit=save_fit)
+        except Exception:
+            conn.send((k, None, traceback.format_exc(), None))
+        else:
+            conn.send((k, pos_def, worker.get_state(),
+                       worker.fit if save_fit else None))
+            # Do not keep the fit object in the child process
+            worker.fit = None
+        worker.release_cavity()
+    conn.close()
+
+
+class SitePool(object):
+    """Pool of forked processes processing the tilted distributions.
+    
+    The pool should be created after the arrays `dQi` and `dri` have been
+    allocated into shared memory and it should be closed by calling the method
+    close.
+    
+    Parameters
+    ----------
+    workers : list of Worker
+        The workers of the sites.
+    
+    n_jobs : int
+        The number of processes.
+    
+    dQi, dri : ndarray
+        The output arrays for the site parameter updates in shared memory (see
+        util.shared_zeros). The last axis indexes the sites.
+    
+    """
+    
+    def __init__(self, workers, n_jobs, dQi, dri):
+        self.workers = workers
+        self.dQi = dQi
+        self.dri = dri
+        # The process behind each connection
+        self.procs = {}
+        # Connections to the idle processes
+        self.idle = []
+        # Site being processed for each connection to a busy process
+        self.running = {}
+        # Start time of the task for each connection to a busy process
+        self.started = {}
+        # The latest global approximation sent to each process
+        self.sent_global = {}
+        for _ in xrange(n_jobs):
+            self._start_process()
+    
+    
+    def _start_process(self):
+        """Fork a new idle process into the pool."""
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_serve,
+            args=(child_conn, self.workers, self.dQi, self.dri)
+        )
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        self.procs[parent_conn] = proc
+        self.idle.append(parent_conn)
+    
+    
+    def submit(self, k, save_fit=False):
+        """Start processing the tilted distribution of site k.
+        
+        The cavity distribution of the site has to be calculated before calling
+        this method (see Worker.cavity) and there has to be an idle process in
+        the pool.
+        
+        """
+        if not self.idle:
+            raise RuntimeError("No idle processes in the pool.")
+        worker = self.workers[k]
+        if worker.phase != 1:
+            raise RuntimeError('Cavity has to be calculated before tilted.')
+        conn = self.idle.pop()
+        glob = _global_to_send(self.sent_global, conn, worker.Q, worker.r)
+        conn.send((k, glob, worker.Mat, worker.vec, worker.get_state(),
+                   save_fit))
+        # The cavity was copied to the process
+        worker.release_cavity()
+        self.running[conn] = k
+        self.started[conn] = timer()
+    
+    
+    def wait(self, timeout=None):
+        """Wait for the processing of at least one site to finish.
+        
+        The state of the workers of the finished sites is updated accordingly.
+        
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time in seconds to wait. By default waits indefinitely.
+        
+        Returns
+        -------
+        list of (int, bool)
+            The index of each finished site and its positive definiteness
+            indicator, see Worker.tilted. Empty list if the timeout expired.
+        
+        """
+        if not self.running:
+            return []
+        ready, _, _ = select.select(list(self.running), [], [], timeout)
+        out = []
+        for conn in ready:
+            k, pos_def, state, fit = conn.recv()
+            del self.running[conn]
+            del self.started[conn]
+            self.idle.append(conn)
+            if pos_def is None:
+                raise RuntimeError("Processing site {} failed:\n{}"
+                                   .format(k, state))
+            worker = self.workers[k]
+            worker.set_state(state)
+            worker.fit = fit
+            worker.phase = 2 if pos_def else 0
+            out.append((k, pos_def))
+        return out
+    
+    
+    def cancel(self, k):
+        """Cancel the processing of site k.
+        
+        The process processing the site is terminated and replaced with a new
+        one. The state of the worker is left as it was before the processing,
+        except that the iteration counter is incremented and the elapsed time
+        is stored as in Worker.tilted. The site parameter update arrays of the
+        site may contain garbage, see Worker.discard_tilted.
+        
+        """
+        for (conn, k_conn) in self.running.iteritems():
+            if k_conn == k:
+                break
+        else:
+            raise ValueError("Site {} is not being processed".format(k))
+        proc = self.procs.pop(conn)
+        proc.terminate()
+        proc.join()
+        conn.close()
+        self.sent_global.pop(conn, None)
+        worker = self.workers[k]
+        worker.iteration += 1
+        worker.last_time = timer() - self.started.pop(conn)
+        worker.phase = 0
+        del self.running[conn]
+        self._start_process()
+    
+    
+    def imap(self, sites, save_fit=False, timeout=None, timeout_mult=None,
+             prepare=None):
+        """Process the tilted distributions of the given sites.
+        
+        Returns an iterator yielding the index and the positive definiteness
+        indicator of each site in the order they finish. Sites processed
+        longer than the time limit are cancelled (see method cancel) and
+        yielded with None as the indicator.
+        
+        Parameters
+        ----------
+        sites : iterable of int
+            The indexes of the sites.
+        
+        save_fit : bool, optional
+            See Worker.tilted.
+        
+        timeout : float, optional
+            The time limit in seconds.
+        
+        timeout_mult : float, optional
+            The time limit as a multiple of the median sampling time of the
+            finished sites. Takes effect after half of the sites have finished.
+        
+        prepare : callable, optional
+            Called with the index of each site right before it is submitted,
+            e.g. for forming its cavity distribution, so that only the sites
+            being submitted hold it. If it returns False, the site is yielded
+            as not positive definite without processing. By default the
+            cavity distributions have to be formed before calling this method.
+        
+        """
+        sites = list(sites)
+        n_sites = len(sites)
+        sites.reverse()
+        # Sampling times of the finished sites
+        times = []
+        while sites or self.running:
+            while sites and self.idle:
+                k = sites.pop()
+                if prepare is not None and not prepare(k):
+                    yield k, False
+                    continue
+                self.submit(k, save_fit=save_fit)
+            # Current time limit
+            limit = timeout
+            if timeout_mult is not None and 2*len(times) >= n_sites:
+                limit_mult = timeout_mult * np.median(times)
+                if limit is None or limit_mult < limit:
+                    limit = limit_mult
+            if limit is None:
+                wait_time = None
+            else:
+                # Cancel the sites exceeding the limit
+                now = timer()
+                for (conn, k) in self.running.items():
+                    if now - self.started[conn] >= limit:
+                        self.cancel(k)
+                        yield k, None
+                if not self.running:
+                    continue
+                wait_time = limit - (now - min(self.started.itervalues()))
+                wait_time = max(wait_time, 0)
+            for (k, pos_def) in self.wait(wait_time):
+                times.append(self.workers[k].last_time)
+                yield k, pos_def
+    
+    
+    def close(self):
+        """Terminate the processes in the pool."""
+        for conn in self.idle:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for conn in self.running:
+            # Busy processes can not be stopped gracefully
+            self.procs[conn].terminate()
+        for (conn, proc) in self.procs.iteritems():
+            proc.join()
+            conn.close()
+        self.procs = {}
+        self.idle = []
+        self.running = {}
+        self.started = {}
+        self.sent_global = {}
+
+
+
+class SocketPool(object):
+    """Pool of site servers processing the tilted distributions.
+    
+    Each site is processed by the server holding its data (see module server).
+    A server processes one site at a time and the sites submitted while it is
+    busy are queued. The pool should be closed by calling the method close,
+    after which the servers wait for the next connection.
+    
+    Parameters
+    ----------
+    workers : list of Worker
+        The workers of the sites in the master. They hold the state of the
+        sites carried over the iterations, which is sent to the servers with
+        each task.
+    
+    addresses : list
+        The addresses of the servers, see server.parse_address.
+    
+    dQi, dri : ndarray
+        The output arrays for the site parameter updates. The last axis
+        indexes the sites.
+    
+    options : dict
+        The worker options used by the servers in creating their workers (see
+        Worker). Option `seed` is ignored, as the random number generator
+        states are sent with the tasks.
+    
+    authkey : str, optional
+        The authentication key of the servers. Required for TCP addresses.
+    
+    site_options : dict, optional
+        The options overriding `options` for individual sites, given as dicts
+        by the site index.
+    
+    """
+    
+    def __init__(self, workers, addresses, dQi, dri, options, authkey=None,
+                 site_options={}):
+        self.workers = workers
+        self.dQi = dQi
+        self.dri = dri
+        # Connections to the servers
+        self.conns = []
+        # The connection to the server of each site
+        self.site_conn = {}
+        # Tasks waiting for each busy server
+        self.queued = {}
+        # Site being processed for each connection to a busy server
+        self.running = {}
+        # The latest global approximation sent to each server
+        self.sent_global = {}
+        options = dict((kw, val) for (kw, val) in options.iteritems()
+                       if kw != 'seed')
+        try:
+            for address in addresses:
+                conn = Client(address, authkey=authkey)
+                self.conns.append(conn)
+                conn.send(('init', workers[0].dphi, dQi.shape[0], options,
+                           site_options))
+                sites = conn.recv()
+                if isinstance(sites, basestring):
+                    raise RuntimeError("Initialising server {} failed:\n{}"
+                                       .format(address, sites))
+                for k in sites:
+                    self.site_conn[k] = conn
+                self.queued[conn] = []
+            missing = set(xrange(len(workers))) - set(self.site_conn)
+            if missing:
+                raise ValueError("No server for sites {}"
+                                 .format(sorted(missing)))
+        except:
+            self.close()
+            raise
+    
+    
+    def submit(self, k, save_fit=False):
+        """Start or queue processing the tilted distribution of site k.
+        
+        The cavity distribution of the site has to be calculated before calling
+        this method (see Worker.cavity).
+        
+        """
+        worker = self.workers[k]
+        if worker.phase != 1:
+            raise RuntimeError('Cavity has to be calculated before tilted.')
+        conn = self.site_conn[k]
+        # Copy the cavity, as the task may be queued
+        glob = _global_to_send(self.sent_global, conn, worker.Q, worker.r)
+        task = ('tilted', k, glob, worker.Mat.copy(order='F'),
+                worker.vec.copy(), worker.get_state(), save_fit)
+        worker.release_cavity()
+        if conn in self.running:
+            self.queued[conn].append(task)
+        else:
+            conn.send(task)
+            self.running[conn] = k
+    
+    
+    def wait(self, timeout=None):
+        """Wait for the processing of at least one site to finish.
+        
+        The state of the workers of the finished sites and the site parameter
+        updates are updated accordingly.
+        
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time in seconds to wait. By default waits indefinitely.
+        
+        Returns
+        -------
+        list of (int, bool)
+            The index of each finished site and its positive definiteness
+            indicator, see Worker.tilted. Empty list if the timeout expired.
+        
+        """
+        if not self.running:
+            return []
+        ready, _, _ = select.select(list(self.running), [], [], timeout)
+        out = []
+        for conn in ready:
+            k, pos_def, state, fit, dQi, dri = conn.recv()
+            del self.running[conn]
+            if self.queued[conn]:
+                # Start the next queued task of the server
+                task = self.queued[conn].pop(0)
+                conn.send(task)
+                self.running[conn] = task[1]
+            if pos_def is None:
+                raise RuntimeError("Processing site {} failed:\n{}"
+                                   .format(k, state))
+            np.copyto(self.dQi[:,k], dQi)
+            np.copyto(self.dri[:,k], dri)
+            worker = self.workers[k]
+            worker.set_state(state)
+            worker.fit = fit
+            worker.phase = 2 if pos_def else 0
+            out.append((k, pos_def))
+        return out
+    
+    
+    def imap(self, sites, save_fit=False, timeout=None, timeout_mult=None,
+             prepare=None):
+        """Process the tilted distributions of the given sites.
+        
+        Returns an iterator yielding the index and the positive definiteness
+        indicator of each site in the order they finish. The time limits of
+        SitePool.imap are not supported, as the servers can not be cancelled.
+        The sites are submitted only when their server is idle, so that the
+        tasks are not queued, see SitePool.imap for `prepare`.
+        
+        """
+        if timeout is not None or timeout_mult is not None:
+            raise ValueError("Timeouts are not supported with site servers")
+        # Sites waiting for each server
+        pending = dict((conn, []) for conn in self.conns)
+        for k in sites:
+            pending[self.site_conn[k]].append(k)
+        while self.running or any(pending.itervalues()):
+            for (conn, waiting) in pending.iteritems():
+                while (waiting and conn not in self.running
+                       and not self.queued[conn]):
+                    k = waiting.pop(0)
+                    if prepare is not None and not prepare(k):
+                        yield k, False
+                        continue
+                    self.submit(k, save_fit=save_fit)
+            for (k, pos_def) in self.wait():
+                yield k, pos_def
+    
+    
+    def close(self):
+        """Close the connections to the servers."""
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        self.conns = []
+        self.site_conn = {}
+        self.queued = {}
+        self.running = {}
+        self.sent_global = {}
@@ -0,0 +1,274 @@
+"""A site server for processing the tilted distributions of the distributed EP
+algorithm on separate nodes.
+
+A server holds the data of one or more sites (shards) and the compiled Stan
+model. The master connects to the servers with backend 'socket' (see Master and
+pool.SocketPool) and sends them only the cavity distributions and the states
+of the sites. The servers send back the site parameter updates. The same
+servers can be used in several runs one after another.
+
+The servers can be started from the command line with:
+    $ python server.py <address> <model> <shard> [<shard> ...]
+
+where <address> is either 'host:port' for TCP or a path of a Unix socket,
+<model> is the Stan model file (see util.load_stan) and each <shard> is a site
+data file saved with save_shard. See `python server.py -h` for help.
+
+The protocol uses multiprocessing.connection. The master sends the messages:
+    ('init', dphi, len_dQi, options, site_options)
+        Initialise the workers of the sites with the given options, overridden
+        by the options in `site_options` by the site index. Replied with the
+        list of the site indexes held by the server.
+    ('tilted', k, glob, Mat, vec, state, save_fit)
+        Process the tilted distribution of site k with the given cavity
+        distribution and worker state (see Worker.set_cavity and
+        Worker.set_state). The global approximation `glob` is a tuple (Q, r),
+        or None if it has not changed since the previous task. Replied with
+        (k, pos_def, state, fit, dQi, dri).
+    None
+        Close the connection. The server waits for the next master.
+    ('shutdown',)
+        Stop the server.
+A task that can not be processed, e.g. one for a site the server does not hold
+or one sent before 'init', is replied with (k, None, message, None, None, None)
+and the server keeps serving.
+
+The messages are pickled, so unpickling a message from an untrusted peer can
+execute arbitrary code. The masters are therefore always authenticated with a
+shared key for TCP addresses: an authkey is mandatory for them and the servers
+refuse to start without one. Unix sockets are protected by the file
+permissions, for which the authkey is optional.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import argparse
+import traceback
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from method import Worker, WorkspacePool
+from util import load_stan
+
+
+def parse_address(address):
+    """Parse a server address string.
+    
+    Returns a tuple (host, port) for a string of form 'host:port', and the
+    string itself otherwise, which is then used as the path of a Unix socket.
+    
+    """
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+def save_shard(filename, k, X, y, A={}):
+    """Save the data of site k into a shard file for a server.
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file (numpy .npz format).
+    
+    k : int
+        The index of the site.
+    
+    X, y : ndarray
+        The data of the site.
+    
+    A : dict, optional
+        Additional data of the site, see Master args. `A`, `A_k` and `A_n`.
+    
+    """
+    for key in A:
+        if key in ('k', 'X', 'y'):
+            raise ValueError("Additional data name {} clashes.".format(key))
+    np.savez(filename, k=k, X=X, y=y, **A)
+
+
+def load_shard(filename):
+    """Load a shard file saved with save_shard.
+    
+    Returns
+    -------
+    k : int
+        The index of the site.
+    
+    X, y : ndarray
+        The data of the site.
+    
+    A : dict
+        Additional data of the site.
+    
+    """
+    with np.load(filename) as f:
+        k = int(f['k'])
+        X = f['X']
+        y = f['y']
+        A = dict((key, f[key]) for key in f.files
+                 if key not in ('k', 'X', 'y'))
+    # Scalars were saved as zero dimensional arrays
+    for (key, val) in A.iteritems():
+        if val.ndim == 0:
+            A[key] = val[()]
+    return k, X, y, A
+
+
+def shutdown(address, authkey=None):
+    """Stop the server at the given address."""
+    conn = Client(address, authkey=authkey)
+    try:
+        conn.send(('shutdown',))
+    finally:
+        conn.close()
+
+
+def serve(address, site_model, shards, authkey=None):
+    """Serve the tilted distributions of the given sites.
+    
+    Accepts connections from the masters one at a time until shut down (see
+    function shutdown).
+    
+    Parameters
+    ----------
+    address : str or tuple
+        The address to listen to, see parse_address.
+    
+    site_model : StanModel
+        The model for sampling from the tilted distributions.
+    
+    shards : dict
+        The data of the sites given as tuples (X, y, A) by the site index.
+    
+    authkey : str, optional
+        The authentication key required from the masters. Mandatory for TCP
+        addresses.
+    
+    """
+    if isinstance(address, tuple) and not authkey:
+        raise ValueError("An authkey is required for TCP addresses")
+    listener = Listener(address, authkey=authkey)
+    try:
+        running = True
+        while running:
+            conn = listener.accept()
+            try:
+                running = _serve_master(conn, site_model, shards)
+            except (EOFError, IOError):
+                # The master disconnected
+                pass
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+
+
+def _serve_master(conn, site_model, shards):
+    """Process the messages of one master connection.
+    
+    Returns False if the server was shut down, True otherwise.
+    
+    """
+    workers = {}
+    # The latest global approximation
+    Q = r = None
+    while True:
+        task = conn.recv()
+        if task is None:
+            return True
+        if not isinstance(task, tuple) or not task:
+            conn.send((None, None, "Unknown message {!r}".format(task),
+                       None, None, None))
+            continue
+        if task[0] == 'shutdown':
+            return False
+        if task[0] == 'init' and len(task) == 5:
+            _, dphi, len_dQi, options, site_options = task
+            try:
+                workers = {}
+                # The sites are processed one at a time
+                workspaces = WorkspacePool(dphi, options.get('phi_blocks'))
+                for (k, (X, y, A)) in shards.iteritems():
+                    worker_options = options.copy()
+                    worker_options.update(site_options.get(k, {}))
+                    # The state of the generator is set with each task
+                    worker_options['seed'] = np.random.RandomState()
+                    workers[k] = Worker(k, site_model, dphi, X, y, A=A,
+                                        workspaces=workspaces,
+                                        **worker_options)
+                # Output arrays for the site parameter updates
+                dQi = np.zeros(len_dQi)
+                dri = np.zeros(dphi)
+            except Exception:
+                workers = {}
+                conn.send(traceback.format_exc())
+            else:
+                conn.send(sorted(workers))
+        elif task[0] == 'tilted' and len(task) == 7:
+            _, k, glob, Mat, vec, state, save_fit = task
+            if glob is not None:
+                Q, r = glob
+            if k not in workers:
+                conn.send((k, None, "Site {} is not initialised on the server"
+                           .format(k), None, None, None))
+                continue
+            worker = workers[k]
+            try:
+                worker.set_state(state)
+                worker.set_cavity(Q, r, Mat, vec)
+                pos_def = worker.tilted(dQi, dri, save_fit=save_fit)
+            except Exception:
+                conn.send((k, None, traceback.format_exc(), None, None, None))
+            else:
+                conn.send((k, pos_def, worker.get_state(),
+                           worker.fit if save_fit else None, dQi, dri))
+                worker.fit = None
+            worker.release_cavity()
+        else:
+            conn.send((None, None, "Unknown message {!r}".format(task[0]),
+                       None, None, None))
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(
+        description="Serve the tilted distributions of the given sites for "
+                    "the distributed EP master (see Master arg. `servers`)."
+    )
+    parser.add_argument(
+        'address',
+        help="'host:port' for TCP or the path of a Unix socket"
+    )
+    parser.add_argument(
+        'model',
+        help="the Stan model file, see util.load_stan"
+    )
+    parser.add_argument(
+        'shards',
+        nargs='+',
+        help="the site data files, see save_shard"
+    )
+    parser.add_argument(
+        '--authkey',
+        help="the authentication key required from the master, mandatory "
+             "for TCP addresses"
+    )
+    args = parser.parse_args()
+    
+    shards = {}
+    for filename in args.shards:
+        k, X, y, A = load_shard(filename)
+        shards[k] = (X, y, A)
+    serve(parse_address(args.address), load_stan(args.model), shards,
+          authkey=args.authkey)
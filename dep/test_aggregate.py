@@ -0,0 +1,80 @@
+"""Sckript for testing the aggregation tree of the site sums, see
+aggregate.SumTree.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from aggregate import SumTree
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+n = 7                           # Length of the summed vectors
+Ks = [1, 2, 5, 16, 17, 100]     # Numbers of sites
+fanins = [2, 3, 8]              # Fan-ins of the trees
+N_upd = 10                      # Number of partial updates
+tol = 1e-10                     # Maximum allowed error
+
+
+errors = []
+pool = ThreadPool(3)
+
+for K in Ks:
+    for fanin in fanins:
+        A = np.asfortranarray(np.random.randn(n, K))
+        computed = []
+        def leaf_sum(sl):
+            computed.append(sl)
+            return np.sum(A[:,sl], axis=1)
+        tree = SumTree(n, K, fanin, leaf_sum)
+        # Full update
+        err = np.max(np.abs(tree.update() - np.sum(A, axis=1)))
+        # Partial updates with and without the output array and map function
+        n_extra = 0
+        out = np.empty(n)
+        for i in xrange(N_upd):
+            sites = np.random.choice(K, np.random.randint(1, min(K, 4)+1),
+                                     replace=False)
+            A[:,sites] = np.random.randn(n, len(sites))
+            del computed[:]
+            if i % 2 == 0:
+                total = tree.update(sites, out=out)
+                if total is not out:
+                    err = np.inf
+            else:
+                total = tree.update(sites, map_func=pool.map)
+            err = max(err, np.max(np.abs(total - np.sum(A, axis=1))))
+            # Only the leaves of the changed sites are recalculated
+            n_extra += len(computed) - len(np.unique(sites // fanin))
+        errors.append(('K={} fanin={}'.format(K, fanin), err))
+        errors.append(('K={} fanin={} leaves'.format(K, fanin), n_extra))
+
+pool.close()
+
+# Too small fan-in
+try:
+    SumTree(n, 4, 1, None)
+    errors.append(('fanin=1 raises', 1))
+except ValueError:
+    errors.append(('fanin=1 raises', 0))
+
+# Print results
+print ('{:30} {:>13}').format('test', 'max error')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
@@ -0,0 +1,110 @@
+"""Sckript for testing the asynchronous algorithm, see
+method.Master.run_async.
+
+The serial asynchronous run with zero staleness should reproduce the
+synchronous method run. The iterations of run_async start from the first
+global update, so they are compared to the iterations of run after the first
+one.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from pystan import StanModel
+
+from method import Master
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+K = 6                           # Number of sites
+nk = 20                         # Number of observations in each site
+d = 3                           # Dimension of phi
+niter = 4                       # Number of iterations
+stalenesses = [None, 1, 3]      # Staleness bounds tested
+tol = 1e-8                      # Maximum allowed error
+
+# Linear Gaussian model, phi as the only parameter
+model_code = """
+data {
+    int<lower=1> N;
+    int<lower=1> D;
+    matrix[N,D] X;
+    vector[N] y;
+    vector[D] mu_phi;
+    matrix[D,D] Omega_phi;
+}
+parameters {
+    vector[D] phi;
+}
+model {
+    phi ~ multi_normal_prec(mu_phi, Omega_phi);
+    y ~ normal(X * phi, 1);
+}
+"""
+
+phi_true = np.random.randn(d)
+X = np.random.randn(K*nk, d)
+y = X.dot(phi_true) + np.random.randn(K*nk)
+model = StanModel(model_code=model_code)
+options = dict(
+    site_sizes = np.repeat(nk, K),
+    dphi = d,
+    seed = 1,
+    chains = 2,
+    iter = 400,
+    df0 = 0.5
+)
+
+errors = []
+
+def check_state(name, master):
+    """Check the sampling times and the released cavity distributions."""
+    errors.append(('{} stimes'.format(name),
+                   np.count_nonzero(master.stimes <= 0)))
+    errors.append(('{} released cavities'.format(name),
+                   sum(worker.Mat is not None for worker in master.workers)))
+
+# Zero staleness against the synchronous algorithm
+master = Master(model, X, y, **options)
+m_phi, cov_phi, _ = master.run(niter + 1, verbose=False)
+master = Master(model, X, y, **options)
+m_phi_a, cov_phi_a, info = master.run_async(niter, staleness=0,
+                                            verbose=False)
+errors.append(('staleness=0 against run', max(
+    np.max(np.abs(m_phi_a - m_phi[1:])),
+    np.max(np.abs(cov_phi_a - cov_phi[1:])),
+    info
+)))
+errors.append(('staleness=0 lags',
+               max(max(lags) for lags in master.site_lags)))
+check_state('staleness=0', master)
+
+# Staleness bounds
+for staleness in stalenesses:
+    name = 'staleness={}'.format(staleness)
+    master = Master(model, X, y, **options)
+    _, _, info = master.run_async(niter, staleness=staleness, verbose=False)
+    errors.append((name, info))
+    if staleness is not None:
+        errors.append(('{} lags'.format(name), max(
+            max(max(lags) for lags in master.site_lags) - staleness, 0)))
+    check_state(name, master)
+
+# Print results
+print ('{:34} {:>13}').format('test', 'max error')
+print 48*'-'
+for (name, err) in errors:
+    print ('{:34} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
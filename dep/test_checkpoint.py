@@ -0,0 +1,110 @@
+"""Sckript for testing the checkpoints of the algorithm, see
+method.Master.save_checkpoint and method.Master.load_checkpoint.
+
+A run is interrupted after a checkpoint and resumed from it in a new object.
+The resumed run should reproduce the uninterrupted one.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import shutil
+import tempfile
+import numpy as np
+from pystan import StanModel
+
+from method import Master
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+K = 5                           # Number of sites
+nk = 20                         # Number of observations in each site
+d = 3                           # Dimension of phi
+niter = 6                       # Number of iterations
+n_ckpt = 3                      # Iteration of the checkpoint
+tol = 1e-10                     # Maximum allowed error
+
+# Options of the compared runs
+configs = [
+    ('all sites', {}),
+    ('random sites', dict(site_selection='random', n_sites=2)),
+    ('adapted draws', dict(target_rel_error=0.05)),
+]
+
+# Linear Gaussian model, phi as the only parameter
+model_code = """
+data {
+    int<lower=1> N;
+    int<lower=1> D;
+    matrix[N,D] X;
+    vector[N] y;
+    vector[D] mu_phi;
+    matrix[D,D] Omega_phi;
+}
+parameters {
+    vector[D] phi;
+}
+model {
+    phi ~ multi_normal_prec(mu_phi, Omega_phi);
+    y ~ normal(X * phi, 1);
+}
+"""
+
+phi_true = np.random.randn(d)
+X = np.random.randn(K*nk, d)
+y = X.dot(phi_true) + np.random.randn(K*nk)
+model = StanModel(model_code=model_code)
+options = dict(
+    site_sizes = np.repeat(nk, K),
+    dphi = d,
+    seed = 1,
+    chains = 2,
+    iter = 400,
+    df0 = 0.5
+)
+
+errors = []
+tmpdir = tempfile.mkdtemp()
+
+try:
+    for (name, config) in configs:
+        config.update(options)
+        path = os.path.join(tmpdir, name.replace(' ', '_'))
+        # Uninterrupted run
+        master = Master(model, X, y, **config)
+        m_phi, _, _ = master.run(niter, verbose=False)
+        Qi = master.Qi
+        # Interrupted after the checkpoint
+        master = Master(model, X, y, **config)
+        master.run(n_ckpt + 1, verbose=False, checkpoint_every=n_ckpt,
+                   checkpoint_path=path)
+        # Resumed
+        master = Master.from_checkpoint(path, model, X, y, **config)
+        m_phi_res, _, info = master.run(niter - n_ckpt, verbose=False)
+        errors.append((name, max(
+            np.max(np.abs(m_phi_res - m_phi[n_ckpt:])),
+            np.max(np.abs(master.Qi - Qi)),
+            abs(master.iter - niter),
+            info
+        )))
+finally:
+    shutil.rmtree(tmpdir)
+
+# Print results
+print ('{:30} {:>13}').format('test', 'max error')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
@@ -0,0 +1,130 @@
+"""Sckript for testing the exact damping factors, see
+method.Master.max_damping.
+
+The global and cavity precision matrices should be positive definite just
+below the solved damping factors and not positive definite just above them.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from scipy import linalg
+
+from method import Master
+from util import pack_triu, unpack_triu
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+N = 20                          # Number of random test cases
+K = 6                           # Number of sites
+d = 4                           # Dimension of phi
+blockings = [None, [1, 3]]      # Block diagonal structures tested
+cavity_chunk = 4                # Sites in each stacked part
+margin = 1e-3                   # Relative margin around the damping factors
+small = 0.01                    # Scale of the updates with feasible full steps
+tol = 0                         # Maximum allowed number of failures
+
+
+def random_prec(d):
+    """Generate a random positive definite matrix."""
+    A = np.random.randn(d, 2*d)
+    return A.dot(A.T) / (2*d) + 0.1*np.eye(d)
+
+def random_sym(d):
+    """Generate a random indefinite symmetric matrix."""
+    A = np.random.randn(d, d)
+    return A + A.T
+
+def pos_def(A):
+    """Check if a symmetric matrix is positive definite."""
+    try:
+        linalg.cholesky(A, lower=True)
+    except linalg.LinAlgError:
+        return False
+    return True
+
+def unpack(A, blocks):
+    """Unpack the packed matrices of the sites into full ones."""
+    return [unpack_triu(A[:,k], np.zeros((d,d), order='F'), blocks)
+            for k in xrange(A.shape[1])]
+
+def check_tight(df, Q, B):
+    """Check that the damping factor is tight for Q + df*B."""
+    if not np.isfinite(df):
+        # The update is positive semidefinite
+        return int(np.min(linalg.eigvalsh(B)) < -1e-12)
+    return int(not pos_def(Q + (1 - margin)*df*B)
+               or pos_def(Q + (1 + margin)*df*B))
+
+X = np.random.randn(K*5, d)
+y = np.random.randn(K*5)
+errors = []
+
+for blocks in blockings:
+    name = 'blocks={}'.format(blocks)
+    master = Master(None, X, y, site_sizes=np.repeat(5, K), dphi=d,
+                    phi_blocks=blocks, cavity_chunk=cavity_chunk)
+    Q0 = unpack_triu(master.Q0_packed, np.zeros((d,d), order='F'), blocks)
+    n_fail_glob = 0
+    n_fail_cav = 0
+    n_fail_full = 0
+    for i in xrange(N):
+        
+        # ----------------------------------------------------------------------
+        #     Random indefinite updates
+        # ----------------------------------------------------------------------
+        master.Qi[:] = np.column_stack(
+            [pack_triu(random_prec(d), blocks=blocks) for _ in xrange(K)])
+        master.dQi[:] = np.column_stack(
+            [pack_triu(random_sym(d), blocks=blocks) for _ in xrange(K)])
+        master.Qi_sum[:] = master.Qi.sum(1)
+        master.dQi_sum[:] = master.dQi.sum(1)
+        Qi = unpack(master.Qi, blocks)
+        dQi = unpack(master.dQi, blocks)
+        Q = Q0 + sum(Qi)
+        B = sum(dQi)
+        df_glob, df_cav = master.max_damping()
+        n_fail_glob += check_tight(df_glob, Q, B)
+        for k in xrange(K):
+            n_fail_cav += check_tight(df_cav[k], Q - Qi[k], B - dQi[k])
+        # Subset of the sites
+        sites = np.sort(np.random.choice(K, K//2, replace=False))
+        _, df_sub = master.max_damping(sites=sites)
+        n_fail_cav += np.count_nonzero(df_sub != df_cav[sites])
+        
+        # ----------------------------------------------------------------------
+        #     Small updates, the full step is feasible
+        # ----------------------------------------------------------------------
+        master.dQi *= small
+        master.dQi_sum *= small
+        df_glob, df_cav = master.max_damping()
+        if (    df_glob <= 1 or np.any(df_cav <= 1)
+             or not pos_def(Q + small*B)
+             or not all(pos_def(Q - Qi[k] + small*(B - dQi[k]))
+                        for k in xrange(K))
+           ):
+            n_fail_full += 1
+    
+    errors.append(('{} global'.format(name), n_fail_glob))
+    errors.append(('{} cavities'.format(name), n_fail_cav))
+    errors.append(('{} full step'.format(name), n_fail_full))
+
+# Print results
+print 'Results of {} random cases'.format(N)
+print ('{:30} {:>13}').format('test', 'failures')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13} {}').format(name, err,
+                                     'ok' if err <= tol else 'FAIL')
@@ -0,0 +1,120 @@
+"""Sckript for testing the iteration history streamed on disk, see
+history.History and history.load_history.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from history import History, load_history
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+niter = 10                      # Number of iterations
+dphi = 4                        # Dimension of the approximation
+n_part = 4                      # Iterations recorded before the partial load
+tol = 0                         # Maximum allowed error
+
+
+def random_cov(d):
+    """Generate a random covariance matrix in F-order."""
+    A = np.random.randn(d, 2*d)
+    return np.asfortranarray(A.dot(A.T) / (2*d) + 0.1*np.eye(d))
+
+def max_diff(a, b):
+    """Maximum absolute difference, infinite if the shapes differ."""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if a.shape != b.shape:
+        return np.inf
+    if a.size == 0:
+        return 0.0
+    return np.max(np.abs(a - b))
+
+errors = []
+tmpdir = tempfile.mkdtemp()
+
+try:
+    for form in ('full', 'diag'):
+        for every in (1, 3):
+            name = '{} every={}'.format(form, every)
+            path = os.path.join(tmpdir, '{}_{}'.format(form, every))
+            m = np.random.randn(niter, dphi)
+            S = [random_cov(dphi) for _ in xrange(niter)]
+            hist_mem = History(niter, dphi, form=form, every=every)
+            hist = History(niter, dphi, form=form, every=every, path=path)
+            # Reference
+            iters_ref = np.array([i for i in xrange(niter)
+                                  if (i+1) % every == 0 or i == niter-1])
+            m_ref = m[iters_ref]
+            if form == 'full':
+                cov_ref = np.array([S[i] for i in iters_ref])
+            else:
+                cov_ref = np.array([np.diag(S[i]) for i in iters_ref])
+            for i in xrange(niter):
+                hist_mem.record(i, m[i], S[i])
+                hist.record(i, m[i], S[i])
+                if i == n_part - 1:
+                    # Load while still running
+                    n_rec = np.count_nonzero(iters_ref < n_part)
+                    m_phi, cov_phi, iters = load_history(path)
+                    errors.append(('{} partial'.format(name), max(
+                        max_diff(m_phi, m_ref[:n_rec]),
+                        max_diff(cov_phi, cov_ref[:n_rec]),
+                        max_diff(iters, iters_ref[:n_rec])
+                    )))
+            m_phi, cov_phi = hist.result()
+            hist.close()
+            # Streamed result and the in-memory history
+            m_mem, cov_mem = hist_mem.result()
+            errors.append(('{} result'.format(name), max(
+                max_diff(m_phi, m_ref), max_diff(cov_phi, cov_ref),
+                max_diff(m_mem, m_ref), max_diff(cov_mem, cov_ref)
+            )))
+            # Round trip after closing
+            m_phi, cov_phi, iters = load_history(path)
+            errors.append(('{} load_history'.format(name), max(
+                max_diff(m_phi, m_ref), max_diff(cov_phi, cov_ref),
+                max_diff(iters, iters_ref)
+            )))
+            # Iterations before n
+            m_phi, cov_phi = hist.result(n=n_part)
+            m_mem, cov_mem = hist_mem.result(n=n_part)
+            errors.append(('{} result(n)'.format(name), max(
+                max_diff(m_phi, m_mem), max_diff(cov_phi, cov_mem)
+            )))
+            # An incompletely written record is not included
+            with open(os.path.join(path, 'm_phi.dat'), 'ab') as f:
+                f.write(np.zeros(dphi).tostring())
+            with open(os.path.join(path, 'cov_phi.dat'), 'ab') as f:
+                f.write(np.zeros(1).tostring())
+            m_phi, cov_phi, iters = load_history(path)
+            errors.append(('{} incomplete record'.format(name), max(
+                max_diff(m_phi, m_ref), max_diff(cov_phi, cov_ref),
+                max_diff(iters, iters_ref)
+            )))
+            del m_phi, cov_phi
+finally:
+    shutil.rmtree(tmpdir)
+
+# Print results
+print ('{:30} {:>13}').format('test', 'max error')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
@@ -0,0 +1,119 @@
+"""Sckript for testing the low rank site approximations, see
+util.lowrank_compress and util.lowrank_capacitance.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from scipy import linalg
+
+from util import lowrank_factors, lowrank_compress, lowrank_capacitance
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+N = 200                         # Number of random test cases
+d = 8                           # Dimension of the matrices
+m = 6                           # Number of factors in the input
+rank = 3                        # Rank of the compressed matrices
+tol = 1e-8                      # Maximum allowed relative error
+
+
+def random_prec(d):
+    """Generate a random positive definite matrix."""
+    A = np.random.randn(d, 2*d)
+    return A.dot(A.T) / (2*d) + 0.1*np.eye(d)
+
+def rel_error(A, A_ref):
+    """Relative error in the maximum norm."""
+    return np.max(np.abs(A - A_ref)) / max(np.max(np.abs(A_ref)), 1.0)
+
+err_compress = 0.0
+err_compress_exact = 0.0
+err_factors = 0.0
+err_inverse = 0.0
+err_mean = 0.0
+n_pos_def = 0
+n_mismatch = 0
+
+for i in xrange(N):
+    
+    # --------------------------------------------------------------------------
+    #     Compression against the truncated eigendecomposition
+    # --------------------------------------------------------------------------
+    U = np.random.randn(d, m)
+    w = np.random.randn(m)
+    A = (U*w).dot(U.T)
+    lam, V = linalg.eigh(A)
+    ind = np.argsort(-np.abs(lam), kind='mergesort')[:rank]
+    A_trunc = (V[:,ind]*lam[ind]).dot(V[:,ind].T)
+    U_c, w_c = lowrank_compress(U, w, rank)
+    err_compress = max(err_compress,
+                       rel_error((U_c*w_c).dot(U_c.T), A_trunc))
+    # Orthonormal factors
+    err_factors = max(err_factors,
+                      np.max(np.abs(U_c.T.dot(U_c) - np.eye(rank))))
+    # Exact if the rank is not reduced
+    U_e, w_e = lowrank_compress(U[:,:rank], w[:rank], rank)
+    A_e = (U[:,:rank]*w[:rank]).dot(U[:,:rank].T)
+    err_compress_exact = max(err_compress_exact,
+                             rel_error((U_e*w_e).dot(U_e.T), A_e))
+    
+    # --------------------------------------------------------------------------
+    #     Woodbury cavity against the dense inverse
+    # --------------------------------------------------------------------------
+    Q = random_prec(d)
+    # Packed factors as stored for the sites, scaled so that about half of
+    # the cavities are positive definite
+    a = np.empty((d+1)*rank)
+    U_s, w_s = lowrank_factors(a, d)
+    U_s[...] = np.random.randn(d, rank)
+    w_s[...] = np.abs(np.random.randn(rank)) * 0.06
+    C = Q - (U_s*w_s).dot(U_s.T)
+    L = linalg.cholesky(Q, lower=True)
+    mu, B = lowrank_capacitance(L, U_s, w_s)
+    try:
+        linalg.cholesky(C, lower=True)
+        pos_def = True
+    except linalg.LinAlgError:
+        pos_def = False
+    if pos_def != (mu[-1] < 1):
+        n_mismatch += 1
+    if not pos_def:
+        continue
+    n_pos_def += 1
+    Linv = linalg.solve_triangular(L, np.eye(d), lower=True)
+    S = Linv.T.dot(np.eye(d) + (B*(mu/(1-mu))).dot(B.T)).dot(Linv)
+    err_inverse = max(err_inverse, rel_error(S, linalg.inv(C)))
+    # Mean with triangular solves as in Master._cavities_lowrank
+    v = np.random.randn(d)
+    x = linalg.solve_triangular(L, v, lower=True)
+    x += B.dot(mu / (1 - mu) * B.T.dot(x))
+    x = linalg.solve_triangular(L, x, lower=True, trans='T')
+    err_mean = max(err_mean, rel_error(x, linalg.solve(C, v)))
+
+# Print results
+print 'Results of {} random cases ({} cavities positive definite)' \
+      .format(N, n_pos_def)
+print ('{:34} {:>13}').format('test', 'max error')
+print 48*'-'
+for (name, err) in (
+        ('lowrank_compress truncation', err_compress),
+        ('lowrank_compress orthonormality', err_factors),
+        ('lowrank_compress full rank', err_compress_exact),
+        ('Woodbury cavity covariance', err_inverse),
+        ('Woodbury cavity mean', err_mean),
+        ('positive definiteness mismatches', n_mismatch)):
+    print ('{:34} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
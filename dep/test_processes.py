@@ -0,0 +1,99 @@
+"""Sckript for testing the reproducibility of the parallel backends, see the
+backend 'processes' and the argument `n_threads` of method.Master.
+
+Each site has its own random number generator, so the results should not
+depend on how the sites are processed. The threads sum the site parameters
+in a different order, so the results are compared with a tolerance.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from pystan import StanModel
+
+from method import Master
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+K = 6                           # Number of sites
+nk = 20                         # Number of observations in each site
+d = 3                           # Dimension of phi
+niter = 4                       # Number of iterations
+tol = 1e-10                     # Maximum allowed error
+
+# Configurations compared to the serial one
+configs = [
+    ('processes n_jobs=1', dict(backend='processes', n_jobs=1)),
+    ('processes n_jobs=3', dict(backend='processes', n_jobs=3)),
+    ('serial n_threads=3', dict(n_threads=3)),
+    ('processes n_jobs=3 n_threads=3',
+     dict(backend='processes', n_jobs=3, n_threads=3)),
+]
+
+# Linear Gaussian model, phi as the only parameter
+model_code = """
+data {
+    int<lower=1> N;
+    int<lower=1> D;
+    matrix[N,D] X;
+    vector[N] y;
+    vector[D] mu_phi;
+    matrix[D,D] Omega_phi;
+}
+parameters {
+    vector[D] phi;
+}
+model {
+    phi ~ multi_normal_prec(mu_phi, Omega_phi);
+    y ~ normal(X * phi, 1);
+}
+"""
+
+phi_true = np.random.randn(d)
+X = np.random.randn(K*nk, d)
+y = X.dot(phi_true) + np.random.randn(K*nk)
+model = StanModel(model_code=model_code)
+options = dict(
+    site_sizes = np.repeat(nk, K),
+    dphi = d,
+    seed = 1,
+    chains = 2,
+    iter = 400,
+    df0 = 0.5
+)
+
+# Serial reference
+master = Master(model, X, y, **options)
+m_phi, cov_phi, _ = master.run(niter, verbose=False)
+Qi = master.Qi
+
+errors = []
+for (name, config) in configs:
+    config.update(options)
+    master = Master(model, X, y, **config)
+    m_phi_p, cov_phi_p, info = master.run(niter, verbose=False)
+    errors.append((name, max(
+        np.max(np.abs(m_phi_p - m_phi)),
+        np.max(np.abs(cov_phi_p - cov_phi)),
+        np.max(np.abs(master.Qi - Qi)),
+        info
+    )))
+
+# Print results
+print ('{:34} {:>13}').format('test', 'max error')
+print 48*'-'
+for (name, err) in errors:
+    print ('{:34} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
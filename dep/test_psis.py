@@ -0,0 +1,117 @@
+"""Sckript for testing the Pareto smoothed importance sampling and the
+effective sample size estimates, see util.psislw, util._gpdfit and
+util.effective_sample_size.
+
+The estimates are random, so they are compared to the known values with a
+statistical tolerance.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+
+from util import psislw, _gpdfit, effective_sample_size
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+N_rep = 20                      # Number of repetitions of each estimate
+n_gpd = 4000                    # Number of generalised Pareto samples
+ks = [0.2, 0.5, 0.9]            # Shape parameters of the heavy tails
+n_chain = 2000                  # Length of each AR(1) chain
+nchains = 4                     # Number of AR(1) chains
+rhos = [0.0, 0.5, 0.9]          # Autocorrelations of the AR(1) chains
+tol_k = 0.1                     # Maximum allowed error in k
+tol_ess = 0.15                  # Maximum allowed relative error in n_eff
+tol = 1e-10                     # Maximum allowed numerical error
+
+
+def rgpd(k, sigma, n):
+    """Sample from the generalised Pareto distribution."""
+    return sigma * np.expm1(-k * np.log(np.random.rand(n))) / k
+
+def ar1(rho, n, nchains, nparam=1):
+    """Sample AR(1) chains with unit marginal variance one after another."""
+    e = np.random.randn(nchains, n, nparam) * np.sqrt(1 - rho**2)
+    x = np.empty_like(e)
+    x[:,0] = np.random.randn(nchains, nparam)
+    for t in xrange(1, n):
+        x[:,t] = rho * x[:,t-1] + e[:,t]
+    return x.reshape((nchains*n, nparam))
+
+results = []
+errors = []
+
+# ------------------------------------------------------------------------------
+#     Pareto shape
+# ------------------------------------------------------------------------------
+for k in ks:
+    # Direct fit to the generalised Pareto samples
+    k_gpd = np.mean([_gpdfit(np.sort(rgpd(k, 1.0, n_gpd)))[0]
+                     for _ in xrange(N_rep)])
+    results.append(('_gpdfit k={}'.format(k), k_gpd, k,
+                    abs(k_gpd - k), tol_k))
+    # The tail of the generalised Pareto distribution is again generalised
+    # Pareto with the same shape, so the log weights have a known tail
+    k_psis = np.mean([psislw(np.log(rgpd(k, 1.0, n_gpd)))[1]
+                      for _ in xrange(N_rep)])
+    results.append(('psislw k={}'.format(k), k_psis, k,
+                    abs(k_psis - k), tol_k))
+
+# Normalisation and in-place operation
+lw = np.log(rgpd(0.5, 1.0, n_gpd))
+lw_out, k_out = psislw(lw)
+errors.append(('psislw normalisation',
+               abs(np.log(np.sum(np.exp(lw_out))))))
+# The smoothing preserves the order of the weights
+errors.append(('psislw order',
+               max(-np.min(np.diff(lw_out[np.argsort(lw)])), 0)))
+lw_in = lw.copy()
+_, k_in = psislw(lw_in, out=lw_in)
+errors.append(('psislw in place',
+               max(np.max(np.abs(lw_in - lw_out)), abs(k_in - k_out))))
+
+# ------------------------------------------------------------------------------
+#     Effective sample size
+# ------------------------------------------------------------------------------
+for rho in rhos:
+    n_eff_ref = nchains * n_chain * (1 - rho) / (1 + rho)
+    n_eff = np.mean([effective_sample_size(ar1(rho, n_chain, nchains),
+                                           nchains)[0]
+                     for _ in xrange(N_rep)])
+    results.append(('effective_sample_size rho={}'.format(rho),
+                    n_eff, n_eff_ref, abs(n_eff / n_eff_ref - 1), tol_ess))
+
+# Parameters are handled independently
+samp = ar1(0.5, n_chain, nchains, nparam=3)
+n_eff = effective_sample_size(samp, nchains)
+errors.append(('effective_sample_size columns',
+               np.max(np.abs(n_eff - [
+                   effective_sample_size(samp[:,i:i+1], nchains)[0]
+                   for i in xrange(3)]))))
+
+# Print results
+print 'Averages of {} repetitions'.format(N_rep)
+print ('{:32} {:>10} {:>10} {:>10}').format(
+    'test', 'estimate', 'true', 'error')
+print 66*'-'
+for (name, est, ref, err, t) in results:
+    print ('{:32} {:>10.4g} {:>10.4g} {:>10.3g} {}').format(
+        name, est, ref, err, 'ok' if err <= t else 'FAIL')
+print
+print ('{:32} {:>13}').format('test', 'max error')
+print 46*'-'
+for (name, err) in errors:
+    print ('{:32} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
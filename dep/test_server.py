@@ -0,0 +1,164 @@
+"""Sckript for testing the site servers, see server.serve and the backend
+'socket' of method.Master.
+
+Two servers holding different sites are started in threads on local Unix
+sockets. The runs using the servers should reproduce the serial runs. The
+servers should reply with an error to a task of a site they do not hold and
+stop cleanly when shut down.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import shutil
+import tempfile
+import time
+import threading
+from multiprocessing.connection import Client
+import numpy as np
+from pystan import StanModel
+
+from method import Master
+from server import serve, shutdown
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+K = 5                           # Number of sites
+nk = 20                         # Number of observations in each site
+d = 3                           # Dimension of phi
+niter = 4                       # Number of iterations
+site_groups = [[0, 1, 2], [3, 4]]   # Sites held by each server
+tol = 1e-10                     # Maximum allowed error
+
+# Linear Gaussian model, phi as the only parameter
+model_code = """
+data {
+    int<lower=1> N;
+    int<lower=1> D;
+    matrix[N,D] X;
+    vector[N] y;
+    vector[D] mu_phi;
+    matrix[D,D] Omega_phi;
+}
+parameters {
+    vector[D] phi;
+}
+model {
+    phi ~ multi_normal_prec(mu_phi, Omega_phi);
+    y ~ normal(X * phi, 1);
+}
+"""
+
+phi_true = np.random.randn(d)
+X = np.random.randn(K*nk, d)
+y = X.dot(phi_true) + np.random.randn(K*nk)
+model = StanModel(model_code=model_code)
+options = dict(
+    site_sizes = np.repeat(nk, K),
+    dphi = d,
+    seed = 1,
+    chains = 2,
+    iter = 400,
+    df0 = 0.5
+)
+
+errors = []
+tmpdir = tempfile.mkdtemp()
+addresses = [os.path.join(tmpdir, 'server{}.sock'.format(i))
+             for i in xrange(len(site_groups))]
+threads = []
+
+try:
+    # Start the servers
+    for (address, group) in zip(addresses, site_groups):
+        shards = dict(
+            (k, (X[k*nk:(k+1)*nk], y[k*nk:(k+1)*nk], {})) for k in group)
+        thread = threading.Thread(target=serve,
+                                  args=(address, model, shards))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Wait for the servers to listen
+    for address in addresses:
+        for _ in xrange(100):
+            if os.path.exists(address):
+                break
+            time.sleep(0.05)
+    
+    # Serial run
+    master = Master(model, X, y, **options)
+    m_phi, cov_phi, _ = master.run(niter, verbose=False)
+    
+    # Runs with the servers, the data held only by the servers
+    master = Master(model, None, None, backend='socket', servers=addresses,
+                    **options)
+    m_phi_s, cov_phi_s, info = master.run(niter, verbose=False)
+    errors.append(('run', max(
+        np.max(np.abs(m_phi_s - m_phi)),
+        np.max(np.abs(cov_phi_s - cov_phi)),
+        info
+    )))
+    # The same servers in a continued run and in an asynchronous run
+    m_phi_s, cov_phi_s, info = master.run(niter, verbose=False)
+    master = Master(model, X, y, **options)
+    master.run(niter, verbose=False)
+    m_phi, cov_phi, _ = master.run(niter, verbose=False)
+    errors.append(('continued run', max(
+        np.max(np.abs(m_phi_s - m_phi)),
+        np.max(np.abs(cov_phi_s - cov_phi)),
+        info
+    )))
+    master = Master(model, None, None, backend='socket', servers=addresses,
+                    **options)
+    _, _, info = master.run_async(niter, staleness=1, verbose=False)
+    errors.append(('run_async', max(
+        max(max(lags) for lags in master.site_lags) - 1, 0, info)))
+    
+    # Error replies
+    conn = Client(addresses[0])
+    try:
+        conn.send(('tilted', 0, None, None, None, None, False))
+        reply = conn.recv()
+        errors.append(('tilted before init', int(
+            reply[0] != 0 or reply[1] is not None
+            or not isinstance(reply[2], str))))
+        conn.send(('init', d, d*(d+1)//2, {}, {}))
+        reply = conn.recv()
+        errors.append(('init', int(reply != site_groups[0])))
+        k = site_groups[1][0]
+        conn.send(('tilted', k, None, None, None, None, False))
+        reply = conn.recv()
+        errors.append(('site not held', int(
+            reply[0] != k or reply[1] is not None
+            or not isinstance(reply[2], str))))
+        conn.send(None)
+    finally:
+        conn.close()
+    
+finally:
+    # Shut down the servers
+    for (address, thread) in zip(addresses, threads):
+        if thread.is_alive():
+            shutdown(address)
+        thread.join(10)
+    errors.append(('shutdown', sum(thread.is_alive() for thread in threads)))
+    shutil.rmtree(tmpdir)
+
+# Print results
+print ('{:30} {:>13}').format('test', 'max error')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
@@ -0,0 +1,119 @@
+"""Sckript for testing the packed storage and the stacked Cholesky
+factorisation of the site precision matrices, see util.pack_triu,
+util.unpack_triu, util.cho_factor_stacked and util.cho_solve_stacked.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from scipy import linalg
+
+from util import (
+    pack_triu,
+    unpack_triu,
+    cho_factor_stacked,
+    cho_solve_stacked
+)
+
+
+# ------------------------------------------------------------------------------
+#     Configurations
+# ------------------------------------------------------------------------------
+np.random.seed(0)               # Seed
+K = 50                          # Number of stacked matrices
+d = 6                           # Dimension of the matrices
+blocks = [2, 3, 1]              # Diagonal blocks for the block packing
+n_fail = 5                      # Number of not positive definite matrices
+tol = 1e-10                     # Maximum allowed error
+
+
+def random_prec(d):
+    """Generate a random positive definite matrix."""
+    A = np.random.randn(d, 2*d)
+    return A.dot(A.T) / (2*d) + 0.1*np.eye(d)
+
+def block_diag_part(A, blocks):
+    """The diagonal blocks of stacked matrices of shape (d,d,K)."""
+    out = np.zeros_like(A)
+    lims = np.concatenate(([0], np.cumsum(blocks)))
+    for i in xrange(len(blocks)):
+        sl = slice(lims[i], lims[i+1])
+        out[sl,sl] = A[sl,sl]
+    return out
+
+errors = []
+
+# ------------------------------------------------------------------------------
+#     Packed upper triangulars
+# ------------------------------------------------------------------------------
+A = np.empty((d,d,K), order='F')
+for k in xrange(K):
+    A[:,:,k] = random_prec(d)
+a = pack_triu(A)
+A_rec = unpack_triu(a, np.zeros((d,d,K), order='F'))
+errors.append(('pack_triu round trip', np.max(np.abs(A_rec - A))))
+errors.append(('packed length', abs(a.shape[0] - d*(d+1)//2)))
+a_b = pack_triu(A, blocks=blocks)
+A_rec = unpack_triu(a_b, np.zeros((d,d,K), order='F'), blocks=blocks)
+errors.append(('block pack_triu round trip',
+               np.max(np.abs(A_rec - block_diag_part(A, blocks)))))
+# Packing the unpacked matrices gives the same elements
+errors.append(('unpack_triu round trip',
+               np.max(np.abs(pack_triu(unpack_triu(
+                   a, np.zeros((d,d,K), order='F'))) - a))))
+
+# ------------------------------------------------------------------------------
+#     Stacked Cholesky factorisation
+# ------------------------------------------------------------------------------
+S = np.ascontiguousarray(A.T)
+fail = np.random.choice(K, n_fail, replace=False)
+for k in fail:
+    # Negative eigenvalue
+    w, V = linalg.eigh(S[k])
+    w[0] = -0.5
+    S[k] = (V*w).dot(V.T)
+b = np.random.randn(K,d)
+
+L, pos_def = cho_factor_stacked(S)
+expected = np.ones(K, dtype=bool)
+expected[fail] = False
+errors.append(('pos_def indicators',
+               np.count_nonzero(pos_def != expected)))
+ok = np.nonzero(expected)[0]
+x = cho_solve_stacked(L[ok], b[ok])
+max_L = 0.0
+max_x = 0.0
+for (i, k) in enumerate(ok):
+    c = linalg.cho_factor(S[k], lower=True)
+    L_ref = np.tril(c[0])
+    max_L = max(max_L, np.max(np.abs(L[k] - L_ref)))
+    x_ref = linalg.cho_solve(c, b[k])
+    max_x = max(max_x, np.max(np.abs(x[i] - x_ref)))
+errors.append(('cho_factor_stacked', max_L))
+errors.append(('cho_solve_stacked', max_x))
+
+# All positive definite (the stacked LAPACK path) in place
+S_ok = S[ok].copy()
+L_ok, pos_def = cho_factor_stacked(S_ok, out=S_ok)
+max_L = 0.0
+for (i, k) in enumerate(ok):
+    L_ref = np.tril(linalg.cho_factor(S[k], lower=True)[0])
+    max_L = max(max_L, np.max(np.abs(L_ok[i] - L_ref)))
+errors.append(('cho_factor_stacked in place', max_L))
+errors.append(('pos_def all', np.count_nonzero(~pos_def)))
+
+# Print results
+print ('{:30} {:>13}').format('test', 'max error')
+print 44*'-'
+for (name, err) in errors:
+    print ('{:30} {:>13.3g} {}').format(name, err,
+                                        'ok' if err <= tol else 'FAIL')
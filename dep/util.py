@@ -13,9 +13,12 @@ https://github.com/gelman/ep-stan
 
 from __future__ import division
 import os
+import re
+import mmap
 import pickle
 import numpy as np
 from scipy import linalg
+import pystan
 from pystan import StanModel
 
 from cython_util import (
@@ -32,8 +35,12 @@ dpotri_routine = linalg.get_lapack_funcs('potri')
 # Precalculated constant
 _LOG_2PI = np.log(2*np.pi)
 
+# Cache for the packed upper triangular indexes, see packed_triu_indices
+_TRIU_INDICES = {}
 
-def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False):
+
+def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False,
+                         blocks=None):
     """Invert moment parameters into natural parameters or vice versa.
     
     Switch between moment parameters (S,m) and natural parameters (Q,r) of
@@ -58,6 +65,11 @@ def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False):
     cho_form : bool
         If True, `A` is assumed to be the upper Cholesky of the real S or Q.
     
+    blocks : sequence of int, optional
+        If given, `A` is block diagonal with consecutive diagonal blocks of the
+        given sizes and it is inverted block by block. The elements outside the
+        blocks are not touched (see block_slices).
+    
     Returns
     -------
     out_A, out_b : ndarray
@@ -92,6 +104,17 @@ def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False):
     else:
         out_b = None
     
+    if blocks is not None:
+        # Invert each diagonal block separately
+        for sl in block_slices(out_A.shape[0], blocks):
+            A_b = out_A[sl,sl].copy(order='F')
+            invert_normal_params(
+                A_b, None if out_b is None else out_b[sl],
+                out_A='in-place', out_b='in-place', cho_form=cho_form
+            )
+            out_A[sl,sl] = A_b
+        return out_A, out_b
+    
     # Invert
     if not cho_form:
         cho = linalg.cho_factor(out_A, overwrite_a=True)
@@ -110,6 +133,375 @@ def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False):
     return out_A, out_b
 
 
+def block_slices(d, blocks=None):
+    """Slices of the consecutive diagonal blocks of a square matrix.
+    
+    Parameters
+    ----------
+    d : int
+        The size of the matrix.
+    
+    blocks : sequence of int, optional
+        The sizes of the blocks, summing up to `d`. If not provided, the whole
+        matrix is one block.
+    
+    Returns
+    -------
+    list of slice
+        The index range of each block.
+    
+    """
+    if blocks is None:
+        return [slice(0, d)]
+    if any(b < 1 for b in blocks) or sum(blocks) != d:
+        raise ValueError("The block sizes should be positive and sum up to "
+                         "{}".format(d))
+    lims = np.concatenate(([0], np.cumsum(blocks)))
+    return [slice(lims[i], lims[i+1]) for i in xrange(len(blocks))]
+
+
+def packed_triu_indices(d, blocks=None):
+    """Indexes of the upper triangular elements of a square matrix.
+    
+    The indexes are in the order used in ravel_triu and unravel_triu, i.e.
+    row by row. The index arrays are cached and shared between the callers, so
+    they should not be modified.
+    
+    Parameters
+    ----------
+    d : int
+        The size of the matrix.
+    
+    blocks : sequence of int, optional
+        If given, only the upper triangular elements inside the consecutive
+        diagonal blocks of the given sizes are included (see block_slices).
+    
+    Returns
+    -------
+    (ndarray, ndarray)
+        The row and column indexes of the d+1 choose 2 elements, or of the
+        b+1 choose 2 elements of each block b.
+    
+    """
+    key = (d, None if blocks is None else tuple(blocks))
+    try:
+        return _TRIU_INDICES[key]
+    except KeyError:
+        if blocks is None:
+            iu = np.triu_indices(d)
+        else:
+            rows = []
+            cols = []
+            for sl in block_slices(d, blocks):
+                iu_b = np.triu_indices(sl.stop - sl.start)
+                rows.append(iu_b[0] + sl.start)
+                cols.append(iu_b[1] + sl.start)
+            iu = (np.concatenate(rows), np.concatenate(cols))
+        _TRIU_INDICES[key] = iu
+        return iu
+
+
+def pack_triu(A, out=None, blocks=None):
+    """Extract the upper triangulars of stacked symmetric matrices.
+    
+    Parameters
+    ----------
+    A : ndarray
+        Array of shape (d,d,...).
+    
+    out : ndarray, optional
+        The output array of shape (d+1 choose 2,...).
+    
+    blocks : sequence of int, optional
+        If given, only the diagonal blocks of the given sizes are extracted,
+        see packed_triu_indices.
+    
+    Returns
+    -------
+    ndarray
+        The upper triangular elements in the order of ravel_triu.
+    
+    """
+    iu = packed_triu_indices(A.shape[0], blocks)
+    if out is None:
+        return A[iu]
+    out[...] = A[iu]
+    return out
+
+
+def unpack_triu(a, out, blocks=None):
+    """Form stacked symmetric matrices from packed upper triangulars.
+    
+    Parameters
+    ----------
+    a : ndarray
+        Array of shape (d+1 choose 2,...) of the upper triangular elements in
+        the order of ravel_triu, see pack_triu.
+    
+    out : ndarray
+        The output array of shape (d,d,...).
+    
+    blocks : sequence of int, optional
+        If given, `a` contains only the diagonal blocks of the given sizes,
+        see packed_triu_indices. The elements of `out` outside the blocks are
+        not touched.
+    
+    Returns
+    -------
+    ndarray
+        The output array `out`.
+    
+    """
+    iu = packed_triu_indices(out.shape[0], blocks)
+    out[iu] = a
+    out[iu[1],iu[0]] = a
+    return out
+
+
+def cho_factor_blocks(A, blocks=None):
+    """Cholesky factorisation of a block diagonal matrix in place.
+    
+    Each diagonal block of `A` is replaced by its upper Cholesky factor as in
+    scipy.linalg.cho_factor. The elements outside the blocks are not touched.
+    
+    Parameters
+    ----------
+    A : ndarray
+        Symmetric matrix of shape (d,d) in F-order.
+    
+    blocks : sequence of int, optional
+        The sizes of the consecutive diagonal blocks, see block_slices. If not
+        provided, the whole matrix is factorised.
+    
+    Returns
+    -------
+    A : ndarray
+        The input array.
+    
+    Raises
+    ------
+    LinAlgError
+        If some of the blocks is not positive definite.
+    
+    """
+    for sl in block_slices(A.shape[0], blocks):
+        A_b = A[sl,sl]
+        c, _ = linalg.cho_factor(A_b, overwrite_a=True)
+        if not np.may_share_memory(c, A_b):
+            A_b[...] = c
+    return A
+
+
+def lowrank_factors(a, d):
+    """Views of the factors of stacked low rank symmetric matrices.
+    
+    A symmetric matrix U diag(w) U.T of rank at most m is stored as an array of
+    length (d+1)*m, which is the F-order ravel of the array of shape (d+1,m)
+    containing U in the first d rows and w in the last row.
+    
+    Parameters
+    ----------
+    a : ndarray
+        Array of shape ((d+1)*m,...) in F-order.
+    
+    d : int
+        The size of the matrices.
+    
+    Returns
+    -------
+    U, w : ndarray
+        Views of shape (d,m,...) and (m,...) into `a` (copies if `a` is not
+        F-contiguous).
+    
+    """
+    m = a.shape[0] // (d+1)
+    F = a.reshape((d+1, m) + a.shape[1:], order='F')
+    return F[:d], F[d]
+
+
+def lowrank_compress(U, w, rank, out_U=None, out_w=None):
+    """Compress a low rank symmetric matrix into a lower rank.
+    
+    The matrix U diag(w) U.T is approximated with the `rank` eigenvalues of
+    the largest magnitude and the corresponding eigenvectors. If the rank of
+    the matrix is at most `rank`, the result is exact.
+    
+    Parameters
+    ----------
+    U : ndarray
+        Array of shape (d,m).
+    
+    w : ndarray
+        Array of shape (m,).
+    
+    rank : int
+        The rank of the output.
+    
+    out_U, out_w : ndarray, optional
+        The output arrays of shape (d,rank) and (rank,). Can not be the same
+        as the input arrays.
+    
+    Returns
+    -------
+    out_U, out_w : ndarray
+        The orthonormal eigenvectors and the eigenvalues. If the rank of the
+        matrix is less than `rank`, the rest of the columns are zero.
+    
+    """
+    d = U.shape[0]
+    if out_U is None:
+        out_U = np.empty((d,rank), order='F')
+    if out_w is None:
+        out_w = np.empty(rank)
+    # Eigendecomposition of the small core matrix
+    Q, R = linalg.qr(U, mode='economic')
+    mu, E = linalg.eigh((R*w).dot(R.T))
+    ind = np.argsort(-np.abs(mu), kind='mergesort')[:rank]
+    n = len(ind)
+    out_U[:,:n] = Q.dot(E[:,ind])
+    out_U[:,n:] = 0
+    out_w[:n] = mu[ind]
+    out_w[n:] = 0
+    return out_U, out_w
+
+
+def lowrank_capacitance(L, U, w):
+    """Eigendecomposition of the capacitance of a low rank downdate.
+    
+    For the matrix Q - U diag(w) U.T with the Cholesky factorisation
+    Q = L L.T, the small matrix inv(L) U diag(w) U.T inv(L).T is decomposed
+    as B diag(mu) B.T with orthonormal B of shape (d,m). The downdated matrix
+    is positive definite if and only if all mu are less than one, and by the
+    Woodbury identity its inverse is then
+        inv(L).T (I + B diag(mu/(1-mu)) B.T) inv(L).
+    
+    Parameters
+    ----------
+    L : ndarray
+        The lower Cholesky factor of Q, of shape (d,d).
+    
+    U, w : ndarray
+        The factors of the low rank matrix, of shape (d,m) and (m,).
+    
+    Returns
+    -------
+    mu : ndarray
+        The eigenvalues in ascending order.
+    
+    B : ndarray
+        The corresponding orthonormal vectors.
+    
+    """
+    P, R = linalg.qr(linalg.solve_triangular(L, U, lower=True),
+                     mode='economic')
+    mu, E = linalg.eigh((R*w).dot(R.T))
+    return mu, P.dot(E)
+
+
+def cho_factor_stacked(A, out=None):
+    """Cholesky factorisation of a stack of symmetric matrices.
+    
+    All the matrices are factorised in one stacked call. If some of the
+    matrices are not positive definite, the factorisation is carried out with
+    an algorithm vectorised over the stack, in order to find every matrix that
+    is not positive definite.
+    
+    Parameters
+    ----------
+    A : ndarray
+        Array of shape (K,d,d) containing the K symmetric matrices. Only the
+        lower triangular part is used.
+    
+    out : ndarray, optional
+        Output array of shape (K,d,d) for the lower Cholesky factors. Can be
+        the same as `A`.
+    
+    Returns
+    -------
+    out : ndarray
+        The lower Cholesky factors with zero upper triangulars. The content is
+        undefined for the matrices that are not positive definite.
+    
+    pos_def : ndarray
+        Boolean array of length K indicating which matrices are positive
+        definite.
+    
+    """
+    K = A.shape[0]
+    d = A.shape[1]
+    if out is None:
+        out = np.empty(A.shape)
+    try:
+        # All the matrices positive definite
+        np.copyto(out, np.linalg.cholesky(A))
+        return out, np.ones(K, dtype=bool)
+    except np.linalg.LinAlgError:
+        pass
+    if not out is A:
+        np.copyto(out, A)
+    pos_def = np.ones(K, dtype=bool)
+    # Column by column Cholesky-Crout vectorised over the stack
+    for j in xrange(d):
+        L_j = out[:,j,:j]
+        piv = out[:,j,j] - np.einsum('ij,ij->i', L_j, L_j)
+        fail = ~(piv > 0)
+        if np.any(fail):
+            # Carry on with unit pivot for the failed matrices
+            pos_def[fail] = False
+            piv[fail] = 1.0
+        np.sqrt(piv, out=piv)
+        out[:,j,j] = piv
+        if j+1 < d:
+            col = out[:,j+1:,j]
+            col -= np.einsum('ikp,ip->ik', out[:,j+1:,:j], L_j)
+            col /= piv[:,np.newaxis]
+    # Zero the upper triangulars
+    iu = np.triu_indices(d, 1)
+    out[:,iu[0],iu[1]] = 0
+    return out, pos_def
+
+
+def cho_solve_stacked(L, b, out=None):
+    """Solve a stack of linear systems given the Cholesky factors.
+    
+    Parameters
+    ----------
+    L : ndarray
+        The lower Cholesky factors of shape (K,d,d), see cho_factor_stacked.
+    
+    b : ndarray
+        The right hand sides of shape (K,d).
+    
+    out : {None, ndarray, 'in-place'}, optional
+        The output array of shape (K,d). Providing a string 'in-place'
+        overwrites `b`.
+    
+    Returns
+    -------
+    out : ndarray
+        The solutions.
+    
+    """
+    if not isinstance(out, np.ndarray) and out == 'in-place':
+        out = b
+    elif out is None:
+        out = b.copy()
+    else:
+        np.copyto(out, b)
+    d = L.shape[1]
+    # Forward substitution
+    for j in xrange(d):
+        if j > 0:
+            out[:,j] -= np.einsum('ip,ip->i', L[:,j,:j], out[:,:j])
+        out[:,j] /= L[:,j,j]
+    # Back substitution with the transpose
+    for j in xrange(d-1, -1, -1):
+        if j+1 < d:
+            out[:,j] -= np.einsum('ip,ip->i', L[:,j+1:,j], out[:,j+1:])
+        out[:,j] /= L[:,j,j]
+    return out
+
+
 def olse(S, n, P=None, out=None):
     """Optimal linear shrinkage estimator.
     
@@ -153,7 +545,7 @@ def olse(S, n, P=None, out=None):
     if not out.flags['FARRAY']:
         # Convert from C-order to F-order by transposing (note symmetric)
         out = out.T
-        if not out.flags['FARRAY']:
+        if not out.flags['FARRAY'] and out.shape[0] > 1:
             raise ValueError('Provided array should be in F-order')
     # Calculate
     d = out.shape[0]
@@ -441,6 +833,46 @@ def copy_fit_samples(fit, pnames, out=None):
     return out
 
 
+def copy_vb_samples(vbfit, par, out=None):
+    """Copy the draws of a vector parameter from PyStan vb output.
+    
+    Parameters
+    ----------
+    vbfit : dict
+        The output of the method StanModel.vb.
+    par : str
+        The name of the vector parameter.
+    out : ndarray, optional
+        The output array.
+    
+    Returns
+    -------
+    ndarray
+        Array of shape (n_draws, d) in F-order containing the draws from the
+        variational approximation.
+    
+    """
+    # The elements are named e.g. 'phi[1]' or 'phi.1'
+    pattern = re.compile(re.escape(par) + r'[\[.](\d+)\]?$')
+    cols = []
+    for (i, name) in enumerate(vbfit['sampler_param_names']):
+        match = pattern.match(name)
+        if match:
+            cols.append((int(match.group(1)), i))
+    if not cols:
+        raise ValueError("No draws of parameter {!r}".format(par))
+    cols.sort()
+    draws = vbfit['sampler_params']
+    ndraws = len(draws[cols[0][1]])
+    if out is None:
+        out = np.empty((ndraws, len(cols)), order='F')
+    elif out.shape != (ndraws, len(cols)):
+        raise ValueError('Invalid output array')
+    for (j, (_, i)) in enumerate(cols):
+        out[:,j] = draws[i]
+    return out
+
+
 def get_last_fit_sample(fit, out=None):
     """Extract the last sample from a PyStan fit object.
     
@@ -491,6 +923,268 @@ def get_last_fit_sample(fit, out=None):
     return out
 
 
+def get_constrained_pars(fit, upar):
+    """Transform unconstrained parameters into the constrained space.
+    
+    Parameters
+    ----------
+    fit : StanFit4<model_name>
+        Instance of the model of the parameters.
+    upar : ndarray
+        The parameters in the unconstrained space (see fit.unconstrain_pars).
+    
+    Returns
+    -------
+    dict
+        The constrained value of each parameter by its name (similarly to the
+        init argument for the method StanModel.sampling). The transformed
+        parameters and the generated quantities are not included.
+    
+    """
+    flat = np.asarray(fit.constrain_pars(np.asarray(upar, dtype=np.float64)))
+    out = {}
+    pos = 0
+    for (p, dims) in zip(fit.model_pars, fit.par_dims):
+        if pos >= flat.shape[0]:
+            # Only the parameters are constrained
+            break
+        if not dims:
+            out[p] = flat[pos]
+            pos += 1
+        else:
+            size = int(np.prod(dims))
+            # Stan stores the multidimensional parameters in column-major order
+            out[p] = flat[pos:pos+size].reshape(dims, order='F')
+            pos += size
+    return out
+
+
+def pystan_version():
+    """Return the version of the installed PyStan as a tuple of ints."""
+    return tuple(int(v) for v in re.findall(r'\d+', pystan.__version__)[:3])
+
+
+def get_fit_adaptation(fit):
+    """Extract the adapted sampler parameters from a PyStan fit object.
+    
+    The returned parameters can be given to the next sampling of the same
+    model through the argument `control` (see StanModel.sampling).
+    
+    Parameters
+    ----------
+    fit : StanFit4<model_name>
+        Instance containing the fitted results.
+    
+    Returns
+    -------
+    stepsize : list of float
+        The adapted step size of each chain.
+    
+    inv_metric : list of ndarray
+        The adapted inverse metric of each chain, either the diagonal or the
+        full matrix depending on the metric of the sampler.
+    
+    """
+    if hasattr(fit, 'get_inv_metric'):
+        # PyStan 2.19 or later
+        stepsize = [float(s) for s in fit.get_stepsize()]
+        inv_metric = [np.array(m, dtype=np.float64)
+                      for m in fit.get_inv_metric()]
+        return stepsize, inv_metric
+    # Parse the adaptation info of each chain, which is of form:
+    #     # Step size = 0.8
+    #     # Diagonal elements of inverse mass matrix:
+    #     # 1.1, 0.9, ...
+    stepsize = []
+    inv_metric = []
+    for info in fit.get_adaptation_info():
+        lines = [line.lstrip('#').strip() for line in info.splitlines()]
+        for (i, line) in enumerate(lines):
+            if line.startswith('Step size'):
+                stepsize.append(float(line.split('=')[1]))
+            elif line.endswith('inverse mass matrix:'):
+                rows = [np.array(row.split(','), dtype=np.float64)
+                        for row in lines[i+1:] if row]
+                if len(rows) == 1:
+                    inv_metric.append(rows[0])
+                else:
+                    inv_metric.append(np.vstack(rows))
+                break
+    return stepsize, inv_metric
+
+
+def psislw(lw, out=None):
+    """Pareto smoothed importance sampling of the given log weights.
+    
+    The largest weights are replaced by the expected order statistics of a
+    generalised Pareto distribution fitted to them (Vehtari, Gelman and Gabry,
+    2015, "Pareto smoothed importance sampling").
+    
+    Parameters
+    ----------
+    lw : ndarray
+        Unnormalised log importance weights.
+    
+    out : ndarray, optional
+        The array into which the output is placed. By default a new array is
+        created. Can be `lw` for in-place operation.
+    
+    Returns
+    -------
+    lw_out : ndarray
+        The smoothed log weights, normalised to sum up to one.
+    
+    k : float
+        The estimated shape parameter of the generalised Pareto distribution.
+        The estimates are reliable if it is less than 0.7.
+    
+    """
+    if out is None:
+        out = lw.copy()
+    elif out is not lw:
+        np.copyto(out, lw)
+    n = out.shape[0]
+    out -= np.max(out)
+    # The tail of the largest weights
+    n_tail = int(np.ceil(min(0.2 * n, 3 * np.sqrt(n))))
+    cutoff = max(np.partition(out, n - n_tail - 1)[n - n_tail - 1],
+                 np.log(np.finfo(float).tiny))
+    tail = np.nonzero(out > cutoff)[0]
+    if tail.shape[0] <= 4:
+        # Too few weights in the tail for fitting
+        k = np.inf
+    else:
+        tail = tail[np.argsort(out[tail])]
+        x = np.exp(out[tail]) - np.exp(cutoff)
+        k, sigma = _gpdfit(x)
+        # Expected order statistics of the fitted distribution
+        p = np.arange(0.5, tail.shape[0]) / tail.shape[0]
+        if abs(k) < np.finfo(float).eps:
+            q = -np.log1p(-p)
+        else:
+            q = np.expm1(-k * np.log1p(-p)) / k
+        q *= sigma
+        out[tail] = np.log(q + np.exp(cutoff))
+        # The smoothed weights can not exceed the largest raw weight
+        np.minimum(out, 0, out=out)
+    # Normalise
+    out -= np.log(np.sum(np.exp(out)))
+    return out, k
+
+
+def _gpdfit(x):
+    """Estimate the parameters of a generalised Pareto distribution.
+    
+    Empirical Bayes estimate of Zhang and Stephens (2009) with a weakly
+    informative prior for the shape parameter `k`. The samples `x` have to be
+    sorted in ascending order.
+    
+    """
+    n = x.shape[0]
+    m = 30 + int(np.sqrt(n))
+    bs = 1 - np.sqrt(m / (np.arange(1, m+1) - 0.5))
+    bs /= 3 * x[int(n/4 + 0.5) - 1]
+    bs += 1 / x[-1]
+    ks = np.mean(np.log1p(-bs[:,np.newaxis] * x), axis=1)
+    L = n * (np.log(-bs / ks) - ks - 1)
+    with np.errstate(over='ignore'):
+        # Overflow yields correctly zero weight
+        w = 1 / np.sum(np.exp(L - L[:,np.newaxis]), axis=1)
+    # Remove the negligible weights
+    keep = w >= 10 * np.finfo(float).eps
+    w = w[keep]
+    w /= np.sum(w)
+    b = np.sum(bs[keep] * w)
+    k = np.mean(np.log1p(-b * x))
+    sigma = -k / b
+    # Weakly informative prior for k
+    k = (n * k + 10 * 0.5) / (n + 10)
+    return k, sigma
+
+
+def effective_sample_size(samp, nchains):
+    """Estimate the effective sample size of the samples of each parameter.
+    
+    The estimate is based on the autocorrelations of the chains combined as in
+    Stan and truncated with Geyer's initial monotone sequence estimator.
+    
+    Parameters
+    ----------
+    samp : ndarray
+        Array of shape (n_samp, n_param) containing the samples of `nchains`
+        equally long chains one after another (see copy_fit_samples).
+    
+    nchains : int
+        The number of chains.
+    
+    Returns
+    -------
+    ndarray
+        The effective sample size of each parameter.
+    
+    """
+    nsamp, nparam = samp.shape
+    n = nsamp // nchains
+    if n < 4:
+        raise ValueError("Too few samples per chain")
+    x = samp[:n*nchains].reshape((nchains, n, nparam))
+    # Autocovariances of each chain with FFT
+    xc = x - np.mean(x, axis=1)[:,np.newaxis,:]
+    nfft = 1 << int(np.ceil(np.log2(2*n)))
+    f = np.fft.rfft(xc, n=nfft, axis=1)
+    f *= np.conj(f)
+    acov = np.fft.irfft(f, n=nfft, axis=1)[:,:n,:]
+    acov /= n
+    # Within and between chain variances
+    W = np.mean(acov[:,0,:], axis=0) * (n / (n - 1))
+    var_plus = W * ((n - 1) / n)
+    if nchains > 1:
+        var_plus += np.var(np.mean(x, axis=1), axis=0, ddof=1)
+    # Autocorrelations of the combined chains
+    rho = 1 - (W - np.mean(acov, axis=0)) / var_plus
+    rho[0] = 1
+    # Sums of consecutive pairs, truncated at the first negative one and made
+    # monotonically decreasing
+    m = n // 2
+    P = rho[0:2*m:2] + rho[1:2*m:2]
+    P *= np.cumprod(P > 0, axis=0)
+    np.minimum.accumulate(P, axis=0, out=P)
+    tau = -1 + 2*np.sum(P, axis=0)
+    # Bound the estimate as in Stan
+    np.maximum(tau, 1 / np.log10(n*nchains), out=tau)
+    return (n*nchains) / tau
+
+
+def shared_zeros(shape, order='C'):
+    """Allocate a zero-initialised array in memory shared with child processes.
+    
+    The array is backed by an anonymous shared memory map, so that the
+    modifications made by processes forked after the allocation are visible
+    to the parent process and vice versa.
+    
+    Parameters
+    ----------
+    shape : int or tuple of int
+        The shape of the array.
+    
+    order : {'C', 'F'}, optional
+        The memory layout of the array. Default is 'C'.
+    
+    Returns
+    -------
+    ndarray
+        The shared float64 array.
+    
+    """
+    if isinstance(shape, (int, long)):
+        shape = (shape,)
+    size = int(np.prod(shape))
+    # Anonymous memory map is shared and zero filled by the operating system
+    buf = mmap.mmap(-1, max(size, 1) * np.dtype(np.float64).itemsize)
+    out = np.frombuffer(buf, dtype=np.float64, count=size)
+    return out.reshape(shape, order=order)
+
+
 def load_stan(filename, overwrite=False):
     """Load or compile a stan model.
     
@@ -4,7 +4,7 @@ algorithm described in an article "Expectation propagation as a way of life"
 
 Execute with:
 $ python fit.py [-h] [--J P] [--D P] [--K P] [--npg P [P ...]] [--iter N]
-                [--cor_input B] [--damp F] [--prec_estim S]
+                [--cor_input B] [--damp F] [--prec_estim S] [--phi_blocks B]
                 [--method {both,distributed,full,none}] [--id S] [--save_true B]
                 [--save_res B] [--seed_data N] [--seed_mcmc N]
                 [--mc_opt P P P P] [--mc_full_opt P P P P]
@@ -28,6 +28,8 @@ optional arguments:
   --prec_estim S        estimate method for tilted distribution precision
                         matrix, currently available options are sample and
                         olse (see dep.method.Master), default sample
+  --phi_blocks B        use the block diagonal site approximations defined
+                        by the model (see dep.method.Master), default False
   --method {both,distributed,full,none}
                         which models are fit, default both
   --id S                optional id appended to the end of the result files,
@@ -96,8 +98,8 @@ from dep.util import load_stan, distribute_groups, suppress_stdout
 
 
 CONFS = ['J','D', 'K', 'npg', 'iter', 'cor_input', 'damp', 'mix', 'prec_estim',
-         'method', 'id', 'save_true', 'save_res', 'seed_data', 'seed_mcmc',
-         'mc_opt', 'mc_full_opt']
+         'phi_blocks', 'method', 'id', 'save_true', 'save_res', 'seed_data',
+         'seed_mcmc', 'mc_opt', 'mc_full_opt']
 
 CONF_DEFAULT = dict(
     J           = 40,
@@ -109,6 +111,7 @@ CONF_DEFAULT = dict(
     damp        = None,
     mix         = False,
     prec_estim  = 'sample',
+    phi_blocks  = False,
     method      = 'both',
     id          = None,
     save_true   = True,
@@ -238,6 +241,11 @@ def main(model_name, conf, ret_master=False):
             init_site = init_site,
             **conf.mc_opt
         )
+        if conf.phi_blocks:
+            if not hasattr(model, 'get_phi_blocks'):
+                raise ValueError("Model {} does not define a block structure "
+                                 "for phi".format(model_name))
+            dep_options['phi_blocks'] = model.get_phi_blocks()
         # Temp fix for the RandomState seed problem with pystan in 32bit Python
         dep_options['tmp_fix_32bit'] = TMP_FIX_32BIT
         
@@ -574,6 +582,8 @@ CONF_HELP = dict(
     prec_estim  = ('estimate method for tilted distribution precision matrix, '
                    'currently available options are sample and olse '
                    '(see dep.method.Master)'),
+    phi_blocks  = ('use the block diagonal site approximations defined by the '
+                   'model (see dep.method.Master)'),
     method      = 'which models are fit',
     id          = 'optional id appended to the end of the result files',
     save_true   = 'save true values',
@@ -605,6 +615,7 @@ CONF_CUSTOMS = dict(
     damp        = dict(type=_parse_damp, metavar='F'),
     mix         = dict(type=_parse_bool, metavar='B'),
     prec_estim  = dict(metavar='S'),
+    phi_blocks  = dict(type=_parse_bool, metavar='B'),
     method      = dict(choices=['both', 'distributed', 'full', 'none']),
     id          = dict(metavar='S'),
     save_true   = dict(type=_parse_bool, metavar='B'),
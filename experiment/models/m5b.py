@@ -223,6 +223,16 @@ class model(object):
         r0 = m0/np.diag(S0)
         return S0, m0, Q0, r0
     
+    def get_phi_blocks(self):
+        """Get a block diagonal structure for the site approximations.
+        
+        Returns the sizes of the consecutive blocks of phi:
+        [mu_a, log(sigma_a)], mu_b and log(sigma_b) (see the
+        argument `phi_blocks` in dep.method.Master).
+        
+        """
+        return (2, self.D, self.D)
+    
     def get_param_definitions(self):
         """Return the definition of the inferred parameters.
         